@@ -0,0 +1,25 @@
+/* Stand-in for the CAENComm library. wavedump only uses it to access the
+ * flash memory of the digitizer (see flash.c and spi.c), which the fake
+ * digitizer doesn't have, so every call fails. */
+
+#include <CAENComm.h>
+
+CAENComm_ErrorCode CAEN_COMM_API CAENComm_Write32(int handle, uint32_t Address, uint32_t Data)
+{
+    return CAENComm_GenericError;
+}
+
+CAENComm_ErrorCode CAEN_COMM_API CAENComm_Read32(int handle, uint32_t Address, uint32_t *Data)
+{
+    return CAENComm_GenericError;
+}
+
+CAENComm_ErrorCode CAEN_COMM_API CAENComm_MultiRead32(int handle, uint32_t *Address, int nCycles, uint32_t *data, CAENComm_ErrorCode *ErrorCode)
+{
+    return CAENComm_GenericError;
+}
+
+CAENComm_ErrorCode CAEN_COMM_API CAENComm_MultiWrite32(int handle, uint32_t *Address, int nCycles, uint32_t *data, CAENComm_ErrorCode *ErrorCode)
+{
+    return CAENComm_GenericError;
+}
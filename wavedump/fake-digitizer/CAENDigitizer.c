@@ -0,0 +1,993 @@
+/* Stand-in for the CAENDigitizer library which pretends to be a DT5742.
+ *
+ * Only the functions called by wavedump are implemented. Events are
+ * triggered at a fixed rate (and by software triggers) and are either
+ * synthesized or replayed from an hdf5 file written by wavedump, so that the
+ * acquisition loop can be run and profiled without a digitizer. Like the real
+ * board, the digitizer only has memory for a limited number of events, and
+ * triggers which arrive when the memory is full are lost. The number of lost
+ * triggers (i.e. the dead time) and the time spent in the readout are printed
+ * when the acquisition is stopped.
+ *
+ * The fake digitizer is configured with environment variables:
+ *
+ *   FAKE_DGTZ_RATE       trigger rate in Hz (default: 1000)
+ *   FAKE_DGTZ_BATCH      maximum number of events per CAEN_DGTZ_ReadData()
+ *                        call (default: the value set with
+ *                        CAEN_DGTZ_SetMaxNumEventsBLT())
+ *   FAKE_DGTZ_MEMORY     number of events the digitizer can store (default:
+ *                        128, like the DT5742)
+ *   FAKE_DGTZ_BANDWIDTH  readout bandwidth in MB/s. 0 means unlimited
+ *                        (default: 0)
+ *   FAKE_DGTZ_REPLAY     hdf5 file to replay events from
+ *   FAKE_DGTZ_GROUP      group of the hdf5 file to replay (default: sodium)
+ *   FAKE_DGTZ_SEED       random number seed (default: 0)
+ *
+ * Self triggers are enabled when one of the group trigger masks (registers
+ * 0x10A8 and 0x11A8) is nonzero, and external triggers when bit 30 of
+ * register 0x810C is set, just like on the real board. No triggers except
+ * software triggers are generated in transparent mode (bit 13 of register
+ * 0x8000).
+ *
+ * Like the real board, the samples are only corrected for the offsets of
+ * the DRS4 cells while the DRS4 corrections are enabled. When they're
+ * disabled with CAEN_DGTZ_DisableDRS4Correction(), the cell and sample
+ * offsets of the tables returned by CAEN_DGTZ_GetCorrectionTables() are
+ * added to the samples. The fake cells are evenly spaced in time.
+ *
+ * Up to FAKE_MAX_BOARDS digitizers can be opened at once with different link
+ * numbers. Every one has its own memory, random numbers (the seed is offset
+ * by the link number) and correction tables, and is configured by the same
+ * environment variables. To emulate a daisy chain of digitizers, the
+ * acquisition of a board in CAEN_DGTZ_S_IN_CONTROLLED mode is only armed by
+ * CAEN_DGTZ_SWStartAcquisition(), and starting a board whose run
+ * synchronization mode isn't CAEN_DGTZ_RUN_SYNC_Disabled starts all of the
+ * armed boards at the same time. Those boards then get the same triggers as
+ * the board which started them (as if from its TRG OUT), with the same
+ * trigger time tags, but lose them independently when their memory is
+ * full. */
+
+#include <CAENDigitizer.h>
+#include "hdf5.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <time.h>
+#include <unistd.h>
+
+#define FAKE_MAX_BOARDS 4
+#define FAKE_NGROUPS 2
+#define FAKE_NCHANNELS (FAKE_NGROUPS*8)
+#define FAKE_MAX_SAMPLES 1024
+#define FAKE_MEMORY 128
+#define FAKE_RATE 1000
+
+/* Synthetic events */
+#define FAKE_BASELINE 2000
+#define FAKE_NOISE 2.0
+#define FAKE_NOISE_SIZE (1 << 16)
+/* Mean pulse height and decay time of the synthetic pulses */
+#define FAKE_AMPLITUDE 200.0
+#define FAKE_FALL_TIME 40.0
+
+/* Maximum number of events read from the replay file */
+#define FAKE_REPLAY_EVENTS 1000
+
+/* Trigger time tag units for the x742 in seconds */
+#define FAKE_TTT_UNIT 8.5e-9
+
+/* Spread of the offsets of the DRS4 cells and of the offsets which depend on
+ * the sample number, in ADC counts */
+#define FAKE_CELL_OFFSET 10.0
+#define FAKE_NSAMPLE_OFFSET 2.0
+
+/* Header in front of every event in the readout buffer */
+typedef struct {
+    uint32_t size;
+    uint32_t counter;
+    uint32_t trigger_time_tag;
+    uint32_t group_mask;
+} FakeEventHeader_t;
+
+/* State of one fake digitizer. The digitizer opened with link number `i`
+ * is `boards[i]`. */
+typedef struct FakeBoard {
+    int open;
+    uint32_t registers[0x10000/4];
+    uint32_t record_length;
+    uint32_t post_trigger;
+    uint32_t max_events_blt;
+    uint32_t group_mask;
+    CAEN_DGTZ_DRS4Frequency_t frequency;
+    int corrections;
+    CAEN_DGTZ_DRS4Correction_t tables[FAKE_NGROUPS];
+
+    double rate;
+    int batch;
+    int memory;
+    double bandwidth;
+
+    CAEN_DGTZ_AcqMode_t acq_mode;
+    CAEN_DGTZ_RunSyncMode_t run_sync;
+    /* Whether the acquisition was started on a board controlled by S-IN and
+     * is waiting for the start from the board before it in the chain. */
+    int armed;
+    /* Board whose TRG OUT the triggers come from when the acquisition was
+     * started by another board, or NULL. */
+    struct FakeBoard *master;
+
+    int running;
+    double start_time;
+    /* Number of triggers generated by the trigger rate since the start of
+     * the acquisition. */
+    long rate_triggers;
+    long sw_triggers;
+    long accepted;
+    long lost;
+    long read;
+    /* Trigger time tags of the events in the digitizer memory */
+    uint32_t *pending;
+    int npending;
+    int first_pending;
+
+    double read_time;
+    double decode_time;
+
+    uint64_t rng;
+    uint16_t *noise;
+    float pulse[FAKE_MAX_SAMPLES];
+    float *replay;
+    long replay_events;
+    long replay_index;
+} FakeBoard_t;
+
+static FakeBoard_t boards[FAKE_MAX_BOARDS];
+
+static double get_time(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec/1e9;
+}
+
+static double getenv_double(char *name, double value)
+{
+    char *s = getenv(name);
+    return s ? atof(s) : value;
+}
+
+/* xorshift64* random number generator */
+static uint64_t rand64(FakeBoard_t *fake)
+{
+    fake->rng ^= fake->rng >> 12;
+    fake->rng ^= fake->rng << 25;
+    fake->rng ^= fake->rng >> 27;
+    return fake->rng*0x2545F4914F6CDD1DULL;
+}
+
+static double uniform(FakeBoard_t *fake)
+{
+    return (rand64(fake) >> 11)*(1.0/9007199254740992.0);
+}
+
+static double gaussian(FakeBoard_t *fake)
+{
+    return sqrt(-2*log(1 - uniform(fake)))*cos(2*M_PI*uniform(fake));
+}
+
+/* Fills the correction tables with random cell and sample offsets. These are
+ * always the same for a given board, no matter what FAKE_DGTZ_SEED is. */
+static void make_tables(FakeBoard_t *fake, int board)
+{
+    uint64_t rng = fake->rng;
+    int gr, ch, k;
+
+    fake->rng = 88172645463325252ULL + board*0x9E3779B97F4A7C15ULL;
+    for (gr = 0; gr < FAKE_NGROUPS; gr++) {
+        for (ch = 0; ch < 8; ch++) {
+            for (k = 0; k < 1024; k++) {
+                fake->tables[gr].cell[ch][k] = (int16_t) rint(FAKE_CELL_OFFSET*gaussian(fake));
+                fake->tables[gr].nsample[ch][k] = (int8_t) rint(FAKE_NSAMPLE_OFFSET*gaussian(fake));
+            }
+        }
+    }
+    fake->rng = rng;
+}
+
+static int event_size(FakeBoard_t *fake)
+{
+    int ngroups = 0, i;
+
+    for (i = 0; i < FAKE_NGROUPS; i++)
+        if (fake->group_mask & (1 << i))
+            ngroups += 1;
+
+    return sizeof(FakeEventHeader_t) + ngroups*8*fake->record_length*sizeof(uint16_t);
+}
+
+/* Reads the first FAKE_REPLAY_EVENTS events of every channel of a group in
+ * an hdf5 file written by wavedump. Channels which aren't in the file are
+ * synthesized. */
+static int load_replay(FakeBoard_t *fake, char *filename, char *group_name)
+{
+    hid_t file, group, dset, space, mem_space;
+    hsize_t dims[2], start[2], count[2];
+    char dset_name[256];
+    int adc_scale = 1;
+    long i, n;
+    int ch;
+
+    if ((file = H5Fopen(filename, H5F_ACC_RDONLY, H5P_DEFAULT)) < 0) {
+        fprintf(stderr, "fake digitizer: couldn't open replay file %s\n", filename);
+        return 1;
+    }
+
+    if ((group = H5Gopen(file, group_name, H5P_DEFAULT)) < 0) {
+        fprintf(stderr, "fake digitizer: couldn't find group %s in %s\n", group_name, filename);
+        H5Fclose(file);
+        return 1;
+    }
+
+    if (H5Aexists(group, "adc_scale") > 0) {
+        hid_t attr = H5Aopen(group, "adc_scale", H5P_DEFAULT);
+        H5Aread(attr, H5T_NATIVE_INT, &adc_scale);
+        H5Aclose(attr);
+    }
+
+    fake->replay = malloc(FAKE_REPLAY_EVENTS*FAKE_NCHANNELS*FAKE_MAX_SAMPLES*sizeof(float));
+    fake->replay_events = FAKE_REPLAY_EVENTS;
+
+    for (i = 0; i < FAKE_REPLAY_EVENTS*FAKE_NCHANNELS*FAKE_MAX_SAMPLES; i++)
+        fake->replay[i] = FAKE_BASELINE;
+
+    for (ch = 0; ch < FAKE_NCHANNELS; ch++) {
+        sprintf(dset_name, "ch%i", ch);
+        if (H5Lexists(group, dset_name, H5P_DEFAULT) <= 0) continue;
+
+        dset = H5Dopen(group, dset_name, H5P_DEFAULT);
+        space = H5Dget_space(dset);
+        H5Sget_simple_extent_dims(space, dims, NULL);
+
+        n = dims[0] < FAKE_REPLAY_EVENTS ? dims[0] : FAKE_REPLAY_EVENTS;
+        if (n < fake->replay_events)
+            fake->replay_events = n;
+
+        start[0] = 0;
+        start[1] = 0;
+        count[0] = n;
+        count[1] = dims[1] < FAKE_MAX_SAMPLES ? dims[1] : FAKE_MAX_SAMPLES;
+        H5Sselect_hyperslab(space, H5S_SELECT_SET, start, NULL, count, NULL);
+        mem_space = H5Screate_simple(2, count, NULL);
+
+        float *data = malloc(n*count[1]*sizeof(float));
+        H5Dread(dset, H5T_NATIVE_FLOAT, mem_space, space, H5P_DEFAULT, data);
+
+        for (i = 0; i < n; i++)
+            for (int k = 0; k < count[1]; k++)
+                fake->replay[(i*FAKE_NCHANNELS + ch)*FAKE_MAX_SAMPLES + k] = data[i*count[1] + k]/adc_scale;
+
+        free(data);
+        H5Sclose(mem_space);
+        H5Sclose(space);
+        H5Dclose(dset);
+    }
+
+    H5Gclose(group);
+    H5Fclose(file);
+
+    if (fake->replay_events == 0) {
+        fprintf(stderr, "fake digitizer: no events to replay in %s\n", filename);
+        return 1;
+    }
+
+    fprintf(stderr, "fake digitizer: replaying %li events from %s/%s\n", fake->replay_events, filename, group_name);
+
+    return 0;
+}
+
+/* Adds a trigger to the digitizer memory, or counts it as lost if the
+ * memory is full. */
+static void trigger(FakeBoard_t *fake, double t)
+{
+    if (fake->npending >= fake->memory) {
+        fake->lost += 1;
+        return;
+    }
+
+    fake->pending[(fake->first_pending + fake->npending) % fake->memory] = (uint32_t) ((t - fake->start_time)/FAKE_TTT_UNIT) & 0x7fffffff;
+    fake->npending += 1;
+    fake->accepted += 1;
+}
+
+/* Adds the triggers generated by the trigger rate since the last call. A
+ * board started by another one gets the triggers of that board. */
+static void update_triggers(FakeBoard_t *fake)
+{
+    FakeBoard_t *source = fake->master ? fake->master : fake;
+    long n, i;
+    double now;
+
+    if (!fake->running)
+        return;
+
+    /* Transparent mode */
+    if (fake->registers[0x8000/4] & (1 << 13))
+        return;
+
+    /* Self triggers or external trigger */
+    if (!source->registers[0x10A8/4] && !source->registers[0x11A8/4] && !(source->registers[0x810C/4] & (1 << 30)))
+        return;
+
+    now = get_time();
+    n = (long) ((now - fake->start_time)*source->rate);
+    for (i = fake->rate_triggers; i < n; i++)
+        trigger(fake, fake->start_time + i/source->rate);
+    fake->rate_triggers = n;
+}
+
+/* Writes the samples of a single event to `samples`. */
+static void make_event(FakeBoard_t *fake, uint16_t *samples)
+{
+    int gr, ch, k, i = 0;
+    float *replay = NULL;
+    double amplitude, v;
+    int t0 = fake->record_length*(100 - fake->post_trigger)/100;
+
+    if (fake->replay) {
+        replay = fake->replay + fake->replay_index*FAKE_NCHANNELS*FAKE_MAX_SAMPLES;
+        fake->replay_index = (fake->replay_index + 1) % fake->replay_events;
+    }
+
+    for (gr = 0; gr < FAKE_NGROUPS; gr++) {
+        if (!(fake->group_mask & (1 << gr))) continue;
+
+        for (ch = 0; ch < 8; ch++) {
+            uint16_t *y = samples + i*fake->record_length;
+            i += 1;
+
+            if (replay) {
+                float *r = replay + (gr*8 + ch)*FAKE_MAX_SAMPLES;
+                for (k = 0; k < fake->record_length; k++)
+                    y[k] = r[k] < 0 ? 0 : r[k] > 4095 ? 4095 : (uint16_t) (r[k] + 0.5f);
+                continue;
+            }
+
+            /* Noise from a random offset of the noise table, with a negative
+             * exponential pulse after the trigger. */
+            memcpy(y, fake->noise + rand64(fake) % (FAKE_NOISE_SIZE - fake->record_length), fake->record_length*sizeof(uint16_t));
+            amplitude = -FAKE_AMPLITUDE*log(1 - uniform(fake));
+            for (k = t0; k < fake->record_length; k++) {
+                v = y[k] - amplitude*fake->pulse[k - t0];
+                y[k] = v < 0 ? 0 : (uint16_t) v;
+            }
+        }
+    }
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_OpenDigitizer(CAEN_DGTZ_ConnectionType LinkType, int LinkNum, int ConetNode, uint32_t VMEBaseAddress, int *handle)
+{
+    FakeBoard_t *fake;
+    char *replay, *group;
+    int i;
+
+    if (LinkNum < 0 || LinkNum >= FAKE_MAX_BOARDS)
+        return CAEN_DGTZ_DigitizerNotFound;
+
+    fake = &boards[LinkNum];
+    if (fake->open)
+        return CAEN_DGTZ_DigitizerAlreadyOpen;
+
+    memset(fake, 0, sizeof(FakeBoard_t));
+
+    fake->rate = getenv_double("FAKE_DGTZ_RATE", FAKE_RATE);
+    fake->batch = (int) getenv_double("FAKE_DGTZ_BATCH", 0);
+    fake->memory = (int) getenv_double("FAKE_DGTZ_MEMORY", FAKE_MEMORY);
+    fake->bandwidth = getenv_double("FAKE_DGTZ_BANDWIDTH", 0);
+    fake->rng = (uint64_t) getenv_double("FAKE_DGTZ_SEED", 0)*2654435761ULL + 88172645463325252ULL + LinkNum*0x9E3779B97F4A7C15ULL;
+
+    if (fake->memory < 1)
+        fake->memory = 1;
+
+    fake->record_length = FAKE_MAX_SAMPLES;
+    fake->post_trigger = 50;
+    fake->max_events_blt = 1023;
+    fake->group_mask = (1 << FAKE_NGROUPS) - 1;
+    fake->frequency = CAEN_DGTZ_DRS4_1GHz;
+    fake->corrections = 1;
+    fake->acq_mode = CAEN_DGTZ_SW_CONTROLLED;
+    fake->run_sync = CAEN_DGTZ_RUN_SYNC_Disabled;
+    make_tables(fake, LinkNum);
+    /* PLL locked */
+    fake->registers[0x8104/4] = 1 << 7;
+
+    fake->pending = malloc(fake->memory*sizeof(uint32_t));
+    fake->noise = malloc(FAKE_NOISE_SIZE*sizeof(uint16_t));
+    if (!fake->pending || !fake->noise)
+        return CAEN_DGTZ_OutOfMemory;
+
+    for (i = 0; i < FAKE_NOISE_SIZE; i++)
+        fake->noise[i] = (uint16_t) (FAKE_BASELINE + FAKE_NOISE*gaussian(fake) + 0.5);
+
+    for (i = 0; i < FAKE_MAX_SAMPLES; i++)
+        fake->pulse[i] = exp(-i/FAKE_FALL_TIME);
+
+    replay = getenv("FAKE_DGTZ_REPLAY");
+    if (replay) {
+        group = getenv("FAKE_DGTZ_GROUP");
+        if (load_replay(fake, replay, group ? group : "sodium"))
+            return CAEN_DGTZ_DigitizerNotFound;
+    }
+
+    fprintf(stderr, "fake digitizer %i: trigger rate %.0f Hz, memory for %i events\n", LinkNum, fake->rate, fake->memory);
+
+    fake->open = 1;
+    *handle = LinkNum;
+
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetInfo(int handle, CAEN_DGTZ_BoardInfo_t *BoardInfo)
+{
+    memset(BoardInfo, 0, sizeof(CAEN_DGTZ_BoardInfo_t));
+    strcpy(BoardInfo->ModelName, "DT5742");
+    BoardInfo->Model = CAEN_DGTZ_DT5742;
+    BoardInfo->Channels = FAKE_NGROUPS;
+    BoardInfo->FormFactor = CAEN_DGTZ_DESKTOP_FORM_FACTOR;
+    BoardInfo->FamilyCode = CAEN_DGTZ_XX742_FAMILY_CODE;
+    strcpy(BoardInfo->ROC_FirmwareRel, "4.21");
+    strcpy(BoardInfo->AMC_FirmwareRel, "1.03");
+    BoardInfo->ADC_NBits = 12;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_WriteRegister(int handle, uint32_t Address, uint32_t Data)
+{
+    FakeBoard_t *fake = &boards[handle];
+    if (Address >= 0x10000)
+        return CAEN_DGTZ_InvalidParam;
+    fake->registers[Address/4] = Data;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_ReadRegister(int handle, uint32_t Address, uint32_t *Data)
+{
+    FakeBoard_t *fake = &boards[handle];
+    if (Address >= 0x10000)
+        return CAEN_DGTZ_InvalidParam;
+    *Data = fake->registers[Address/4];
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_Reset(int handle)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_Calibrate(int handle)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_ClearData(int handle)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->npending = 0;
+    return CAEN_DGTZ_Success;
+}
+
+/* Starts the acquisition of a board at `start_time`. If `master` isn't
+ * NULL, the board gets the triggers of `master`. */
+static void start(FakeBoard_t *fake, double start_time, FakeBoard_t *master)
+{
+    fake->armed = 0;
+    fake->master = master;
+    fake->running = 1;
+    fake->start_time = start_time;
+    fake->rate_triggers = 0;
+    fake->sw_triggers = 0;
+    fake->accepted = 0;
+    fake->lost = 0;
+    fake->read = 0;
+    fake->read_time = 0;
+    fake->decode_time = 0;
+}
+
+/* Stops the acquisition of a board and prints the number of triggers and
+ * how long the readout took. */
+static void stop(FakeBoard_t *fake)
+{
+    long triggers;
+
+    if (!fake->running)
+        return;
+
+    update_triggers(fake);
+    fake->running = 0;
+
+    triggers = fake->accepted + fake->lost;
+    fprintf(stderr, "fake digitizer %i: %li triggers (%li software) in %.3f s, %li accepted, %li lost (%.2f%% dead time)\n",
+            (int) (fake - boards), triggers, fake->sw_triggers, get_time() - fake->start_time, fake->accepted, fake->lost, triggers ? 100.0*fake->lost/triggers : 0.0);
+    fprintf(stderr, "fake digitizer %i: %li events read, %.3f s reading, %.3f s decoding\n", (int) (fake - boards), fake->read, fake->read_time, fake->decode_time);
+}
+
+/* Starts the acquisition, or arms it if the board is controlled by S-IN.
+ * Starting a board with run synchronization also starts every armed
+ * board. */
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SWStartAcquisition(int handle)
+{
+    FakeBoard_t *fake = &boards[handle];
+    double now;
+    int i;
+
+    if (fake->acq_mode == CAEN_DGTZ_S_IN_CONTROLLED) {
+        fake->armed = 1;
+        return CAEN_DGTZ_Success;
+    }
+
+    now = get_time();
+    start(fake, now, NULL);
+
+    if (fake->run_sync != CAEN_DGTZ_RUN_SYNC_Disabled) {
+        for (i = 0; i < FAKE_MAX_BOARDS; i++)
+            if (boards[i].open && boards[i].armed)
+                start(&boards[i], now, fake);
+    }
+
+    return CAEN_DGTZ_Success;
+}
+
+/* Stops the acquisition of a board and of every board it started. */
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SWStopAcquisition(int handle)
+{
+    FakeBoard_t *fake = &boards[handle];
+    int i;
+
+    fake->armed = 0;
+
+    if (!fake->running)
+        return CAEN_DGTZ_Success;
+
+    stop(fake);
+
+    for (i = 0; i < FAKE_MAX_BOARDS; i++)
+        if (boards[i].running && boards[i].master == fake)
+            stop(&boards[i]);
+
+    return CAEN_DGTZ_Success;
+}
+
+/* Sends a software trigger to a board and to every board it started. */
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SendSWtrigger(int handle)
+{
+    FakeBoard_t *fake = &boards[handle];
+    double now;
+    int i;
+
+    if (!fake->running)
+        return CAEN_DGTZ_Success;
+
+    now = get_time();
+    for (i = 0; i < FAKE_MAX_BOARDS; i++) {
+        if (&boards[i] != fake && !(boards[i].running && boards[i].master == fake))
+            continue;
+
+        update_triggers(&boards[i]);
+        boards[i].sw_triggers += 1;
+        trigger(&boards[i], now);
+    }
+
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_MallocReadoutBuffer(int handle, char **buffer, uint32_t *size)
+{
+    FakeBoard_t *fake = &boards[handle];
+    int n = fake->batch > 0 ? fake->batch : fake->max_events_blt;
+
+    *size = sizeof(uint32_t) + n*(sizeof(FakeEventHeader_t) + FAKE_NCHANNELS*FAKE_MAX_SAMPLES*sizeof(uint16_t));
+    *buffer = malloc(*size);
+
+    if (!*buffer)
+        return CAEN_DGTZ_OutOfMemory;
+
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_FreeReadoutBuffer(char **buffer)
+{
+    free(*buffer);
+    *buffer = NULL;
+    return CAEN_DGTZ_Success;
+}
+
+/* Moves up to FAKE_DGTZ_BATCH events from the digitizer memory to `buffer`.
+ * The buffer starts with the number of events, and every event is a
+ * FakeEventHeader_t followed by the 12 bit samples of every channel of the
+ * enabled groups. */
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_ReadData(int handle, CAEN_DGTZ_ReadMode_t mode, char *buffer, uint32_t *bufferSize)
+{
+    FakeBoard_t *fake = &boards[handle];
+    uint32_t n, i;
+    int size = event_size(fake);
+    int max_events = fake->batch > 0 ? fake->batch : fake->max_events_blt;
+    FakeEventHeader_t *header;
+    double t0 = get_time();
+
+    update_triggers(fake);
+
+    n = fake->npending < max_events ? fake->npending : max_events;
+
+    if (n == 0) {
+        *bufferSize = 0;
+        fake->read_time += get_time() - t0;
+        return CAEN_DGTZ_Success;
+    }
+
+    *(uint32_t *) buffer = n;
+    for (i = 0; i < n; i++) {
+        header = (FakeEventHeader_t *) (buffer + sizeof(uint32_t) + i*size);
+        header->size = size;
+        header->counter = fake->read & 0x3fffff;
+        header->trigger_time_tag = fake->pending[fake->first_pending];
+        header->group_mask = fake->group_mask;
+        make_event(fake, (uint16_t *) (header + 1));
+        fake->first_pending = (fake->first_pending + 1) % fake->memory;
+        fake->npending -= 1;
+        fake->read += 1;
+    }
+
+    *bufferSize = sizeof(uint32_t) + n*size;
+
+    /* Wait for the rest of the time the transfer would take. */
+    if (fake->bandwidth > 0) {
+        double transfer = *bufferSize/(fake->bandwidth*1e6) - (get_time() - t0);
+        if (transfer > 0)
+            usleep((useconds_t) (transfer*1e6));
+    }
+
+    fake->read_time += get_time() - t0;
+
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetNumEvents(int handle, char *buffer, uint32_t buffsize, uint32_t *numEvents)
+{
+    if (buffsize < sizeof(uint32_t))
+        return CAEN_DGTZ_InvalidBuffer;
+    *numEvents = *(uint32_t *) buffer;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetEventInfo(int handle, char *buffer, uint32_t buffsize, int32_t numEvent, CAEN_DGTZ_EventInfo_t *eventInfo, char **EventPtr)
+{
+    FakeBoard_t *fake = &boards[handle];
+    FakeEventHeader_t *header;
+    double t0 = get_time();
+
+    if (numEvent < 0 || numEvent >= *(uint32_t *) buffer)
+        return CAEN_DGTZ_BadEventNumber;
+
+    header = (FakeEventHeader_t *) (buffer + sizeof(uint32_t) + numEvent*event_size(fake));
+
+    eventInfo->EventSize = header->size;
+    eventInfo->BoardId = handle;
+    eventInfo->Pattern = 0;
+    eventInfo->ChannelMask = header->group_mask;
+    eventInfo->EventCounter = header->counter;
+    eventInfo->TriggerTimeTag = header->trigger_time_tag;
+    *EventPtr = (char *) header;
+
+    fake->decode_time += get_time() - t0;
+
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_AllocateEvent(int handle, void **Evt)
+{
+    CAEN_DGTZ_X742_EVENT_t *event;
+    int gr, ch;
+
+    event = calloc(1, sizeof(CAEN_DGTZ_X742_EVENT_t));
+    if (!event)
+        return CAEN_DGTZ_OutOfMemory;
+
+    for (gr = 0; gr < FAKE_NGROUPS; gr++) {
+        for (ch = 0; ch < MAX_X742_CHANNEL_SIZE; ch++) {
+            event->DataGroup[gr].DataChannel[ch] = malloc(FAKE_MAX_SAMPLES*sizeof(float));
+            if (!event->DataGroup[gr].DataChannel[ch])
+                return CAEN_DGTZ_OutOfMemory;
+        }
+    }
+
+    *Evt = event;
+
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_FreeEvent(int handle, void **Evt)
+{
+    CAEN_DGTZ_X742_EVENT_t *event = *Evt;
+    int gr, ch;
+
+    if (!event)
+        return CAEN_DGTZ_Success;
+
+    for (gr = 0; gr < FAKE_NGROUPS; gr++)
+        for (ch = 0; ch < MAX_X742_CHANNEL_SIZE; ch++)
+            free(event->DataGroup[gr].DataChannel[ch]);
+    free(event);
+    *Evt = NULL;
+
+    return CAEN_DGTZ_Success;
+}
+
+/* Converts the samples of an event to floats. The fast trigger channel
+ * (channel 8 of every group) is never digitized. */
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_DecodeEvent(int handle, char *evtPtr, void **Evt)
+{
+    FakeBoard_t *fake = &boards[handle];
+    FakeEventHeader_t *header = (FakeEventHeader_t *) evtPtr;
+    CAEN_DGTZ_X742_EVENT_t *event = *Evt;
+    CAEN_DGTZ_DRS4Correction_t *table;
+    uint16_t *samples = (uint16_t *) (header + 1);
+    int gr, ch, k, cell;
+    double t0 = get_time();
+
+    for (gr = 0; gr < FAKE_NGROUPS; gr++) {
+        event->GrPresent[gr] = (header->group_mask >> gr) & 1;
+        if (!event->GrPresent[gr]) continue;
+
+        event->DataGroup[gr].TriggerTimeTag = header->trigger_time_tag;
+        event->DataGroup[gr].StartIndexCell = cell = header->counter % 1024;
+        table = &fake->tables[gr];
+        for (ch = 0; ch < 8; ch++) {
+            event->DataGroup[gr].ChSize[ch] = fake->record_length;
+            for (k = 0; k < fake->record_length; k++) {
+                event->DataGroup[gr].DataChannel[ch][k] = samples[k];
+                if (!fake->corrections)
+                    event->DataGroup[gr].DataChannel[ch][k] += table->cell[ch][(cell + k) % 1024] + table->nsample[ch][k];
+            }
+            samples += fake->record_length;
+        }
+        event->DataGroup[gr].ChSize[8] = 0;
+    }
+
+    fake->decode_time += get_time() - t0;
+
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetRecordLength(int handle, uint32_t size, ...)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->record_length = size > FAKE_MAX_SAMPLES ? FAKE_MAX_SAMPLES : size;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetRecordLength(int handle, uint32_t *size, ...)
+{
+    FakeBoard_t *fake = &boards[handle];
+    *size = fake->record_length;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetPostTriggerSize(int handle, uint32_t percent)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->post_trigger = percent > 100 ? 100 : percent;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetPostTriggerSize(int handle, uint32_t *percent)
+{
+    FakeBoard_t *fake = &boards[handle];
+    *percent = fake->post_trigger;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetMaxNumEventsBLT(int handle, uint32_t numEvents)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->max_events_blt = numEvents > 0 ? numEvents : 1;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetGroupEnableMask(int handle, uint32_t mask)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->group_mask = mask & ((1 << FAKE_NGROUPS) - 1);
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetDRS4SamplingFrequency(int handle, CAEN_DGTZ_DRS4Frequency_t frequency)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->frequency = frequency;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetDRS4SamplingFrequency(int handle, CAEN_DGTZ_DRS4Frequency_t *frequency)
+{
+    FakeBoard_t *fake = &boards[handle];
+    *frequency = fake->frequency;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetAcquisitionMode(int handle, CAEN_DGTZ_AcqMode_t mode)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->acq_mode = mode;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetAcquisitionMode(int handle, CAEN_DGTZ_AcqMode_t *mode)
+{
+    FakeBoard_t *fake = &boards[handle];
+    *mode = fake->acq_mode;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetRunSynchronizationMode(int handle, CAEN_DGTZ_RunSyncMode_t mode)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->run_sync = mode;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetChannelDCOffset(int handle, uint32_t channel, uint32_t *Tvalue)
+{
+    *Tvalue = 0x55F0;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetGroupDCOffset(int handle, uint32_t group, uint32_t *Tvalue)
+{
+    *Tvalue = 0x55F0;
+    return CAEN_DGTZ_Success;
+}
+
+/* Returns the fake correction tables. The cells are evenly spaced in time
+ * with the sampling period (ns) of `frequency`. */
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_GetCorrectionTables(int handle, int frequency, void *CTable)
+{
+    FakeBoard_t *fake = &boards[handle];
+    CAEN_DGTZ_DRS4Correction_t *tables = CTable;
+    float tsample;
+    int gr, k;
+
+    switch (frequency) {
+    case CAEN_DGTZ_DRS4_5GHz:
+        tsample = 0.2;
+        break;
+    case CAEN_DGTZ_DRS4_2_5GHz:
+        tsample = 0.4;
+        break;
+    case CAEN_DGTZ_DRS4_1GHz:
+        tsample = 1.0;
+        break;
+    default:
+        tsample = 1000.0/750;
+        break;
+    }
+
+    memset(tables, 0, MAX_X742_GROUP_SIZE*sizeof(CAEN_DGTZ_DRS4Correction_t));
+    for (gr = 0; gr < FAKE_NGROUPS; gr++) {
+        tables[gr] = fake->tables[gr];
+        for (k = 0; k < 1024; k++)
+            tables[gr].time[k] = k*tsample;
+    }
+
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_LoadDRS4CorrectionData(int handle, CAEN_DGTZ_DRS4Frequency_t frequency)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_EnableDRS4Correction(int handle)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->corrections = 1;
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_DisableDRS4Correction(int handle)
+{
+    FakeBoard_t *fake = &boards[handle];
+    fake->corrections = 0;
+    return CAEN_DGTZ_Success;
+}
+
+/* Settings which don't change the fake events. */
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetChannelDCOffset(int handle, uint32_t channel, uint32_t Tvalue)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetChannelEnableMask(int handle, uint32_t mask)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetChannelGroupMask(int handle, uint32_t group, uint32_t channelmask)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetChannelSelfTrigger(int handle, CAEN_DGTZ_TriggerMode_t mode, uint32_t channelmask)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetChannelTriggerThreshold(int handle, uint32_t channel, uint32_t Tvalue)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetDESMode(int handle, CAEN_DGTZ_EnaDis_t enable)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetDecimationFactor(int handle, uint16_t factor)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetExtTriggerInputMode(int handle, CAEN_DGTZ_TriggerMode_t mode)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetFastTriggerDigitizing(int handle, CAEN_DGTZ_EnaDis_t enable)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetFastTriggerMode(int handle, CAEN_DGTZ_TriggerMode_t mode)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetGroupDCOffset(int handle, uint32_t group, uint32_t Tvalue)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetGroupFastTriggerDCOffset(int handle, uint32_t group, uint32_t DCvalue)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetGroupFastTriggerThreshold(int handle, uint32_t group, uint32_t Tvalue)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetGroupSelfTrigger(int handle, CAEN_DGTZ_TriggerMode_t mode, uint32_t groupmask)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetGroupTriggerThreshold(int handle, uint32_t group, uint32_t Tvalue)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetIOLevel(int handle, CAEN_DGTZ_IOLevel_t level)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetInterruptConfig(int handle, CAEN_DGTZ_EnaDis_t state, uint8_t level, uint32_t status_id, uint16_t event_number, CAEN_DGTZ_IRQMode_t mode)
+{
+    return CAEN_DGTZ_Success;
+}
+
+CAEN_DGTZ_ErrorCode CAENDGTZ_API CAEN_DGTZ_SetTriggerPolarity(int handle, uint32_t channel, CAEN_DGTZ_TriggerPolarity_t Polarity)
+{
+    return CAEN_DGTZ_Success;
+}
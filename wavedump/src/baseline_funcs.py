@@ -0,0 +1,117 @@
+"""
+Vectorized baseline subtraction for SPE waveforms.
+
+These functions don't depend on the command line arguments of
+`analyze-waveforms`, so they can be used (and benchmarked) by other tools.
+"""
+
+from __future__ import print_function, division
+import numpy as np
+
+def iqr(x):
+    """
+    Returns the interquartile range of `x`.
+    """
+    return np.percentile(x,75) - np.percentile(x,25)
+
+def masked_median(y, mask):
+    """
+    Returns the median of every row of the 2D array `y`, only using the
+    entries where `mask` is True. This gives the same result as
+
+        np.array([np.median(y[i, mask[i]]) for i in range(len(y))])
+
+    but without a python loop over the rows. The masked entries are replaced
+    with infinity, so after `np.partition` they're at the end of each row, and
+    the median is just the middle of the first `n` entries, where `n` is the
+    number of unmasked entries. The rows are partitioned together in groups
+    with the same `n`, so only the two middle entries of every row have to be
+    found instead of sorting the whole row. There are only a few groups,
+    since most of the samples of every waveform are unmasked.
+
+    Rows with no unmasked entries return NaN.
+    """
+    y = np.asarray(y)
+    mask = np.asarray(mask)
+    n = np.count_nonzero(mask, axis=-1)
+    values = np.where(mask, y, np.inf)
+    median = np.full(len(values), np.nan, dtype=values.dtype)
+    for count in np.unique(n[n > 0]):
+        rows = np.flatnonzero(n == count)
+        lo, hi = (count-1)//2, count//2
+        s = np.partition(values[rows], [lo, hi], axis=-1)
+        median[rows] = (s[:,lo] + s[:,hi])/2
+    return median
+
+def get_window_offset(x, y, start_time, integration_time):
+    """
+    Returns the median of all points of the waveforms `y` in the integration
+    window, which integration method 1 subtracts from every waveform.
+    """
+    i_mask = np.logical_and(x>=start_time, x<start_time+integration_time)
+    return np.median(y[:, i_mask])
+
+def subtract_spe_baseline(x, y, high_filter_y, method=1, start_time=50, integration_time=300):
+    """
+    Subtracts the baseline from the SPE waveforms `y` with times `x`.
+    `high_filter_y` is `y` passed through the high pass filter (see
+    `high_filter_SPE` in `analyze-waveforms`). `start_time` and
+    `integration_time` are the SPE integration window in nanoseconds and are
+    only used by method 1. If `start_time` is None, method 1 skips the
+    subtraction of the median in the integration window, which is just a
+    constant offset (see `get_window_offset`). This is used to integrate
+    several windows from one baseline subtraction.
+
+    INTEGRATION METHODS
+    0: Only per event median subtraction (preformed in every method).
+    1 (default): For each event, subtract off the median of all points that lie above `cutoff`.
+                 Then, across all events, subtract off the median of all points in the integration window.
+    2: Per sample median subtraction. This method is not good because the SPE signal gets diminished.
+    3: Delete all trials that have an SPE between `ma` and `mb`. Subtract off the median between `ma` and `mb` on a per event basis.
+    4: Same as 3, except no trials are deleted. Trials that have an SPE between `ma` and `mb` get reduced by the total median
+       between `ma` and `mb` of events that don't have an SPE in this range.
+    5: Subtract off the median of all points before the trigger on a per event basis. Unlike the median
+       of the whole waveform in method 0, this isn't pulled down by the SPE pulses, which all come after
+       the trigger.
+
+    `y` is modified in place for every method except 3, which returns a new
+    array without the deleted trials.
+    """
+    # Integration Method 0, per event median subtraction:
+    y -= np.median(y, axis=-1)[:, np.newaxis]
+
+    if method == 1:  # Default
+        cutoff = -2*iqr(high_filter_y.flatten())
+        y -= masked_median(y, y > cutoff)[:, np.newaxis]
+        if start_time is not None:
+            y -= get_window_offset(x, y, start_time, integration_time)
+    elif method == 2:
+        # `s` for samples
+        s = y.T
+        s_mask = s > -10*iqr(high_filter_y.flatten())
+        print(f'average number of good samples: {np.mean(np.count_nonzero(s_mask, axis=-1))}')
+        y -= masked_median(s, s_mask)
+    elif method == 3:
+        ma = -25
+        mb = 200
+        m_mask = np.logical_and(x >= ma, x < mb)
+        SPE_trials = np.min(y[:, m_mask], axis=-1) < -2 * iqr(high_filter_y[:, m_mask].flatten())
+        y = y[~SPE_trials]
+        # Subtract off the median between `ma` and `mb` per event
+        y -= np.median(y[:, m_mask], axis=-1)[:, np.newaxis]
+        if len(y) == 0:
+            print('All trials were removed')
+    elif method == 4:
+        ma = -25
+        mb = 200
+        m_mask = np.logical_and(x>=ma, x<mb)
+        no_SPE_trials_mask = np.min(y[:, m_mask], axis=-1) > -2 * iqr(high_filter_y[:, m_mask].flatten())
+        medians = np.median(y[:, m_mask], axis=-1)
+        if not np.all(no_SPE_trials_mask):
+            medians[~no_SPE_trials_mask] = np.median(y[no_SPE_trials_mask][:, m_mask])
+        y -= medians[:, np.newaxis]
+    elif method == 5:
+        y -= np.median(y[:, x < 0], axis=-1)[:, np.newaxis]
+    elif method != 0:
+        print('Not a valid integration method. Defaulting to integration method 0')
+    return y
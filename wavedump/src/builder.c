@@ -0,0 +1,368 @@
+/* Reads out several digitizers at once and puts their events together by
+ * trigger time (see builder.h). */
+
+#include "builder.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <time.h>
+
+/* Reads out the events in the memory of the digitizer into `buffer` and
+ * counts them, holding off the software triggers while the CAEN library is
+ * called. Unless the memory was empty, the number of events and the time it
+ * took are recorded in `telemetry` if it isn't NULL, and in `trigger` if the
+ * software triggers are sent to this digitizer. */
+int read_events(int handle, char *buffer, uint32_t *BufferSize, uint32_t *NumEvents, Trigger_t *trigger, Telemetry_t *telemetry)
+{
+    CAEN_DGTZ_ErrorCode ret;
+    double t0, latency;
+
+    trigger_lock(trigger);
+    t0 = telemetry_get_time();
+
+    ret = CAEN_DGTZ_ReadData(handle, CAEN_DGTZ_SLAVE_TERMINATED_READOUT_MBLT, buffer, BufferSize);
+
+    if (ret) {
+        trigger_unlock(trigger);
+        fprintf(stderr, "error calling CAEN_DGTZ_ReadData()!\n");
+        return 1;
+    }
+
+    *NumEvents = 0;
+    if (*BufferSize != 0) {
+        ret = CAEN_DGTZ_GetNumEvents(handle, buffer, *BufferSize, NumEvents);
+
+        if (ret) {
+            trigger_unlock(trigger);
+            fprintf(stderr, "error calling CAEN_DGTZ_GetNumEvents()!\n");
+            return 1;
+        }
+    }
+
+    if (*NumEvents > 0) {
+        latency = telemetry_get_time() - t0;
+        if (handle == trigger->handle)
+            trigger_readout(trigger, *NumEvents, latency);
+        if (telemetry) {
+            telemetry_add(telemetry, TELEMETRY_READOUT, latency);
+            telemetry_readout(telemetry, *NumEvents, *BufferSize);
+        }
+    }
+    trigger_unlock(trigger);
+
+    return 0;
+}
+
+static void set_error(Builder_t *b)
+{
+    pthread_mutex_lock(&b->lock);
+    b->error = 1;
+    pthread_cond_broadcast(&b->cond);
+    pthread_mutex_unlock(&b->lock);
+}
+
+/* Waits until there's room for another event in the ring buffer of `board`
+ * and returns its slot, or -1 if the builder was stopped. */
+static int wait_for_room(Builder_t *b, Board_t *board)
+{
+    int slot = -1;
+
+    pthread_mutex_lock(&b->lock);
+    while (!b->done && board->count == BUILDER_QUEUE_SIZE)
+        pthread_cond_wait(&b->cond, &b->lock);
+    if (!b->done)
+        slot = (board->head + board->count) % BUILDER_QUEUE_SIZE;
+    pthread_mutex_unlock(&b->lock);
+
+    return slot;
+}
+
+/* Returns the trigger time tag `ttt` as a count since the start of the run.
+ * This assumes that the digitizer gets at least one trigger every time the
+ * counter wraps around, i.e. every 18 seconds. */
+static int64_t unwrap_ttt(Board_t *board, uint32_t ttt)
+{
+    ttt &= (1U << BUILDER_TTT_BITS) - 1;
+
+    if (board->nread > 0 && ttt < board->last_ttt)
+        board->ttt_offset += (int64_t) 1 << BUILDER_TTT_BITS;
+
+    board->last_ttt = ttt;
+
+    return board->ttt_offset + ttt;
+}
+
+/* Decodes event `i` of the readout buffer of `board` into `slot` of its ring
+ * buffer. */
+static int decode_event(Builder_t *b, Board_t *board, uint32_t BufferSize, int i, int slot)
+{
+    CAEN_DGTZ_EventInfo_t EventInfo;
+    char *EventPtr = NULL;
+    CAEN_DGTZ_X742_EVENT_t *event = board->event;
+    int gr, ch;
+
+    if (CAEN_DGTZ_GetEventInfo(board->handle, board->buffer, BufferSize, i, &EventInfo, &EventPtr)) {
+        fprintf(stderr, "error calling CAEN_DGTZ_GetEventInfo()!\n");
+        return 1;
+    }
+
+    if (CAEN_DGTZ_DecodeEvent(board->handle, EventPtr, (void**)&event)) {
+        fprintf(stderr, "error calling CAEN_DGTZ_DecodeEvent()!\n");
+        return 1;
+    }
+
+    board->time[slot] = unwrap_ttt(board, EventInfo.TriggerTimeTag);
+
+    for (gr = 0; gr < BOARD_NCHANNELS/8; gr++) {
+        if (!event->GrPresent[gr]) {
+            if (board->chmask & (0xffUL << gr*8))
+                fprintf(stderr, "Warning: missing data for group %i of digitizer %i\n", gr, (int) (board - b->boards));
+            continue;
+        }
+
+        for (ch = 0; ch < 8; ch++) {
+            int Size = event->DataGroup[gr].ChSize[ch];
+
+            if (Size <= 0 || !(board->chmask & (1UL << (gr*8 + ch))))
+                continue;
+
+            if (Size != b->nsamples) {
+                fprintf(stderr, "got %i samples for channel %i of digitizer %i, but the record length is %i!\n", Size, gr*8 + ch, (int) (board - b->boards), b->nsamples);
+                return 1;
+            }
+
+            memcpy(board->samples + ((long) slot*BOARD_NCHANNELS + gr*8 + ch)*b->nsamples, event->DataGroup[gr].DataChannel[ch], Size*sizeof(float));
+            board->start_cell[slot][gr*8 + ch] = event->DataGroup[gr].StartIndexCell;
+        }
+    }
+
+    return 0;
+}
+
+static void *board_thread(void *arg)
+{
+    Board_t *board = arg;
+    Builder_t *b = board->builder;
+    uint32_t BufferSize, NumEvents;
+    double t0;
+    int i, slot;
+
+    while (wait_for_room(b, board) >= 0) {
+        if (read_events(board->handle, board->buffer, &BufferSize, &NumEvents, b->trigger, &board->telemetry)) {
+            set_error(b);
+            break;
+        }
+
+        if (NumEvents == 0) {
+            usleep(1000);
+            continue;
+        }
+
+        /* If the builder is stopped, the rest of the events are dropped,
+         * since the run already has enough of them. */
+        t0 = telemetry_get_time();
+        for (i = 0; i < NumEvents; i++) {
+            if ((slot = wait_for_room(b, board)) < 0)
+                break;
+
+            if (decode_event(b, board, BufferSize, i, slot)) {
+                set_error(b);
+                return NULL;
+            }
+
+            pthread_mutex_lock(&b->lock);
+            board->count += 1;
+            board->nread += 1;
+            pthread_cond_broadcast(&b->cond);
+            pthread_mutex_unlock(&b->lock);
+        }
+        telemetry_add(&board->telemetry, TELEMETRY_DECODE, telemetry_get_time() - t0);
+    }
+
+    return NULL;
+}
+
+/* Starts reading out the `nboards` digitizers in `handles`, with the readout
+ * buffers and events allocated for each of them, and putting together the
+ * events whose trigger times are within `window` ns of each other. Only the
+ * channels in `chmask` are kept, where the channels of digitizer `i` start at
+ * bit `i*BOARD_NCHANNELS`. The acquisition should already be started. */
+int builder_start(Builder_t *b, int *handles, char **buffers, CAEN_DGTZ_X742_EVENT_t **events, int nboards, unsigned long chmask, int nsamples, double window, Trigger_t *trigger)
+{
+    pthread_condattr_t attr;
+    Board_t *board;
+    int i;
+
+    if (nboards < 1 || nboards > BUILDER_MAX_BOARDS) {
+        fprintf(stderr, "can only read out up to %i digitizers.\n", BUILDER_MAX_BOARDS);
+        return 1;
+    }
+
+    memset(b, 0, sizeof(Builder_t));
+    b->nboards = nboards;
+    b->nsamples = nsamples;
+    b->window = (int64_t) (window/BUILDER_TTT_UNIT);
+    b->trigger = trigger;
+
+    pthread_mutex_init(&b->lock, NULL);
+    pthread_condattr_init(&attr);
+    pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+    pthread_cond_init(&b->cond, &attr);
+    pthread_condattr_destroy(&attr);
+
+    for (i = 0; i < nboards; i++) {
+        board = &b->boards[i];
+        board->handle = handles[i];
+        board->buffer = buffers[i];
+        board->event = events[i];
+        board->chmask = (chmask >> i*BOARD_NCHANNELS) & ((1UL << BOARD_NCHANNELS) - 1);
+        board->builder = b;
+        telemetry_init(&board->telemetry, 0);
+
+        board->samples = malloc((long) BUILDER_QUEUE_SIZE*BOARD_NCHANNELS*nsamples*sizeof(float));
+
+        if (!board->samples) {
+            fprintf(stderr, "failed to allocate the event buffers of digitizer %i.\n", i);
+            b->nboards = 0;
+            builder_stop(b);
+            return 1;
+        }
+    }
+
+    for (i = 0; i < nboards; i++) {
+        if (pthread_create(&b->boards[i].thread, NULL, board_thread, &b->boards[i])) {
+            fprintf(stderr, "failed to start the readout thread of digitizer %i.\n", i);
+            b->nboards = i;
+            builder_stop(b);
+            return 1;
+        }
+    }
+
+    printf("reading out %i digitizers, %.0f ns time window\n", nboards, window);
+
+    return 0;
+}
+
+/* Waits up to `timeout` seconds until every digitizer has an event with the
+ * same trigger time. Returns 1 if there's an event, 0 if not, and -1 if
+ * there was an error reading out one of the digitizers. */
+int builder_next(Builder_t *b, double timeout)
+{
+    struct timespec ts;
+    double deadline = telemetry_get_time() + timeout;
+    int64_t t, tmin, tmax;
+    int i, first, ready, ret = 0;
+    Board_t *board;
+
+    pthread_mutex_lock(&b->lock);
+    while (!b->error) {
+        ready = 1;
+        for (i = 0; i < b->nboards; i++)
+            if (b->boards[i].count == 0)
+                ready = 0;
+
+        if (!ready) {
+            if (telemetry_get_time() >= deadline)
+                break;
+
+            ts.tv_sec = (time_t) deadline;
+            ts.tv_nsec = (long) ((deadline - ts.tv_sec)*1e9);
+            pthread_cond_timedwait(&b->cond, &b->lock, &ts);
+            continue;
+        }
+
+        first = 0;
+        tmin = tmax = b->boards[0].time[b->boards[0].head];
+        for (i = 1; i < b->nboards; i++) {
+            t = b->boards[i].time[b->boards[i].head];
+            if (t < tmin) {
+                tmin = t;
+                first = i;
+            }
+            if (t > tmax)
+                tmax = t;
+        }
+
+        if (tmax - tmin <= b->window) {
+            ret = 1;
+            break;
+        }
+
+        /* The other digitizers don't have this trigger, so drop it. */
+        board = &b->boards[first];
+        board->head = (board->head + 1) % BUILDER_QUEUE_SIZE;
+        board->count -= 1;
+        board->nunmatched += 1;
+        pthread_cond_broadcast(&b->cond);
+    }
+
+    if (b->error)
+        ret = -1;
+    pthread_mutex_unlock(&b->lock);
+
+    return ret;
+}
+
+/* Removes the current event of every digitizer once it's been copied. */
+void builder_release(Builder_t *b)
+{
+    Board_t *board;
+    int i;
+
+    pthread_mutex_lock(&b->lock);
+    for (i = 0; i < b->nboards; i++) {
+        board = &b->boards[i];
+        board->head = (board->head + 1) % BUILDER_QUEUE_SIZE;
+        board->count -= 1;
+    }
+    b->nbuilt += 1;
+    pthread_cond_broadcast(&b->cond);
+    pthread_mutex_unlock(&b->lock);
+}
+
+/* Returns the number of bytes read out from all of the digitizers so far. */
+long builder_bytes_read(Builder_t *b)
+{
+    long bytes = 0;
+    int i;
+
+    for (i = 0; i < b->nboards; i++)
+        bytes += b->boards[i].telemetry.bytes_read;
+
+    return bytes;
+}
+
+/* Stops the readout threads. The events which weren't put together yet are
+ * dropped. */
+void builder_stop(Builder_t *b)
+{
+    int i;
+
+    pthread_mutex_lock(&b->lock);
+    b->done = 1;
+    pthread_cond_broadcast(&b->cond);
+    pthread_mutex_unlock(&b->lock);
+
+    for (i = 0; i < b->nboards; i++)
+        pthread_join(b->boards[i].thread, NULL);
+
+    for (i = 0; i < BUILDER_MAX_BOARDS; i++) {
+        free(b->boards[i].samples);
+        b->boards[i].samples = NULL;
+    }
+
+    pthread_mutex_destroy(&b->lock);
+    pthread_cond_destroy(&b->cond);
+}
+
+/* Prints the number of events read out from every digitizer and the number
+ * which were dropped without a match. */
+void builder_summary(Builder_t *b)
+{
+    int i;
+
+    printf("built %li events from %i digitizers\n", b->nbuilt, b->nboards);
+    for (i = 0; i < b->nboards; i++)
+        printf("    digitizer %i: %li events read, %li without a match\n", i, b->boards[i].nread, b->boards[i].nunmatched);
+}
@@ -0,0 +1,113 @@
+#ifndef _BUILDER_H_
+#define _BUILDER_H_
+
+#include <stdint.h>
+#include <pthread.h>
+#include <CAENDigitizer.h>
+#include "trigger.h"
+#include "telemetry.h"
+
+/* Maximum number of digitizers read out at once and the number of channels
+ * of each of them. The channels of digitizer `i` are numbered from
+ * `i*BOARD_NCHANNELS` in the output file. */
+#define BUILDER_MAX_BOARDS 4
+#define BOARD_NCHANNELS 16
+
+/* Number of events of every digitizer which are decoded ahead of the event
+ * builder. */
+#define BUILDER_QUEUE_SIZE 256
+
+/* Default maximum difference between the trigger times of the events from
+ * every digitizer which are put together (ns). */
+#define BUILDER_TIME_WINDOW 1000
+
+/* Trigger time tag of the x742: a 31 bit counter in units of 8.5 ns which is
+ * reset when the acquisition starts. */
+#define BUILDER_TTT_UNIT 8.5
+#define BUILDER_TTT_BITS 31
+
+struct Builder;
+
+/* One digitizer read out by its own thread. The decoded events are kept in a
+ * ring buffer of BUILDER_QUEUE_SIZE events starting at `head`, with the
+ * samples of every channel in `chmask` and the trigger time tag unwrapped
+ * into a 64 bit count since the start of the run. */
+typedef struct {
+    int handle;
+    char *buffer;
+    CAEN_DGTZ_X742_EVENT_t *event;
+    unsigned long chmask;
+
+    float *samples;
+    uint16_t start_cell[BUILDER_QUEUE_SIZE][BOARD_NCHANNELS];
+    int64_t time[BUILDER_QUEUE_SIZE];
+    int head;
+    int count;
+
+    uint32_t last_ttt;
+    int64_t ttt_offset;
+
+    pthread_t thread;
+    /* Number of events read out, and the number of those which were dropped
+     * because no other digitizer had an event at the same time. */
+    long nread;
+    long nunmatched;
+    /* Readout and decode stages of this digitizer. */
+    Telemetry_t telemetry;
+
+    struct Builder *builder;
+} Board_t;
+
+/* Puts together the events of several digitizers which share a clock, a
+ * trigger and the start of the acquisition, so the same trigger has the
+ * same trigger time tag on every one of them.
+ *
+ * Every digitizer is read out by its own thread, which decodes the events
+ * into the ring buffer of the digitizer. `builder_next()` waits for the
+ * oldest event of every digitizer, and if their trigger times are within
+ * `window` of each other, they're one event, which is copied out with
+ * `builder_samples()` and removed with `builder_release()`. Otherwise the
+ * earliest one is dropped, since the trigger was lost by one of the other
+ * digitizers (for example because its memory was full). */
+typedef struct Builder {
+    Board_t boards[BUILDER_MAX_BOARDS];
+    int nboards;
+    int nsamples;
+    /* Time window in units of the trigger time tag. */
+    int64_t window;
+
+    int done;
+    int error;
+    pthread_mutex_t lock;
+    /* Signaled whenever an event is added to or removed from a ring
+     * buffer. */
+    pthread_cond_t cond;
+
+    Trigger_t *trigger;
+    long nbuilt;
+} Builder_t;
+
+int read_events(int handle, char *buffer, uint32_t *BufferSize, uint32_t *NumEvents, Trigger_t *trigger, Telemetry_t *telemetry);
+int builder_start(Builder_t *b, int *handles, char **buffers, CAEN_DGTZ_X742_EVENT_t **events, int nboards, unsigned long chmask, int nsamples, double window, Trigger_t *trigger);
+int builder_next(Builder_t *b, double timeout);
+void builder_release(Builder_t *b);
+long builder_bytes_read(Builder_t *b);
+void builder_stop(Builder_t *b);
+void builder_summary(Builder_t *b);
+
+/* Returns the samples of board channel `ch` of the current event of board
+ * `i`. */
+static inline float *builder_samples(Builder_t *b, int i, int ch)
+{
+    Board_t *board = &b->boards[i];
+    return board->samples + ((long) board->head*BOARD_NCHANNELS + ch)*b->nsamples;
+}
+
+/* Returns the first DRS4 cell of board channel `ch` of the current event of
+ * board `i`. */
+static inline uint16_t builder_start_cell(Builder_t *b, int i, int ch)
+{
+    return b->boards[i].start_cell[b->boards[i].head][ch];
+}
+
+#endif
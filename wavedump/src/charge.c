@@ -0,0 +1,161 @@
+/* Online integration of the waveforms for `wavedump --charge-only`.
+ *
+ * The times of the samples, the integration window and the integral are
+ * computed in the same way as in `convert_data()`, `get_spe_window()` and
+ * `integrate()` in `analyze-waveforms`: the samples are converted to volts,
+ * the median of the first CHARGE_BASELINE_TIME ns is subtracted, and the
+ * charge (in pC) is the trapezoidal integral over the window divided by 50
+ * ohms. */
+
+#include "charge.h"
+
+/* Returns the DRS4 sampling frequency in MHz for the CAEN setting, or -1 if
+ * it's unknown. */
+int get_drs4_frequency(int DRS4Frequency)
+{
+    switch (DRS4Frequency) {
+    case 0:
+        return 5000;
+    case 1:
+        return 2500;
+    case 2:
+        return 1000;
+    case 3:
+        return 750;
+    }
+
+    return -1;
+}
+
+/* Finds the integration window for waveforms with `nsamples` samples taken
+ * with the settings in `WDcfg`. `start_time` is relative to the trigger and
+ * both times are in ns. Returns 1 if the window doesn't fit in the
+ * waveforms. */
+int charge_window_init(ChargeWindow_t *w, WaveDumpConfig_t *WDcfg, int nsamples, float start_time, float integration_time)
+{
+    double xinc, x0, d, dmin;
+    int i, frequency;
+
+    frequency = get_drs4_frequency(WDcfg->DRS4Frequency);
+
+    if (frequency < 0) {
+        fprintf(stderr, "unknown DRS4 frequency %i\n", WDcfg->DRS4Frequency);
+        return 1;
+    }
+
+    if (nsamples < 2 || nsamples > 1024) {
+        fprintf(stderr, "invalid number of samples %i.\n", nsamples);
+        return 1;
+    }
+
+    w->start_time = start_time;
+    w->integration_time = integration_time;
+    w->nsamples = nsamples;
+
+    /* The times are `np.linspace(0, xinc*points, points)` shifted so that
+     * the trigger is at 0. */
+    xinc = 1e9/(frequency*1e6);
+    w->dt = xinc*nsamples/(nsamples - 1);
+    x0 = -xinc*nsamples*(1 - WDcfg->PostTrigger/100.0);
+
+    w->a = 0;
+    dmin = fabs(x0 - start_time);
+    for (i = 1; i < nsamples; i++) {
+        d = fabs(x0 + i*w->dt - start_time);
+        if (d < dmin) {
+            dmin = d;
+            w->a = i;
+        }
+    }
+
+    if (w->a >= nsamples - 1) {
+        fprintf(stderr, "integration start time exceeds the acquisition window!\n");
+        return 1;
+    }
+
+    w->b = (int) rint(w->a + integration_time/w->dt);
+
+    if (w->b > nsamples - 1) {
+        fprintf(stderr, "integration time is too long!\n");
+        return 1;
+    }
+
+    w->nbaseline = 0;
+    while (w->nbaseline < nsamples && w->nbaseline*w->dt < CHARGE_BASELINE_TIME)
+        w->nbaseline++;
+
+    printf("integrating from %.1f ns to %.1f ns (samples %i to %i)\n", x0 + w->a*w->dt, x0 + (w->b - 1)*w->dt, w->a, w->b - 1);
+
+    return 0;
+}
+
+/* Returns the `k`th smallest value of `v`, partially sorting `v` so that
+ * every value before `k` is less than or equal to it. */
+static float select_kth(float *v, int n, int k)
+{
+    int i, j, l = 0, r = n - 1;
+    float pivot, tmp;
+
+    while (l < r) {
+        pivot = v[(l + r)/2];
+        i = l;
+        j = r;
+        while (i <= j) {
+            while (v[i] < pivot) i++;
+            while (v[j] > pivot) j--;
+            if (i <= j) {
+                tmp = v[i];
+                v[i] = v[j];
+                v[j] = tmp;
+                i++;
+                j--;
+            }
+        }
+        if (k <= j)
+            r = j;
+        else if (k >= i)
+            l = i;
+        else
+            break;
+    }
+
+    return v[k];
+}
+
+/* Returns the median of the first `w->nbaseline` samples, averaging the two
+ * middle samples if there's an even number of them like `np.median()`. */
+static float get_baseline(ChargeWindow_t *w, float *samples)
+{
+    int i, n = w->nbaseline;
+    float hi, lo;
+
+    memcpy(w->scratch, samples, n*sizeof(float));
+    hi = select_kth(w->scratch, n, n/2);
+
+    if (n % 2)
+        return hi;
+
+    lo = w->scratch[0];
+    for (i = 1; i < n/2; i++)
+        if (w->scratch[i] > lo)
+            lo = w->scratch[i];
+
+    return (lo + hi)/2;
+}
+
+/* Returns the charge (pC) of a waveform in ADC counts. */
+float charge_integrate(ChargeWindow_t *w, float *samples)
+{
+    double sum = 0;
+    float baseline;
+    int i;
+
+    baseline = get_baseline(w, samples);
+
+    for (i = w->a; i < w->b - 1; i++)
+        sum += (samples[i] - baseline) + (samples[i+1] - baseline);
+
+    /* Convert from ADC counts to volts and divide by 50 ohms. The times are
+     * in ns, so the charge is in nC, and we multiply by 1000 to get pC. */
+    return -sum*w->dt/2/(1 << 12)*1000/50.0;
+}
@@ -0,0 +1,41 @@
+#ifndef _CHARGE_H_
+#define _CHARGE_H_
+
+#include "wavedump.h"
+
+/* Length of the start of the waveforms used for the baseline (ns). This is
+ * the same as the sodium baseline in `analyze-waveforms`. */
+#define CHARGE_BASELINE_TIME 100
+
+/* Default integration window of `--charge-only` (ns). The start time is
+ * relative to the trigger, so this integrates from 50 ns before to 125 ns
+ * after the trigger, like the window `analyze-waveforms` finds around the
+ * sodium pulses. */
+#define CHARGE_START_TIME -50
+#define CHARGE_INTEGRATION_TIME 175
+
+/* Integration window for the charges computed online with `--charge-only`.
+ *
+ * The window is found in the same way as `get_spe_window()` in
+ * `analyze-waveforms` and the charges are the same as those it finds by
+ * integrating the waveforms, so that histograms of the online charges can be
+ * fit in the same way. */
+typedef struct {
+    float start_time;
+    float integration_time;
+    /* Time between samples (ns). */
+    double dt;
+    int nsamples;
+    /* First and last (exclusive) sample of the integral. */
+    int a;
+    int b;
+    /* Number of samples used for the baseline. */
+    int nbaseline;
+    float scratch[1024];
+} ChargeWindow_t;
+
+int get_drs4_frequency(int DRS4Frequency);
+int charge_window_init(ChargeWindow_t *w, WaveDumpConfig_t *WDcfg, int nsamples, float start_time, float integration_time);
+float charge_integrate(ChargeWindow_t *w, float *samples);
+
+#endif
@@ -0,0 +1,218 @@
+"""
+Sidecar cache of the per-channel results of `analyze-waveforms`.
+
+Integrating the raw waveforms is by far the slowest part of the analysis, but
+it only depends on the input file and on a handful of the command line
+arguments. The results of `analyze_channel` are stored in an hdf5 file next to
+the input file (`<input>.cache.hdf5` by default) so that changing a fit or
+plotting option doesn't require another pass over the waveforms.
+
+Every entry is a group in the cache file whose name is the hash of its key.
+The key is made from the identity of the input file (size, modification time
+and a hash of its first and last MiB), the group and channel, the analysis
+arguments the results depend on and the version of the analysis code (the git
+SHA and a hash of the source files). The key is also stored in the attributes
+of the entry so that entries can be invalidated or pruned.
+
+The charges, and the rise and fall times of the sodium pulses, are fields of
+the feature table, so they're only stored once as part of it and the other
+views are made again when the entry is loaded.
+"""
+
+from __future__ import print_function, division
+import h5py
+import numpy as np
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Number of bytes at the start and end of the input file which are hashed to
+# identify it
+IDENTITY_BYTES = 2**20
+
+# Results which are views of a field of the feature table, and the field
+FEATURE_VIEWS = {'charge': 'charge', 'sodium_rise_time': 'rise_time', 'sodium_fall_time': 'fall_time'}
+
+# Source files whose contents change the results of `analyze_channel`
+SOURCES = ('analyze-waveforms', 'baseline_funcs.py', 'pulse_features.py', 'charge_cache.py', 'drs4_correction.py')
+
+def get_cache_filename(filename):
+    """
+    Returns the default cache filename for the input file `filename`.
+    """
+    return filename + '.cache.hdf5'
+
+def get_file_identity(filename):
+    """
+    Returns a string which identifies the contents of the file `filename`
+    without reading the whole file.
+    """
+    st = os.stat(filename)
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        sha.update(f.read(IDENTITY_BYTES))
+        if st.st_size > IDENTITY_BYTES:
+            f.seek(max(IDENTITY_BYTES, st.st_size - IDENTITY_BYTES))
+            sha.update(f.read(IDENTITY_BYTES))
+    return f'{st.st_size}-{st.st_mtime_ns}-{sha.hexdigest()}'
+
+def get_code_version():
+    """
+    Returns the git SHA of the analysis code followed by a hash of the source
+    files. The hash makes sure that uncommitted changes (or an installed copy
+    of the scripts that isn't in a git repository) also invalidate the cache.
+    """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        git_sha1 = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=src_dir, stderr=subprocess.DEVNULL).decode('UTF-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_sha1 = 'unknown'
+    sha = hashlib.sha1()
+    for name in SOURCES:
+        path = os.path.join(src_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+    return f'{git_sha1}-{sha.hexdigest()[:12]}'
+
+def get_key(identity, code_version, group, channel, args):
+    """
+    Returns the cache key of the results of `analyze_channel` for `channel`
+    in `group`. The sodium results don't depend on the SPE integration
+    arguments, so they aren't part of the key for sodium data. `--chunks` is
+    part of the key since the sodium integration window and the SPE baseline
+    are found per chunk, and `--stream` since it stores the charges as
+    float32 and only keeps a sample of the waveforms. Tables given with
+    `--drs4-tables` are part of the key by their hash.
+    """
+    key = {'identity': identity,
+           'code_version': code_version,
+           'group': group,
+           'channel': channel,
+           'chunks': args.chunks,
+           'float32': args.float32,
+           'stream': args.stream,
+           'drs4_correction': args.drs4_correction}
+    if args.drs4_tables is not None:
+        sha = hashlib.sha1()
+        for name in sorted(args.drs4_tables):
+            sha.update(np.ascontiguousarray(args.drs4_tables[name]).tobytes())
+        key['drs4_tables'] = sha.hexdigest()
+    if group == 'spe':
+        key['start_time'] = args.start_time
+        key['integration_time'] = args.integration_time
+        key['integration_method'] = args.integration_method
+    return key
+
+def get_entry_name(key):
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('UTF-8')).hexdigest()
+
+def open_cache(cache_filename, mode):
+    """
+    Opens the cache file. Returns None and prints a warning if it can't be
+    opened, for example if the input file is on a read-only file system or
+    the cache is being written by another process, since the cache is only
+    an optimization.
+    """
+    if mode == 'r' and not os.path.exists(cache_filename):
+        return None
+    try:
+        return h5py.File(cache_filename, mode)
+    except OSError as e:
+        print(f"Warning: unable to open cache file {cache_filename}: {e}", file=sys.stderr)
+        return None
+
+def load(cache_filename, key):
+    """
+    Returns the cached results for `key`, or None if they aren't in the
+    cache.
+    """
+    f = open_cache(cache_filename, 'r')
+    if f is None:
+        return None
+    with f:
+        name = get_entry_name(key)
+        if name not in f:
+            return None
+        entry = f[name]
+        result = {k: v for k, v in entry.attrs.items() if not k.startswith('key_')}
+        for k in entry:
+            result[k] = entry[k][()]
+        for k in result.pop('none_keys', []):
+            result[k] = None
+        for k in result.pop('feature_views', []):
+            result[k] = result['features'][FEATURE_VIEWS[k]]
+        return result
+
+def save(cache_filename, key, result):
+    """
+    Stores `result` (the dictionary returned by `analyze_channel`) in the
+    cache under `key`. Arrays are stored as datasets and everything else as
+    attributes, except for the views of the feature table in FEATURE_VIEWS,
+    which aren't stored again. With `--charge-only`, the charges aren't the
+    ones in the feature table, so they're stored separately.
+    """
+    f = open_cache(cache_filename, 'a')
+    if f is None:
+        return
+    with f:
+        name = get_entry_name(key)
+        if name in f:
+            del f[name]
+        entry = f.create_group(name)
+        for k, v in key.items():
+            entry.attrs[f'key_{k}'] = v
+        entry.attrs['key_created'] = time.time()
+        none_keys = []
+        feature_views = []
+        features = result.get('features')
+        for k, v in result.items():
+            if k in FEATURE_VIEWS and features is not None and np.may_share_memory(v, features):
+                feature_views.append(k)
+            elif v is None:
+                none_keys.append(k)
+            elif isinstance(v, np.ndarray) and v.ndim > 0:
+                entry.create_dataset(k, data=v, compression='gzip', compression_opts=1)
+            else:
+                entry.attrs[k] = v
+        entry.attrs['none_keys'] = none_keys
+        entry.attrs['feature_views'] = feature_views
+
+def invalidate(cache_filename, identity):
+    """
+    Removes every entry for the input file with identity `identity` from the
+    cache.
+    """
+    f = open_cache(cache_filename, 'r+') if os.path.exists(cache_filename) else None
+    if f is None:
+        return 0
+    with f:
+        names = [name for name in f if f[name].attrs['key_identity'] == identity]
+        for name in names:
+            del f[name]
+    return len(names)
+
+def prune(cache_filename, identity, code_version):
+    """
+    Removes every entry which wasn't made from the input file with identity
+    `identity` by the analysis code `code_version`. Since hdf5 doesn't reclaim
+    the space used by deleted objects, the remaining entries are copied to a
+    new file which replaces the old one.
+    """
+    f = open_cache(cache_filename, 'r') if os.path.exists(cache_filename) else None
+    if f is None:
+        return 0
+    tmp_filename = cache_filename + '.tmp'
+    removed = 0
+    with f, h5py.File(tmp_filename, 'w') as new_f:
+        for name in f:
+            attrs = f[name].attrs
+            if attrs['key_identity'] == identity and attrs['key_code_version'] == code_version:
+                f.copy(f[name], new_f, name=name)
+            else:
+                removed += 1
+    os.replace(tmp_filename, cache_filename)
+    return removed
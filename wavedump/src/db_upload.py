@@ -0,0 +1,240 @@
+"""
+Uploads the results of `analyze-waveforms --upload` to the btl_qa database.
+
+A run and all of its channels are uploaded in a single transaction, so a
+crash or a lost connection never leaves a run without its channels. The
+channels are sent with a single COPY, with the histograms and the average
+pulse written as postgres array literals instead of one parameter for every
+element.
+
+psycopg2 is only imported once we connect to the database, so the rest of
+this module can be used (and tested) without it.
+
+If the database can't be reached, the results are written to a spool
+directory instead and uploaded later with `analyze-waveforms --flush-spool`.
+Every run is uploaded with an id which only depends on the contents of its
+input file (see `get_upload_id`), which is unique in the runs table, so
+uploading the same file twice, for example if the connection was lost right
+after the commit or the file was copied to another computer, doesn't add a
+second run.
+"""
+
+from __future__ import print_function, division
+import numpy as np
+import h5py
+import hashlib
+import json
+import io
+import os
+import sys
+
+# Datasets up to this size (in bytes) are included in the upload id
+UPLOAD_ID_MAX_DATASET_SIZE = 2**20
+
+# Columns of the data table uploaded for every channel, besides the run.
+DATA_COLUMNS = ['channel', 'barcode', 'sodium_peak', 'spe', 'sodium_rise_time', 'sodium_fall_time', 'sodium_charge_histogram_x', 'sodium_charge_histogram_y', 'spe_charge_histogram_x', 'spe_charge_histogram_y', 'avg_pulse_x', 'avg_pulse_y']
+
+def get_spool_dir():
+    """
+    Returns the default spool directory, which can be set with the
+    BTL_SPOOL_DIR environment variable.
+    """
+    return os.environ.get('BTL_SPOOL_DIR', os.path.expanduser('~/.btl_qa_spool'))
+
+def get_hash_bytes(value):
+    """
+    Returns the bytes of an attribute or a dataset which are hashed for the
+    upload id.
+    """
+    if isinstance(value, str):
+        return value.encode('UTF-8')
+    if isinstance(value, bytes):
+        return value
+    value = np.asarray(value)
+    if value.dtype.kind == 'O':
+        return repr(value.tolist()).encode('UTF-8')
+    return np.ascontiguousarray(value).tobytes()
+
+def get_upload_id(f):
+    """
+    Returns the upload id of the open hdf5 file `f`: a SHA256 of the
+    attributes of every group and dataset, the name, shape and type of every
+    dataset, and the contents of the small ones (up to
+    UPLOAD_ID_MAX_DATASET_SIZE bytes), like the baselines measured at the
+    start of every run and the telemetry. The baselines are noise and the
+    telemetry has the timing of the run, so no two runs have the same id, but
+    unlike `charge_cache.get_file_identity`, it doesn't depend on the
+    modification time, so the same run copied, rsynced, or touched gets the
+    same id. The waveforms themselves aren't read, so this only reads a few
+    MB even for multi-GB files.
+    """
+    sha = hashlib.sha256()
+
+    def update(name, obj):
+        sha.update(name.encode('UTF-8'))
+        for key in sorted(obj.attrs):
+            sha.update(key.encode('UTF-8'))
+            sha.update(get_hash_bytes(obj.attrs[key]))
+        if isinstance(obj, h5py.Dataset):
+            sha.update(repr((obj.shape, obj.dtype.str)).encode('UTF-8'))
+            if obj.size*obj.dtype.itemsize <= UPLOAD_ID_MAX_DATASET_SIZE:
+                sha.update(get_hash_bytes(obj[()]))
+
+    update('/', f)
+    f.visititems(update)
+
+    return sha.hexdigest()
+
+def get_connection_errors():
+    """
+    Returns the exceptions raised when the database can't be reached.
+    """
+    import psycopg2
+    return (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+def connect():
+    import psycopg2
+    return psycopg2.connect(dbname='btl_qa',
+                            user='btl',
+                            host=os.environ['BTL_DB_HOST'],
+                            password=os.environ['BTL_DB_PASS'],
+                            connect_timeout=10)
+
+def format_float(value):
+    value = float(value)
+    if np.isnan(value):
+        return 'NaN'
+    if np.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return repr(value)
+
+def copy_value(value):
+    """
+    Returns `value` as a field of the text format of COPY.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return '{' + ','.join(map(format_float, value)) + '}'
+    if isinstance(value, (float, np.floating)):
+        return format_float(value)
+    return str(value)
+
+def upload(conn, run, channels):
+    """
+    Uploads the run `run` (a dictionary with the columns of the runs table
+    and the upload id) and its channels `channels` (a list of dictionaries
+    with the columns in DATA_COLUMNS) in a single transaction. Returns a tuple
+    (run number, whether it was uploaded now or already in the database).
+    """
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO runs (voltage, institution, git_sha1, git_dirty, filename, upload_id) VALUES (%(voltage)s, %(institution)s::inst, %(git_sha1)s, %(git_dirty)s, %(filename)s, %(upload_id)s) ON CONFLICT (upload_id) DO NOTHING RETURNING run", run)
+            result = cursor.fetchone()
+
+            if result is None:
+                cursor.execute("SELECT run FROM runs WHERE upload_id = %s", (run['upload_id'],))
+                return cursor.fetchone()[0], False
+
+            buf = io.StringIO()
+            for channel in channels:
+                buf.write('\t'.join(copy_value(channel[column]) for column in DATA_COLUMNS))
+                buf.write('\t%i\n' % result[0])
+            buf.seek(0)
+
+            cursor.copy_expert("COPY data (%s, run) FROM STDIN" % ', '.join(DATA_COLUMNS), buf)
+
+    return result[0], True
+
+def get_spool_filename(spool_dir, run):
+    return os.path.join(spool_dir, hashlib.sha1(run['upload_id'].encode('UTF-8')).hexdigest() + '.json')
+
+def spool(spool_dir, run, channels):
+    """
+    Writes the run and its channels to the spool directory. Returns the name
+    of the spool file.
+    """
+    def to_json(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    os.makedirs(spool_dir, exist_ok=True)
+
+    filename = get_spool_filename(spool_dir, run)
+    channels = [{column: to_json(channel[column]) for column in DATA_COLUMNS} for channel in channels]
+
+    # Write it to a temporary file first so that `--flush-spool` never sees
+    # half of a file.
+    with open(filename + '.tmp', 'w') as f:
+        json.dump({'run': run, 'channels': channels}, f)
+    os.replace(filename + '.tmp', filename)
+
+    return filename
+
+def upload_or_spool(spool_dir, run, channels):
+    """
+    Uploads the run and its channels, or writes them to the spool directory
+    if the database can't be reached.
+    """
+    try:
+        conn = connect()
+        try:
+            number, uploaded = upload(conn, run, channels)
+        finally:
+            conn.close()
+    except get_connection_errors() as e:
+        print(f"Failed to upload the results: {str(e).strip()}", file=sys.stderr)
+        filename = spool(spool_dir, run, channels)
+        print(f"Saved the results to {filename}. Upload them later with `analyze-waveforms --flush-spool`.", file=sys.stderr)
+        return
+
+    if uploaded:
+        print(f"Uploaded {len(channels)} channels as run {number}")
+    else:
+        print(f"{run['filename']} was already uploaded as run {number}")
+
+def flush_spool(spool_dir):
+    """
+    Uploads every run in the spool directory, and removes them from the
+    spool once they're in the database. Returns 0 if every run was uploaded,
+    or 1 if the database couldn't be reached.
+    """
+    if not os.path.isdir(spool_dir):
+        filenames = []
+    else:
+        filenames = sorted(os.path.join(spool_dir, name) for name in os.listdir(spool_dir) if name.endswith('.json'))
+
+    if len(filenames) == 0:
+        print(f"No results to upload in {spool_dir}")
+        return 0
+
+    try:
+        conn = connect()
+    except get_connection_errors() as e:
+        print(f"Failed to connect to the database: {str(e).strip()}", file=sys.stderr)
+        return 1
+
+    try:
+        for filename in filenames:
+            with open(filename) as f:
+                spooled = json.load(f)
+
+            try:
+                number, uploaded = upload(conn, spooled['run'], spooled['channels'])
+            except get_connection_errors() as e:
+                print(f"Failed to upload {filename}: {str(e).strip()}", file=sys.stderr)
+                return 1
+
+            if uploaded:
+                print(f"Uploaded {spooled['run']['filename']} as run {number}")
+            else:
+                print(f"{spooled['run']['filename']} was already uploaded as run {number}")
+
+            os.remove(filename)
+    finally:
+        conn.close()
+
+    return 0
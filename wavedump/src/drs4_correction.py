@@ -0,0 +1,334 @@
+"""
+Offline DRS4 corrections of the raw samples written by `wavedump --raw`.
+
+The DT5742 normally corrects every event for the offsets of the DRS4 cells,
+for the offsets which depend on the sample number, and for the unequal
+spacing of the cells in time before it's read out. With `--raw` these
+corrections are turned off and the correction tables and the start cell of
+every waveform are stored in the file instead, so that the samples can be
+corrected here a whole chunk of events at a time (and corrected again later
+with better tables).
+
+`correct` does the same thing as `ApplyDataCorrection` in
+`X742CorrectionRoutines.c` with the same single precision arithmetic, so
+the results agree with the C routine to the last bit.
+"""
+
+from __future__ import print_function, division
+import numpy as np
+import os
+import sys
+
+# Bits of the correction level mask (`CORRECTION_LEVEL` in the wavedump
+# config file)
+CELL = 0x1
+NSAMPLE = 0x2
+TIME = 0x4
+ALL = CELL | NSAMPLE | TIME
+
+# Number of cells of the DRS4 chip
+NCELLS = 1024
+
+# Minimum size of a spike (ADC counts) removed by the cell correction
+SPIKE_THRESHOLD = 30
+
+# Cache of `interpolation_table`
+interpolation_tables = {}
+
+def read_tables(group):
+    """
+    Returns the correction tables stored in the `drs4_tables` group of the
+    hdf5 group `group` as a dictionary of arrays: `cell` and `nsample`
+    (group, channel, cell) and `time` (group, cell).
+    """
+    tables = group['drs4_tables']
+    return {name: tables[name][:] for name in ('cell', 'nsample', 'time')}
+
+def read_table_values(filename, nvalues, dtype):
+    """
+    Reads the `nvalues` values after every "Calibration values" line of a
+    table written by `SaveCorrectionTables` in `X742CorrectionRoutines.c`.
+    Every other line has 8 values followed by the cells they're for.
+    """
+    values = []
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('Calibration'):
+                values.append([])
+            elif values and len(values[-1]) < nvalues and line.strip():
+                values[-1].extend(line.split('\t')[:8])
+    return np.array(values, dtype=dtype)
+
+def load_tables(prefix):
+    """
+    Loads the correction tables saved with `SaveCorrectionTables`, i.e. the
+    files `<prefix>_grN_cell.txt`, `<prefix>_grN_nsample.txt` and
+    `<prefix>_grN_time.txt` of every group of channels. Returns the tables in
+    the same format as `read_tables`.
+    """
+    tables = {'cell': [], 'nsample': [], 'time': []}
+    gr = 0
+    while os.path.exists(f'{prefix}_gr{gr}_cell.txt'):
+        tables['cell'].append(read_table_values(f'{prefix}_gr{gr}_cell.txt', NCELLS, np.int16))
+        tables['nsample'].append(read_table_values(f'{prefix}_gr{gr}_nsample.txt', NCELLS, np.int8))
+        tables['time'].append(read_table_values(f'{prefix}_gr{gr}_time.txt', NCELLS, np.float32)[0])
+        gr += 1
+
+    if gr == 0:
+        print(f"couldn't find the correction tables {prefix}_gr0_cell.txt! Quitting...", file=sys.stderr)
+        sys.exit(1)
+
+    return {name: np.array(value) for name, value in tables.items()}
+
+def sampling_period(frequency):
+    """
+    Returns the sampling period (ns) for the DRS4 frequency `frequency` in
+    MHz, rounded to single precision like in `ApplyDataCorrection`.
+    """
+    return np.float32((1.0/frequency)*1000.0)
+
+def find_spikes(y, i):
+    """
+    Returns whether there's a spike at sample `i` of every waveform in `y`
+    (channel, event, sample). This is the test in `PeakCorrection` for a
+    single channel.
+    """
+    n = y.shape[-1]
+    if i == 1:
+        return (y[...,2] - y[...,1] > SPIKE_THRESHOLD) | ((y[...,3] - y[...,1] > SPIKE_THRESHOLD) & (y[...,3] - y[...,2] > SPIKE_THRESHOLD))
+    if i == n - 1:
+        return y[...,n-2] - y[...,n-1] > SPIKE_THRESHOLD
+    spike = y[...,i+1] - y[...,i] > SPIKE_THRESHOLD
+    if i < n - 2:
+        spike |= y[...,i+2] - y[...,i] > SPIKE_THRESHOLD
+    else:
+        spike[:] = True
+    return (y[...,i-1] - y[...,i] > SPIKE_THRESHOLD) & spike
+
+def find_common_spikes(y):
+    """
+    Returns whether there's a spike at the same sample in every channel of
+    `y` (channel, event, sample) for every event and sample, i.e.
+    `find_spikes` for all of the samples at once. Except at the edges, a
+    spike always starts with a drop of more than SPIKE_THRESHOLD, which is
+    rare, so the rest of the test is only done where every channel drops.
+    """
+    n = y.shape[-1]
+    spikes = np.zeros(y.shape[1:], dtype=bool)
+    spikes[:,1] = find_spikes(y, 1).all(axis=0)
+    spikes[:,n-1] = find_spikes(y, n - 1).all(axis=0)
+
+    drop = np.logical_and.reduce(y[...,1:n-2] - y[...,2:n-1] > SPIKE_THRESHOLD, axis=0)
+    events, i = np.nonzero(drop)
+    i += 2
+    rise = (y[:,events,i+1] - y[:,events,i] > SPIKE_THRESHOLD) | (i == n - 2)
+    rise |= y[:,events,np.minimum(i+2,n-1)] - y[:,events,i] > SPIKE_THRESHOLD
+    spikes[events,i] = rise.all(axis=0)
+    return spikes
+
+def remove_spikes(y, i):
+    """
+    Replaces the spike at sample `i` of the waveforms in `y` (channel, event,
+    sample) by the neighbouring samples like `PeakCorrection`.
+    """
+    n = y.shape[-1]
+    if i == 1:
+        two = y[...,2] - y[...,1] > SPIKE_THRESHOLD
+        value = np.where(two, y[...,2], y[...,3])
+        y[...,0] = value
+        y[...,1] = value
+        y[...,2] = np.where(two, y[...,2], value)
+    elif i == n - 1:
+        y[...,n-1] = y[...,n-2]
+    else:
+        one = y[...,i+1] - y[...,i] > SPIKE_THRESHOLD
+        if i == n - 2:
+            y[...,n-2] = np.where(one, (y[...,n-1] + y[...,n-3])/2, y[...,n-3])
+            y[...,n-1] = np.where(one, y[...,n-1], y[...,n-3])
+        else:
+            value = (y[...,i+2] + y[...,i-1])/2
+            y[...,i+1] = np.where(one, y[...,i+1], value)
+            y[...,i] = np.where(one, (y[...,i+1] + y[...,i-1])/2, value)
+
+def peak_correction(y):
+    """
+    Removes the spikes which appear in every channel of a DRS4 chip at the
+    same time from the waveforms in `y` (channel, event, sample). This is
+    `PeakCorrection` in `X742CorrectionRoutines.c`, which loops over the
+    samples since every spike which is removed changes the test for the next
+    few samples. Most events don't have any spikes though, and the samples of
+    an event only change once a spike has been found, so only the events
+    with a spike in the uncorrected samples are looped over.
+    """
+    y[...,0] = y[...,1]
+
+    spikes = find_common_spikes(y)
+    events = np.flatnonzero(spikes.any(axis=-1))
+    if len(events) == 0:
+        return
+
+    z = y[:,events]
+    for i in range(spikes[events].argmax(axis=-1).min(), y.shape[-1]):
+        spike = find_spikes(z, i).all(axis=0)
+        if spike.any():
+            w = z[:,spike]
+            remove_spikes(w, i)
+            z[:,spike] = w
+    y[:,events] = z
+
+def cell_times(time, start_cells, tsample):
+    """
+    Returns the times of the samples (ns) of waveforms which start at the
+    cells `start_cells`, starting from 0 for the first sample, where `time`
+    is the time table of the DRS4 chip. The time of every cell is the time
+    of the previous cell plus the difference in their times in the table, or
+    plus the length of the whole chip when the table wraps around.
+    """
+    # The cells are along the first axis here so that every step of the
+    # loop below works on contiguous rows.
+    cells = (np.arange(NCELLS)[:,np.newaxis] + start_cells) % NCELLS
+    dt = np.diff(time[cells], axis=0)
+    wrap = np.where(dt > 0, np.float32(0), np.float32(tsample*NCELLS))
+    t = np.zeros((NCELLS, len(start_cells)), dtype=np.float32)
+    # This is a loop instead of `np.cumsum` since the length of the chip is
+    # added after the difference, which rounds differently.
+    for j in range(1, NCELLS):
+        np.add(t[j-1], dt[j-1], out=t[j])
+        t[j] += wrap[j-1]
+    return t.T
+
+def interpolation_indices(t, x):
+    """
+    Returns the index of the first sample of every row of `t` after each of
+    the times `x`, or the last sample if there isn't one. The samples are
+    interpolated between this sample and the one before it.
+
+    `ApplyDataCorrection` searches for every sample starting from the one
+    before the previous sample it found, which is the same as a binary
+    search as long as the times are increasing. If the times in the table
+    add up to more than the length of the chip, the times go backwards
+    where the table wraps around, so the search is done in the same way as
+    in the C routine for all of the rows at once.
+    """
+    n = t.shape[-1]
+    k = np.empty((len(t), len(x)), dtype=np.intp)
+
+    if np.all(np.diff(t, axis=-1) > 0):
+        for i in range(len(t)):
+            k[i] = np.searchsorted(t[i], x)
+        np.minimum(k, n - 1, out=k)
+        return k
+
+    rows = np.arange(len(t))
+    j = np.zeros(len(t), dtype=np.intp)
+    for i in range(len(x)):
+        while True:
+            step = (j < n - 1) & (t[rows,j] < x[i])
+            if not step.any():
+                break
+            j += step
+        k[:,i] = j
+        j -= 1
+    return k
+
+def interpolation_table(time, tsample, n):
+    """
+    Returns the indices of the samples to interpolate between, the time
+    between them and the time from the first of them to the evenly spaced
+    times for waveforms with `n` samples starting at every cell of the chip
+    with the time table `time`. These only depend on the table, so they're
+    only computed once for every table.
+    """
+    key = (time.tobytes(), float(tsample), n)
+    if key not in interpolation_tables:
+        t = cell_times(time, np.arange(NCELLS), tsample)
+        x = np.arange(1, n, dtype=np.float32)*tsample
+        k = interpolation_indices(t[:,:n], x)
+        t0 = np.take_along_axis(t, k - 1, axis=-1)
+        t1 = np.take_along_axis(t, k, axis=-1)
+        interpolation_tables[key] = (k, t1 - t0, x - t0)
+    return interpolation_tables[key]
+
+def time_correction(y, start_cells, time, tsample):
+    """
+    Interpolates the waveforms in `y` (channel, event, sample) to evenly
+    spaced times like the time correction of `ApplyDataCorrection`.
+    """
+    n = y.shape[-1]
+    y[...,0] = y[...,1]
+
+    k, dt, dx = interpolation_table(time, tsample, n)
+    k = k[start_cells]
+    y0 = np.take_along_axis(y, k[np.newaxis] - 1, axis=-1)
+    y1 = np.take_along_axis(y, k[np.newaxis], axis=-1)
+    y[...,1:] = y0 + (y1 - y0)/dt[start_cells]*dx[start_cells]
+
+def correct(y, start_cells, cell, nsample, time, tsample, level=ALL):
+    """
+    Corrects the raw samples `y` (channel, event, sample) in ADC counts of
+    the channels of a single DRS4 chip in place. `start_cells` are the start
+    cells of the events, `cell` and `nsample` are the tables of the channels
+    (channel, cell), `time` is the time table of the chip and `tsample` is
+    the sampling period (see `sampling_period`). `level` is a mask of the
+    corrections to apply.
+
+    The spikes are only removed when they appear in every channel of `y`, so
+    the results are only the same as `ApplyDataCorrection` if `y` has all 8
+    channels of the chip.
+    """
+    y = np.asarray(y)
+    start_cells = np.asarray(start_cells, dtype=np.intp)
+    n = y.shape[-1]
+
+    if level & CELL:
+        # The offsets of the cells of every event are a window of the table
+        # repeated twice, so that they can be copied row by row.
+        cell = np.concatenate((cell, cell[:,:n]), axis=-1)
+        y -= np.lib.stride_tricks.sliding_window_view(cell, n, axis=-1)[:,start_cells]
+    if level & NSAMPLE:
+        y -= nsample[:,np.newaxis,:n]
+    if level & CELL:
+        peak_correction(y)
+    if level & TIME:
+        time_correction(y, start_cells, time, tsample)
+
+    return y
+
+def correct_channel(group, channel, start, stop, y, level=ALL, tables=None):
+    """
+    Corrects the raw samples `y` in ADC counts of the events `start` to
+    `stop` of the dataset `channel` of the hdf5 group `group` written by
+    `wavedump --raw` in place. The tables stored in the group are used
+    unless other `tables` are given (see `load_tables`).
+
+    The cell correction needs the other channels of the same DRS4 chip to
+    find the spikes, so they're read and corrected as well unless `level`
+    doesn't include it. Only `channel` is corrected for the times of the
+    cells though.
+    """
+    if tables is None:
+        tables = read_tables(group)
+
+    starting_channel = group.attrs.get('starting_channel', 0)
+    gr, ch = divmod(int(channel[2:]) - starting_channel, 8)
+
+    if level & CELL:
+        channels = [i for i in range(8) if f'ch{gr*8 + i + starting_channel}' in group]
+    else:
+        channels = [ch]
+
+    scale = 1/group.attrs.get('adc_scale', 1)
+    data = np.empty((len(channels),) + y.shape, dtype=y.dtype)
+    for i, c in enumerate(channels):
+        if c == ch:
+            data[i] = y
+        else:
+            data[i] = group[f'ch{gr*8 + c + starting_channel}'][start:stop]
+            data[i] *= scale
+
+    start_cells = group[channel.replace('ch', 'start_cell_ch', 1)][start:stop]
+    tsample = sampling_period(group.attrs['drs4_frequency'])
+    correct(data, start_cells, tables['cell'][gr,channels], tables['nsample'][gr,channels], tables['time'][gr], tsample, level & ~TIME)
+    y[:] = data[channels.index(ch)]
+    if level & TIME:
+        time_correction(y[np.newaxis], start_cells, tables['time'][gr], tsample)
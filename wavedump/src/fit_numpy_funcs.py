@@ -0,0 +1,373 @@
+"""
+ROOT-free versions of `fit_spe_funcs.fit_spe` and `fit_511_funcs.fit_511`.
+
+The histograms are plain numpy arrays of bin contents and bin edges, and the
+fits minimize a binned Poisson likelihood with analytic gradients using
+scipy. This lets the analysis run on machines that don't have ROOT installed.
+"""
+
+from __future__ import print_function, division
+import numpy as np
+from scipy.optimize import minimize
+from scipy.ndimage import gaussian_filter1d
+from scipy.stats import poisson
+from vinogradov import vinogradov_pmf, vinogradov_pmf_grad
+
+# DEFAULT VALUES FOR SPE FIT (see fit_spe_funcs.py):
+D_OFFSET = 0
+D_LAMBDA = 0.5
+D_NOISE_SPREAD = 0.01
+D_SPE_CHARGE_SPREAD = 0
+D_ZERO_PEAK_SPREAD = 0.4
+# Number of peaks we use for SPE fitting
+num_peaks = 20
+
+def get_bin_centers(edges):
+    return (edges[1:] + edges[:-1])/2
+
+def hist_mean_std(counts, edges=None, x=None):
+    """
+    Returns the mean and standard deviation of the histogram, computed from
+    the bin centers `x` (or from the bin edges `edges`).
+    """
+    if x is None:
+        x = get_bin_centers(edges)
+    mean = np.sum(counts*x)/np.sum(counts)
+    std = np.sqrt(np.sum(counts*(x - mean)**2)/np.sum(counts))
+    return mean, std
+
+def find_peaks(counts, edges, width=4, height=0.05):
+    """
+    Finds peaks in the histogram `counts`. This is a replacement for
+    `fit_511_funcs.ROOT_peaks`. The histogram is first smoothed with a gaussian
+    of standard deviation `width` bins, and any local maximum of the smoothed
+    histogram larger than `height` times the highest peak is returned.
+
+    Returns an array of the peak locations, sorted in charge order, lowest to
+    highest `x_pos`, and the location of the highest peak:
+    (`x_pos`, `highest_peak`)
+    """
+    smoothed = gaussian_filter1d(np.asarray(counts, dtype=np.double), width, mode='constant')
+    i = np.flatnonzero((smoothed[1:-1] > smoothed[:-2]) & (smoothed[1:-1] >= smoothed[2:])) + 1
+    if len(i) == 0:
+        return (np.array([]), None)
+    i = i[smoothed[i] >= height*np.max(smoothed[i])]
+    x = get_bin_centers(edges)
+    highest_peak = x[i[np.argmax(smoothed[i])]]
+    return (x[i], highest_peak)
+
+def gaus_model(x, p):
+    """
+    Returns the value and jacobian of a gaussian with amplitude `p[0]`, mean
+    `p[1]` and standard deviation `p[2]` at the points `x`. This is the same
+    as ROOT's "gaus" function.
+    """
+    z = (x - p[1])/p[2]
+    g = np.exp(-0.5*z**2)
+    jac = np.empty((len(x), 3))
+    jac[:,0] = g
+    jac[:,1] = p[0]*g*z/p[2]
+    jac[:,2] = p[0]*g*z**2/p[2]
+    return p[0]*g, jac
+
+def vinogradov_model(x, p):
+    """
+    Returns the value and jacobian of the SPE model at the points `x`. The
+    parameters are the same as `vinogradov_model` in `fit_spe_funcs.py`:
+
+    p[0]: overall scale
+    p[1]: offset
+    p[2]: mean number of SPEs in integration window
+    p[3]: SPE charge
+    p[4]: std. of scope/digitizer noise
+    p[5]: std. of SPE charge
+    p[6]: probability that a primary PE triggers a secondary PE
+    """
+    N = np.arange(num_peaks)
+    w, dw_dl, dw_dps = vinogradov_pmf_grad(num_peaks, p[2], p[6])
+    s = np.maximum(np.sqrt(p[4]**2 + N*p[5]**2), 1e-12)
+    z = (x[:, np.newaxis] - p[1] - N*p[3])/s
+    g = np.exp(-0.5*z**2)
+    wg = w*g
+    jac = np.empty((len(x), 7))
+    jac[:,0] = np.sum(wg, axis=-1)
+    jac[:,1] = p[0]*np.sum(wg*z/s, axis=-1)
+    jac[:,2] = p[0]*np.dot(g, dw_dl)
+    jac[:,3] = p[0]*np.sum(wg*z*N/s, axis=-1)
+    jac[:,4] = p[0]*np.sum(wg*z**2/s*p[4]/s, axis=-1)
+    jac[:,5] = p[0]*np.sum(wg*z**2/s*N*p[5]/s, axis=-1)
+    jac[:,6] = p[0]*np.dot(g, dw_dps)
+    return p[0]*jac[:,0], jac
+
+def fit_binned_likelihood(model, counts, edges, p0, fixed=(), bounds=None, fit_range=None):
+    """
+    Fits `model` to the histogram `counts` by minimizing the binned Poisson
+    likelihood ratio (Baker-Cousins chi2). `model(x, p)` should return the
+    expected number of counts at the bin centers `x` and the jacobian with
+    respect to the parameters `p`.
+
+    Parameters whose index is in `fixed` are held at their value in `p0`.
+    `bounds` is a list of `(min, max)` tuples (or `None`) for each parameter,
+    and `fit_range` is the `(xmin, xmax)` range to fit.
+
+    Returns a tuple `(p, errors, valid)`, where the errors are computed from
+    the expected Fisher information at the minimum.
+    """
+    x = get_bin_centers(edges)
+    counts = np.asarray(counts, dtype=np.double)
+    if fit_range is not None:
+        sel = (x >= fit_range[0]) & (x <= fit_range[1])
+        x = x[sel]
+        counts = counts[sel]
+
+    p0 = np.array(p0, dtype=np.double)
+    free = np.array([i for i in range(len(p0)) if i not in fixed], dtype=int)
+    if bounds is None:
+        bounds = [None]*len(p0)
+    bounds = [bounds[i] if bounds[i] is not None else (None, None) for i in free]
+
+    def nll(q):
+        p = p0.copy()
+        p[free] = q
+        mu, jac = model(x, p)
+        mu = np.maximum(mu, 1e-300)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_term = np.where(counts > 0, counts*np.log(counts/mu), 0)
+        grad = 2*np.dot(1 - counts/mu, jac[:,free])
+        return 2*np.sum(mu - counts + log_term), grad
+
+    res = minimize(nll, p0[free], jac=True, method='L-BFGS-B', bounds=bounds)
+
+    p = p0.copy()
+    p[free] = res.x
+    mu, jac = model(x, p)
+    info = np.dot(jac[:,free].T/np.maximum(mu, 1e-300), jac[:,free])
+    errors = np.zeros(len(p))
+    errors[free] = np.sqrt(np.abs(np.diag(np.linalg.pinv(info))))
+    return p, errors, res.success
+
+def fit_gaus(counts, edges, xmin, xmax, p0=None):
+    """
+    Fits a gaussian to the histogram between `xmin` and `xmax`. If the
+    starting parameters `p0` aren't given they are estimated from the
+    histogram in the fit range, the same way ROOT does for "gaus".
+    """
+    x = get_bin_centers(edges)
+    sel = (x >= xmin) & (x <= xmax)
+    if np.sum(counts[sel]) <= 0:
+        return None
+    if p0 is None:
+        mean, std = hist_mean_std(counts[sel], x=x[sel])
+        p0 = [np.max(counts[sel]), mean, std]
+    p0 = list(p0)
+    if p0[2] <= 0:
+        p0[2] = (edges[1] - edges[0])
+    return fit_binned_likelihood(gaus_model, counts, edges, p0, bounds=[(0, None), None, (1e-12, None)], fit_range=(xmin, xmax))
+
+def fit_zero_peak(counts, edges, offset, win):
+    """
+    Fits the zero peak of the raw charge histogram with a gaussian in a window
+    of +/- `win` around `offset`, moving the window to the fitted mean until it
+    stops moving. The window is clipped to the histogram, since the zero peak
+    is often right at the low edge. The first fit starts from the mean and
+    standard deviation of the histogram in the window, since the width of the
+    zero peak is usually much larger than the noise spread of the filtered
+    data, and starting from that lets the fit walk off to the next peak.
+
+    Returns `(offset, spread, scale)` or None if the zero peak couldn't be
+    found.
+    """
+    means = []
+    p = None
+
+    diff = 1
+    count = 0
+    while diff > 0.001 and count < 5:
+        if offset < edges[0] or offset > edges[-1]:
+            return None
+        r = fit_gaus(counts, edges, max(offset-win, edges[0]), min(offset+win, edges[-1]), p0=p)
+        if r is None:
+            return None
+        p = r[0]
+        diff = np.abs(p[1] - offset)
+        offset = p[1]
+        means.append(offset)
+        count += 1
+
+    if diff > 0.001:
+        offset = np.mean(means)
+        if offset < edges[0] or offset > edges[-1]:
+            return None
+        r = fit_gaus(counts, edges, max(offset-win, edges[0]), min(offset+win, edges[-1]), p0=p)
+        if r is None:
+            return None
+        p = r[0]
+        offset = p[1]
+    return (offset, abs(p[2]), p[0])
+
+def analyze_filter_data(counts, edges, f_counts, f_edges):
+    """
+    The same as `analyze_filter_data` in `fit_spe_funcs.py`, except that the
+    zero peak is looked for at the lowest peak of the raw histogram when it
+    isn't where the filtered data says it is. The baseline subtraction can
+    shift the raw zero peak by more than the window, e.g. it's at about -0.5
+    pC for the waveforms from `generate-waveforms`, while the filtered charges
+    are always centered at zero.
+
+    Returns `(m, f_std, std, scale)` or None if the zero peak couldn't be found.
+    """
+    f_mean, f_std = hist_mean_std(f_counts, f_edges)
+    r = fit_gaus(f_counts, f_edges, f_mean - 2*f_std, f_mean + 2*f_std)
+    if r is None:
+        return None
+    offset = r[0][1]
+    noise_spread = abs(r[0][2])
+
+    win = max(0.3, 15*noise_spread)
+
+    peaks = find_peaks(counts, edges)[0]
+    if len(peaks) and abs(peaks[0] - offset) > win:
+        offset = peaks[0]
+
+    zero_peak = fit_zero_peak(counts, edges, offset, win)
+    if zero_peak is None:
+        print('Filtered data could not find first peak!')
+        return None
+    offset, raw_spread, scale = zero_peak
+    return (offset, noise_spread, raw_spread, scale)
+
+def analyze_raw_data(counts, edges):
+    """
+    Finds the zero peak of the raw charge histogram when there's no filtered
+    data (or the filtered data didn't help). The zero peak is the lowest peak
+    found by `find_peaks`, and it's fit in a window of half the distance to
+    the next peak.
+
+    Returns `(m, f_std, std, scale)` like `analyze_filter_data`, with the
+    default noise spread, or None if there are no peaks.
+    """
+    peaks = find_peaks(counts, edges)[0]
+    if len(peaks) == 0:
+        return None
+    win = (peaks[1] - peaks[0])/2 if len(peaks) > 1 else 0.3
+    zero_peak = fit_zero_peak(counts, edges, peaks[0], win)
+    if zero_peak is None:
+        return None
+    offset, raw_spread, scale = zero_peak
+    return (offset, D_NOISE_SPREAD, raw_spread, scale)
+
+def fit_spe(counts, edges, f_counts=None, f_edges=None):
+    """
+    Fits the SPE charge histogram `counts` with bin edges `edges` using the
+    same two stage strategy as `fit_spe_funcs.fit_spe`: a first fit where the
+    scale, offset, noise and SPE charge spread are held fixed, followed by a
+    fit where most parameters are released within limits.
+
+    The starting values are found a bit more carefully than in the ROOT
+    version, since L-BFGS-B is less forgiving about a bad start:
+
+    - If the zero peak can't be found from the filtered data, it's found from
+      the raw histogram instead of assuming it's at zero (`analyze_raw_data`).
+    - The fixed scale of the first fit is the height of the zero peak divided
+      by the probability of no PEs, not the height of the zero peak.
+    - The SPE charge starts at the distance between the zero peak and the
+      next peak when there is one, and from the mean of the histogram
+      otherwise.
+
+    Returns `(SPE charge, error)`, or None if the fit failed.
+    """
+    counts = np.asarray(counts, dtype=np.double)
+    entries = np.sum(counts)
+    mean, std = hist_mean_std(counts, edges)
+
+    filter_output = None
+    if f_counts is not None:
+        print('Using filtered data!')
+        filter_output = analyze_filter_data(counts, edges, np.asarray(f_counts, dtype=np.double), f_edges)
+    if filter_output is None:
+        filter_output = analyze_raw_data(counts, edges)
+    if filter_output is None:
+        offset = D_OFFSET
+        noise_spread = D_NOISE_SPREAD
+        raw_spread = D_ZERO_PEAK_SPREAD
+        scale = None
+    else:
+        offset, noise_spread, raw_spread, scale = filter_output
+
+    # Probability that an SPE trigger a secondary SPE
+    ps = 0
+
+    zero_peak_end = offset + 2 * raw_spread
+    print(f'zero_peak_end: {zero_peak_end}')
+    x = get_bin_centers(edges)
+    prob_zero = np.sum(counts[x <= zero_peak_end]) / entries
+    if prob_zero <= 0 or prob_zero >= 1:
+        l = D_LAMBDA
+    else:
+        l = -np.log(prob_zero)
+    n = min(20, max(4, int(poisson.ppf(0.95, l))))
+
+    if scale is None:
+        scale = entries*0.075
+    else:
+        scale /= np.exp(-l)
+
+    peaks = find_peaks(counts, edges)[0]
+    peaks = peaks[peaks > zero_peak_end]
+    if len(peaks):
+        SPE_charge = peaks[0] - offset
+    else:
+        pmf = vinogradov_pmf(n, l, ps)
+        SPE_charge = mean
+        SPE_charge -= offset * np.sum(pmf)
+        SPE_charge /= np.sum(pmf * np.arange(n))
+    SPE_charge = min(4, SPE_charge)
+    SPE_charge = max(zero_peak_end - offset, SPE_charge)
+
+    fit_range = (offset - 1.5*raw_spread, offset + 5*std)
+
+    p0 = [scale, offset, l, SPE_charge, raw_spread, D_SPE_CHARGE_SPREAD, ps]
+    bounds = [None, None, (0, n+5), (zero_peak_end - offset, SPE_charge + 1), None, None, None]
+    p, errors, valid = fit_binned_likelihood(vinogradov_model, counts, edges, p0, fixed=(0,1,4,5,6), bounds=bounds, fit_range=fit_range)
+
+    bounds = [(0, None), None,
+              (max(0, p[2] - 1), p[2] + 1),
+              (max(zero_peak_end - offset, p[3] - 1), p[3] + 1),
+              (0, p[4] + 0.1),
+              (0, p[5] + 0.1),
+              (0, 0.25)]
+    p, errors, valid = fit_binned_likelihood(vinogradov_model, counts, edges, p, fixed=(1,), bounds=bounds, fit_range=fit_range)
+    if not valid or not np.isfinite(p[3]) or not errors[3] > 0:
+        print("Fit error!")
+        return None
+
+    return (p[3], errors[3])
+
+def fit_511(counts, edges):
+    """
+    Fits the highest peak of the sodium charge histogram with a gaussian, the
+    same way as `fit_511_funcs.fit_511`.
+
+    Returns `(511 charge, error)` or None if no peak was found or the fit
+    failed. A fit which didn't converge, whose mean is outside of the window,
+    or whose gaussian is narrower than a bin (in which case the errors are
+    meaningless, often exactly zero) is a failed fit.
+    """
+    counts = np.asarray(counts, dtype=np.double)
+    mean, std = hist_mean_std(counts, edges)
+    # With only a few bins in the window the width of the gaussian isn't
+    # constrained and the mean can end up anywhere, so the window is always at
+    # least three bins on either side of the peak.
+    win = max(0.2 * std, 3*(edges[1] - edges[0]))
+    # The highest peak
+    peak = find_peaks(counts, edges, width=2, height=0.05)[1]
+    if peak is None:
+        return None
+    r = fit_gaus(counts, edges, peak-win, peak+win)
+    if r is None:
+        return None
+    p, errors, valid = r
+    if not valid or not peak-win <= p[1] <= peak+win or abs(p[2]) < (edges[1] - edges[0])/2 or not errors[1] > 0:
+        print("Fit error!")
+        return None
+    return (p[1], errors[1])
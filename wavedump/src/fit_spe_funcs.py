@@ -8,6 +8,7 @@ import os
 import ROOT
 from ROOT import gROOT
 from ROOT import TMath
+from vinogradov import fac, B_coeff, vinogradov, vinogradov_coeffs, vinogradov_pmf
 
 # DEFAULT VALUES FOR SPE FIT:
 D_OFFSET = 0
@@ -108,38 +109,6 @@ class poisson_model:
         model *= p[0]
         return model
 
-def fac(x):
-    """
-    Returns x!. We use the gamma function here instead since it works even for
-    non-integer values and is generally faster than calling math.factorial(x).
-    """
-    return np.math.gamma(x+1)
-
-def vinogradov(N, l, ps):
-    """
-    Returns probability of getting `N` PEs in the integration window.  `l` is
-    the mean number of primary PEs.  `ps` is the probability that a primary PE
-    causes a secondary PE.  See this paper for a more detailed explanation:
-    https://arxiv.org/pdf/2106.13168.pdf
-    """
-    model = 0
-    for i in range(N+1):
-        model += B_coeff(i, N) * (l*(1-ps))**i * ps**(N-i)
-    model *= np.exp(-l)
-    model /= fac(N)
-    return model
-
-def B_coeff(i, N):
-    """
-    Helper function for the vinogradov model.
-    """
-    if i == 0 and N == 0:
-        return 1
-    elif i == 0 and N > 0:
-        return 0
-    else:
-        return (fac(N)*fac(N-1)) / (fac(i)*fac(i-1)*fac(N-i))
-
 class vinogradov_model:
     """
     We assume that each photoelectron (PE) peak is gaussian. We add the PE
@@ -162,6 +131,48 @@ class vinogradov_model:
         model *= p[0]
         return model
 
+class fast_vinogradov_model:
+    """
+    The same model as `vinogradov_model`, but evaluated with numpy.
+
+    ROOT still calls the model once per point, but the first call with a new
+    set of parameters evaluates the model at all the bin centers of the
+    histogram `h` at once. Every other call during the same minimizer step
+    just looks up the value for its bin.
+    """
+    def __init__(self, h=None, num_peaks=num_peaks):
+        self.num_peaks = num_peaks
+        self.params = None
+        self.values = None
+        if h is not None:
+            self.x = np.array([h.GetBinCenter(i) for i in range(1, h.GetNbinsX()+1)])
+        else:
+            self.x = None
+
+    def evaluate(self, x, p):
+        """
+        Returns the model evaluated at every point in the array `x`.
+        """
+        x = np.asarray(x, dtype=np.double)
+        i = np.arange(self.num_peaks)
+        sigma = np.sqrt(p[4]**2 + i*(p[5]**2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gaus = np.exp(-0.5*((x[:, np.newaxis] - p[1] - i*p[3])/sigma)**2)
+        # TMath::Gaus() returns 1e30 when sigma is zero
+        gaus[:, sigma == 0] = 1e30
+        return p[0]*np.dot(gaus, vinogradov_pmf(self.num_peaks, p[2], p[6]))
+
+    def __call__(self, x, p):
+        params = tuple(p[i] for i in range(7))
+        if self.x is not None and params != self.params:
+            self.params = params
+            self.values = self.evaluate(self.x, params)
+        if self.values is not None:
+            j = np.searchsorted(self.x, x[0])
+            if j < len(self.x) and self.x[j] == x[0]:
+                return self.values[j]
+        return self.evaluate([x[0]], params)[0]
+
 def plot_dists():
     """
     Plots the poisson and vinogradov distributions, then exits on user input.
@@ -247,8 +258,9 @@ def fit_spe(h, model, f_h=None, root_func=False):
     # SPE Charge estimated using the method from this forum:
     # https://math.stackexchange.com/questions/3689141/calculating-the-mean-and-standard-deviation-of-a-gaussian-mixture-model-of-two-c
     SPE_charge = h.GetMean()
-    SPE_charge -= offset * sum([vinogradov(i, l, ps) for i in range(num_peaks)])
-    SPE_charge /= sum([vinogradov(i, l, ps) * i for i in range(num_peaks)])
+    pmf = vinogradov_pmf(int(num_peaks), l, ps)
+    SPE_charge -= offset * np.sum(pmf)
+    SPE_charge /= np.sum(pmf * np.arange(len(pmf)))
     SPE_charge = min(4, SPE_charge)
     SPE_charge = max(zero_peak_end - offset, SPE_charge)
 
@@ -0,0 +1,169 @@
+"""
+Single pass extraction of per-event pulse features.
+
+`extract_features` computes the amplitude, start time, rise time, fall time
+and charge of every waveform in a chunk, finding the minimum of each waveform
+only once. The features are returned as a numpy structured array which
+`analyze-waveforms` writes out as a compound hdf5 dataset per channel (see
+`--features`) so that cuts and uploads don't need another pass over the raw
+waveforms.
+"""
+
+from __future__ import print_function, division
+import numpy as np
+from baseline_funcs import iqr
+
+# Fractions of the pulse minimum used for the rise and fall times, and for the
+# start time of the pulse (`t0`)
+LOW = 0.1
+HIGH = 0.9
+T0 = 0.4
+
+FEATURES = ('amplitude', 't0', 'rise_time', 'fall_time', 'charge')
+
+def feature_dtype(dtype=np.float64):
+    """
+    Returns the numpy dtype of the feature table.
+    """
+    return np.dtype([(name, dtype) for name in FEATURES])
+
+def integrate(x, data, a, b):
+    """
+    Integrate all waveforms in `data` with times `x`.
+    """
+    # i = v/r
+    # divide by 50 ohms to convert to a charge
+    if np.ndim(data) == 2:
+        return -np.trapz(data[:,a:b],x=x[a:b])*1000/50.0
+    else:
+        return -np.trapz(data[a:b],x=x[a:b])*1000/50.0
+
+def cumulative_integral(x, data):
+    """
+    Returns the cumulative trapezoidal integral of the waveforms in `data`
+    with times `x`, i.e. the integral from `x[0]` to `x[i]` for every sample
+    `i`. The integral over any window can then be found with
+    `integrate_cumulative` without another pass over the waveforms.
+    """
+    c = np.empty(data.shape, dtype=np.float64)
+    c[:,0] = 0
+    np.cumsum((data[:,1:] + data[:,:-1])*(np.diff(x)/2), axis=-1, out=c[:,1:])
+    return c
+
+def integrate_cumulative(x, c, a, b, offset=0):
+    """
+    Returns the same charges as `integrate(x, data - offset, a, b)` from the
+    cumulative integral `c` of `data`.
+    """
+    return -((c[:,b-1] - c[:,a]) - offset*(x[b-1] - x[a]))*1000/50.0
+
+def interpolate_crossing(x, data, amplitude, fraction, il):
+    """
+    Returns the time at which each waveform crosses `fraction*amplitude`,
+    linearly interpolating between the samples `il` and `il+1`. Events where
+    `il` is outside of the waveform (i.e. the pulse is cut off at the start or
+    end of the event) or where the waveform is flat, so there's no crossing to
+    interpolate, return NaN.
+    """
+    nevents, nsamples = data.shape
+    i = np.arange(nevents)
+    bad = (il < 0) | (il >= nsamples - 1)
+    il = np.clip(il, 0, nsamples - 2)
+    ir = il + 1
+    threshold = fraction*amplitude
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = x[il] + (threshold-data[i,il])*(x[ir]-x[il])/(data[i,ir]-data[i,il])
+    t[bad | ~np.isfinite(t)] = np.nan
+    return t
+
+def get_crossings(data, argmin, amplitude, fractions):
+    """
+    Returns a dictionary mapping every fraction in `fractions` to the indices
+    `(il_rising, il_falling)` of the samples on the leading and trailing edge
+    of each waveform in `data`, where the waveform crosses
+    `fraction*amplitude` between the samples `il` and `il+1`. An index of -1
+    means that the waveform never crosses the threshold on that side.
+
+    The waveforms are swept once outwards from the minimum on each side, one
+    sample of every event at a time, checking all of the thresholds at once.
+    Events are dropped from the sweep once they've crossed every threshold,
+    so the sweep only goes as far from the minimum as the widest pulse
+    instead of over the whole waveform.
+    """
+    nevents, nsamples = data.shape
+    crossings = []
+    for step in (-1, 1):
+        il = np.full((nevents, len(fractions)), -1)
+        events = np.arange(nevents)
+        index = argmin.copy()
+        thresholds = np.multiply.outer(amplitude, fractions)
+        found = np.zeros(thresholds.shape, dtype=bool)
+        while True:
+            index += step
+            keep = (index >= 0) & (index < nsamples) & ~np.all(found, axis=-1)
+            if not np.all(keep):
+                events, index, thresholds, found = events[keep], index[keep], thresholds[keep], found[keep]
+            if len(events) == 0:
+                break
+            above = data[events, index][:,np.newaxis] > thresholds
+            rows, cols = np.nonzero(above & ~found)
+            # On the trailing edge, the sample before the first one above the
+            # threshold is the last one below it.
+            il[events[rows], cols] = index[rows] if step < 0 else index[rows] - 1
+            found |= above
+        crossings.append(il)
+    return {fraction: (crossings[0][:,k], crossings[1][:,k]) for k, fraction in enumerate(fractions)}
+
+def get_window(x, t0, left=1, right=10):
+    """
+    Returns the indices start and stop over which you should integrate the
+    waveforms with times `x`. The window is found by calculating the median
+    start time `t0` of all pulses and then going back `left` ns and forward
+    `right` ns.
+    """
+    mean_hit_time = np.nanmedian(t0)
+    a, b = np.searchsorted(x,[mean_hit_time-left,mean_hit_time+right])
+    if a < 0:
+        a = 0
+    if b > len(x) - 1:
+        b = len(x) - 1
+    return a, b
+
+def extract_features(x, data, a=None, b=None, left=50, right=125, baseline=10, dtype=np.float64):
+    """
+    Returns `(features, a, b)` for the baseline subtracted waveforms `data`
+    with times `x`, where `features` is a structured array with the fields in
+    `FEATURES` for every event and `a` and `b` are the integration window.
+
+    If the window isn't given, it's found with `get_window` from the start
+    times of the events with a pulse, where events with a pulse are those with
+    an amplitude larger than 5 times the IQR of the first `baseline` ns of the
+    waveforms. If no event has a pulse (which might be the case for the
+    triggering channel), then all events are used.
+    """
+    data = np.asarray(data)
+    nevents = data.shape[0]
+    i = np.arange(nevents)
+    argmin = np.argmin(data,axis=-1)
+    amplitude = data[i,argmin]
+
+    crossings = get_crossings(data, argmin, amplitude, (LOW, T0, HIGH))
+
+    features = np.empty(nevents, dtype=feature_dtype(dtype))
+    features['amplitude'] = amplitude
+    t0 = interpolate_crossing(x, data, amplitude, T0, crossings[T0][0])
+    features['t0'] = t0
+    t10 = interpolate_crossing(x, data, amplitude, LOW, crossings[LOW][0])
+    t90 = interpolate_crossing(x, data, amplitude, HIGH, crossings[HIGH][0])
+    features['rise_time'] = t90 - t10
+    t10 = interpolate_crossing(x, data, amplitude, LOW, crossings[LOW][1])
+    t90 = interpolate_crossing(x, data, amplitude, HIGH, crossings[HIGH][1])
+    features['fall_time'] = t10 - t90
+
+    if a is None or b is None:
+        noise = iqr(data[:,x < x[0] + baseline])
+        pulses = amplitude < -noise*5
+        a, b = get_window(x, t0[pulses] if np.count_nonzero(pulses) else t0, left, right)
+
+    features['charge'] = integrate(x, data, a, b)
+    return features, a, b
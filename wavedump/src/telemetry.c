@@ -0,0 +1,158 @@
+/* Timing of the stages of the acquisition loop (see telemetry.h). */
+
+#include "telemetry.h"
+#include <stdio.h>
+#include <string.h>
+#include <math.h>
+#include <time.h>
+
+char *telemetry_stages[TELEMETRY_NSTAGES] = {"readout", "decode", "copy", "wait", "write"};
+
+double telemetry_get_time(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec/1e9;
+}
+
+/* Returns the upper edge of bin `i` of the latency histograms (s). */
+static double bin_edge(int i)
+{
+    return TELEMETRY_MIN_TIME*pow(10, (double) (i + 1)/TELEMETRY_BINS_PER_DECADE);
+}
+
+/* Starts the clock of the run. Prints the rate every `interval` seconds, or
+ * never if it's 0. */
+void telemetry_init(Telemetry_t *t, double interval)
+{
+    memset(t, 0, sizeof(Telemetry_t));
+    t->interval = interval;
+    t->start_time = telemetry_get_time();
+    t->last_time = t->start_time;
+}
+
+/* Records that one pass through `stage` took `latency` seconds. */
+void telemetry_add(Telemetry_t *t, int stage, double latency)
+{
+    int i;
+
+    if (latency < TELEMETRY_MIN_TIME)
+        i = 0;
+    else
+        i = (int) (log10(latency/TELEMETRY_MIN_TIME)*TELEMETRY_BINS_PER_DECADE);
+
+    if (i >= TELEMETRY_NBINS)
+        i = TELEMETRY_NBINS - 1;
+
+    t->count[stage] += 1;
+    t->time[stage] += latency;
+    t->hist[stage][i] += 1;
+}
+
+/* Records a readout of `nevents` events and `bytes` bytes. */
+void telemetry_readout(Telemetry_t *t, int nevents, long bytes)
+{
+    int i = 0;
+
+    while (i < TELEMETRY_NSIZES - 1 && nevents >= (2 << i))
+        i++;
+
+    t->sizes[i] += 1;
+    t->events += nevents;
+    t->bytes_read += bytes;
+}
+
+/* Prints the rate of events taken and bytes read out since the last line if
+ * it was printed more than `t->interval` seconds ago. `total` is the number
+ * of events taken so far out of `nevents`. */
+void telemetry_print(Telemetry_t *t, int total, int nevents)
+{
+    double now, dt;
+
+    if (t->interval <= 0)
+        return;
+
+    now = telemetry_get_time();
+    dt = now - t->last_time;
+
+    if (dt < t->interval)
+        return;
+
+    printf("%i / %i events, %.0f events/s, %.1f MB/s\n", total, nevents, (total - t->last_events)/dt, (t->bytes_read - t->last_bytes)/dt/1e6);
+
+    t->last_time = now;
+    t->last_events = total;
+    t->last_bytes = t->bytes_read;
+}
+
+/* Stops the clock of the run. */
+void telemetry_stop(Telemetry_t *t, double live_time)
+{
+    t->stop_time = telemetry_get_time();
+    t->live_time = live_time;
+}
+
+/* Adds the timing of the stages and the histogram of the number of events
+ * per readout of `other` to `t`. */
+void telemetry_merge_stages(Telemetry_t *t, Telemetry_t *other)
+{
+    int i, j;
+
+    for (i = 0; i < TELEMETRY_NSTAGES; i++) {
+        t->count[i] += other->count[i];
+        t->time[i] += other->time[i];
+        for (j = 0; j < TELEMETRY_NBINS; j++)
+            t->hist[i][j] += other->hist[i][j];
+    }
+
+    for (i = 0; i < TELEMETRY_NSIZES; i++)
+        t->sizes[i] += other->sizes[i];
+}
+
+/* Adds the counts and histograms of `other` to `t`. */
+void telemetry_merge(Telemetry_t *t, Telemetry_t *other)
+{
+    telemetry_merge_stages(t, other);
+    t->events += other->events;
+    t->bytes_read += other->bytes_read;
+    t->bytes_written += other->bytes_written;
+    t->stop_time += other->stop_time - other->start_time;
+    t->live_time += other->live_time;
+}
+
+/* Returns the `q` quantile of the latency of `stage` (s), i.e. the upper
+ * edge of the histogram bin it falls in, or 0 if the stage was never
+ * timed. */
+double telemetry_percentile(Telemetry_t *t, int stage, double q)
+{
+    long sum = 0;
+    int i;
+
+    if (t->count[stage] == 0)
+        return 0;
+
+    for (i = 0; i < TELEMETRY_NBINS; i++) {
+        sum += t->hist[stage][i];
+        if (sum >= q*t->count[stage])
+            break;
+    }
+
+    if (i == TELEMETRY_NBINS)
+        i = TELEMETRY_NBINS - 1;
+
+    return bin_edge(i);
+}
+
+/* Prints the total time, mean, p50 and p99 latency of every stage. */
+void telemetry_summary(Telemetry_t *t)
+{
+    double run_time = t->stop_time - t->start_time;
+    int i;
+
+    printf("%li events (%.1f MB) read in %.3f s, %.3f s live\n", t->events, t->bytes_read/1e6, run_time, t->live_time);
+    printf("%-8s %8s %10s %10s %10s %10s\n", "stage", "count", "total (s)", "mean (ms)", "p50 (ms)", "p99 (ms)");
+    for (i = 0; i < TELEMETRY_NSTAGES; i++) {
+        if (t->count[i] == 0) continue;
+        printf("%-8s %8li %10.3f %10.3f %10.3f %10.3f\n", telemetry_stages[i], t->count[i], t->time[i], 1000*t->time[i]/t->count[i], 1000*telemetry_percentile(t, i, 0.5), 1000*telemetry_percentile(t, i, 0.99));
+    }
+}
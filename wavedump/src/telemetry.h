@@ -0,0 +1,75 @@
+#ifndef _TELEMETRY_H_
+#define _TELEMETRY_H_
+
+/* The latency histograms have TELEMETRY_BINS_PER_DECADE logarithmic bins
+ * per decade starting at TELEMETRY_MIN_TIME seconds, i.e. from 100 ns to
+ * 100 s. Times outside of this range are put in the first or last bin. */
+#define TELEMETRY_MIN_TIME 1e-7
+#define TELEMETRY_BINS_PER_DECADE 20
+#define TELEMETRY_NBINS 180
+
+/* Number of bins of the histogram of the number of events per readout. Bin
+ * `i` counts the readouts with 2^i to 2^(i+1) - 1 events. */
+#define TELEMETRY_NSIZES 12
+
+/* Default time between the rate lines printed during the run (s). */
+#define TELEMETRY_INTERVAL 1
+
+/* Stages of the acquisition which are timed. The readout, decode and copy
+ * stages are timed once for every readout of the digitizer, and the wait
+ * (for the writer to free a buffer) and write stages once for every batch of
+ * events written to the file. */
+enum {
+    TELEMETRY_READOUT,
+    TELEMETRY_DECODE,
+    TELEMETRY_COPY,
+    TELEMETRY_WAIT,
+    TELEMETRY_WRITE,
+    TELEMETRY_NSTAGES
+};
+
+extern char *telemetry_stages[TELEMETRY_NSTAGES];
+
+/* Timing of each stage of the acquisition, the number of bytes read out and
+ * handed to the hdf5 library, and the distribution of the number of events
+ * per readout.
+ *
+ * The write stage is recorded by the writer thread and everything else by
+ * the readout, so no two threads update the same fields. */
+typedef struct {
+    long count[TELEMETRY_NSTAGES];
+    double time[TELEMETRY_NSTAGES];
+    long hist[TELEMETRY_NSTAGES][TELEMETRY_NBINS];
+    long sizes[TELEMETRY_NSIZES];
+
+    long events;
+    long bytes_read;
+    long bytes_written;
+
+    double start_time;
+    double stop_time;
+    /* Time during which the digitizer could take events (s). This is the
+     * live time of the software triggers if they're used, and otherwise the
+     * time the readout wasn't waiting for the writer. */
+    double live_time;
+
+    /* Rate line printed every `interval` seconds. `last_events` is the
+     * number of events taken when the last line was printed. */
+    double interval;
+    double last_time;
+    long last_events;
+    long last_bytes;
+} Telemetry_t;
+
+double telemetry_get_time(void);
+void telemetry_init(Telemetry_t *t, double interval);
+void telemetry_add(Telemetry_t *t, int stage, double latency);
+void telemetry_readout(Telemetry_t *t, int nevents, long bytes);
+void telemetry_print(Telemetry_t *t, int total, int nevents);
+void telemetry_stop(Telemetry_t *t, double live_time);
+void telemetry_merge_stages(Telemetry_t *t, Telemetry_t *other);
+void telemetry_merge(Telemetry_t *t, Telemetry_t *other);
+double telemetry_percentile(Telemetry_t *t, int stage, double q);
+void telemetry_summary(Telemetry_t *t);
+
+#endif
@@ -0,0 +1,171 @@
+/* Sends software triggers at a fixed rate for `wavedump --trigger software`
+ * (see trigger.h). */
+
+#include "trigger.h"
+#include <stdio.h>
+#include <string.h>
+#include <math.h>
+#include <time.h>
+#include "CAENDigitizer.h"
+
+static double get_time(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec/1e9;
+}
+
+static void *trigger_thread(void *arg)
+{
+    Trigger_t *t = arg;
+    struct timespec ts;
+    double now, next;
+    long overdue;
+
+    pthread_mutex_lock(&t->lock);
+    while (!t->done) {
+        now = get_time();
+        next = t->start_time + t->requested/t->rate;
+
+        if (now < next) {
+            ts.tv_sec = (time_t) next;
+            ts.tv_nsec = (long) ((next - ts.tv_sec)*1e9);
+            pthread_cond_timedwait(&t->wake, &t->lock, &ts);
+            continue;
+        }
+
+        /* The overdue triggers are sent one after the other without
+         * waiting, except for the ones more than TRIGGER_MAX_BURST behind,
+         * which are skipped. */
+        overdue = (long) floor((now - t->start_time)*t->rate) + 1 - t->requested;
+        if (overdue > TRIGGER_MAX_BURST) {
+            t->missed += overdue - TRIGGER_MAX_BURST;
+            t->requested += overdue - TRIGGER_MAX_BURST;
+        }
+
+        t->requested += 1;
+
+        if (CAEN_DGTZ_SendSWtrigger(t->handle) != CAEN_DGTZ_Success) {
+            fprintf(stderr, "error calling CAEN_DGTZ_SendSWtrigger()!\n");
+            t->error = 1;
+            break;
+        }
+
+        t->sent += 1;
+    }
+    t->stop_time = get_time();
+    pthread_mutex_unlock(&t->lock);
+
+    return NULL;
+}
+
+/* Sets up software triggers at `rate` Hz for the digitizer `handle`, without
+ * sending any yet. This should be called before the output file is opened,
+ * since the writer writes the rate and the statistics to it. */
+int trigger_init(Trigger_t *t, int handle, double rate)
+{
+    memset(t, 0, sizeof(Trigger_t));
+
+    if (rate <= 0 || rate > TRIGGER_MAX_RATE) {
+        fprintf(stderr, "trigger rate must be between 0 and %i Hz.\n", TRIGGER_MAX_RATE);
+        return 1;
+    }
+
+    t->handle = handle;
+    t->rate = rate;
+
+    return 0;
+}
+
+/* Starts sending the software triggers set up with `trigger_init()`. The
+ * acquisition should already be started. */
+int trigger_start(Trigger_t *t)
+{
+    pthread_condattr_t attr;
+
+    pthread_mutex_init(&t->lock, NULL);
+    pthread_condattr_init(&attr);
+    pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+    pthread_cond_init(&t->wake, &attr);
+    pthread_condattr_destroy(&attr);
+
+    t->start_time = get_time();
+
+    if (pthread_create(&t->thread, NULL, trigger_thread, t)) {
+        fprintf(stderr, "failed to start the trigger thread.\n");
+        return 1;
+    }
+
+    t->running = 1;
+
+    printf("sending software triggers at %.0f Hz\n", t->rate);
+
+    return 0;
+}
+
+/* Stops sending software triggers. */
+void trigger_stop(Trigger_t *t)
+{
+    if (!t->running)
+        return;
+
+    pthread_mutex_lock(&t->lock);
+    t->done = 1;
+    pthread_cond_signal(&t->wake);
+    pthread_mutex_unlock(&t->lock);
+
+    pthread_join(t->thread, NULL);
+
+    t->running = 0;
+    pthread_mutex_destroy(&t->lock);
+    pthread_cond_destroy(&t->wake);
+}
+
+/* Prints the number of software triggers and the readout latency. */
+void trigger_summary(Trigger_t *t)
+{
+    printf("sent %li of %li software triggers in %.3f s (%li missed), %li accepted (%.2f%% dead time)\n", t->sent, t->requested, t->stop_time - t->start_time, t->missed, t->accepted, 100*trigger_dead_time(t));
+    if (t->readouts)
+        printf("%li readouts, %.3f ms on average, %.3f ms at most\n", t->readouts, 1000*t->readout_time/t->readouts, 1000*t->readout_max);
+}
+
+/* Holds off the software triggers while the readout calls the CAEN
+ * library. Does nothing if the triggers weren't started. */
+void trigger_lock(Trigger_t *t)
+{
+    if (t->running)
+        pthread_mutex_lock(&t->lock);
+}
+
+void trigger_unlock(Trigger_t *t)
+{
+    if (t->running)
+        pthread_mutex_unlock(&t->lock);
+}
+
+/* Records a readout of `nevents` events which took `latency` seconds. */
+void trigger_readout(Trigger_t *t, int nevents, double latency)
+{
+    t->accepted += nevents;
+    t->readouts += 1;
+    t->readout_time += latency;
+    if (latency > t->readout_max)
+        t->readout_max = latency;
+}
+
+/* Returns the fraction of the software triggers sent which the digitizer
+ * lost because its memory was full. */
+double trigger_dead_time(Trigger_t *t)
+{
+    if (t->sent == 0 || t->accepted > t->sent)
+        return 0;
+
+    return 1 - (double) t->accepted/t->sent;
+}
+
+/* Returns the time (s) during which the digitizer could accept a software
+ * trigger. */
+double trigger_live_time(Trigger_t *t)
+{
+    return (t->stop_time - t->start_time)*(1 - trigger_dead_time(t));
+}
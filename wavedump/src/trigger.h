@@ -0,0 +1,65 @@
+#ifndef _TRIGGER_H_
+#define _TRIGGER_H_
+
+#include <pthread.h>
+
+/* Default rate of software triggers with `--trigger software` (Hz). */
+#define TRIGGER_RATE 1000
+/* Maximum rate of software triggers (Hz). */
+#define TRIGGER_MAX_RATE 100000
+/* Maximum number of overdue triggers sent at once when the thread wakes up
+ * late. */
+#define TRIGGER_MAX_BURST 100
+
+/* Software triggers sent at a fixed rate by a separate thread, so that the
+ * trigger rate doesn't depend on how long it takes to read out and write the
+ * events.
+ *
+ * The `n`th trigger is scheduled at `n/rate` seconds after the start. If the
+ * thread wakes up late (for example because the readout held the lock), it
+ * sends the triggers which are overdue right away to catch up. If more than
+ * TRIGGER_MAX_BURST are overdue, the rest are skipped and counted as missed,
+ * so a long stall doesn't turn into a long burst of triggers.
+ *
+ * The CAEN library isn't guaranteed to be thread safe, so the readout has to
+ * hold the lock with `trigger_lock()` while it calls the library. The readout
+ * also records the number of events it read and how long every readout took
+ * with `trigger_readout()`, which gives the number of triggers accepted by
+ * the digitizer and the dead time, i.e. the fraction of the triggers sent
+ * which the digitizer lost because its memory was full. The triggers missed
+ * by the thread aren't part of the dead time. */
+typedef struct {
+    int handle;
+    double rate;
+    /* Whether the thread was started. */
+    int running;
+    int done;
+    int error;
+
+    pthread_t thread;
+    pthread_mutex_t lock;
+    pthread_cond_t wake;
+
+    double start_time;
+    double stop_time;
+    long requested;
+    long sent;
+    long missed;
+
+    long accepted;
+    long readouts;
+    double readout_time;
+    double readout_max;
+} Trigger_t;
+
+int trigger_init(Trigger_t *t, int handle, double rate);
+int trigger_start(Trigger_t *t);
+void trigger_stop(Trigger_t *t);
+void trigger_summary(Trigger_t *t);
+void trigger_lock(Trigger_t *t);
+void trigger_unlock(Trigger_t *t);
+void trigger_readout(Trigger_t *t, int nevents, double latency);
+double trigger_dead_time(Trigger_t *t);
+double trigger_live_time(Trigger_t *t);
+
+#endif
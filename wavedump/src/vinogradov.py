@@ -0,0 +1,94 @@
+"""
+The Vinogradov distribution of the number of PEs in the integration window,
+which is used by both the ROOT (`fit_spe_funcs.py`) and the numpy
+(`fit_numpy_funcs.py`) SPE fits. This module doesn't depend on ROOT.
+
+See this paper for a more detailed explanation:
+https://arxiv.org/pdf/2106.13168.pdf
+"""
+
+from __future__ import print_function, division
+import numpy as np
+import functools
+from math import gamma
+
+def fac(x):
+    """
+    Returns x!. We use the gamma function here instead since it works even for
+    non-integer values and is generally faster than calling math.factorial(x).
+    """
+    return gamma(x+1)
+
+def B_coeff(i, N):
+    """
+    Helper function for the vinogradov model.
+    """
+    if i == 0 and N == 0:
+        return 1
+    elif i == 0 and N > 0:
+        return 0
+    else:
+        return (fac(N)*fac(N-1)) / (fac(i)*fac(i-1)*fac(N-i))
+
+def vinogradov(N, l, ps):
+    """
+    Returns probability of getting `N` PEs in the integration window.  `l` is
+    the mean number of primary PEs.  `ps` is the probability that a primary PE
+    causes a secondary PE.
+    """
+    model = 0
+    for i in range(N+1):
+        model += B_coeff(i, N) * (l*(1-ps))**i * ps**(N-i)
+    model *= np.exp(-l)
+    model /= fac(N)
+    return model
+
+@functools.lru_cache(maxsize=None)
+def vinogradov_coeffs(num_peaks):
+    """
+    Returns a `num_peaks` x `num_peaks` table of `B_coeff(i, N)/N!`, indexed
+    by `[N, i]`. The table only depends on `num_peaks`, so it's only computed
+    once.
+    """
+    coeffs = np.zeros((num_peaks, num_peaks))
+    for N in range(num_peaks):
+        for i in range(N+1):
+            coeffs[N, i] = B_coeff(i, N) / fac(N)
+    return coeffs
+
+def _power(base, k):
+    """
+    Returns `base**k` for an integer array `k`, where negative powers are set
+    to zero.
+    """
+    return np.where(k < 0, 0.0, np.power(base, np.maximum(k, 0)))
+
+@functools.lru_cache(maxsize=1024)
+def vinogradov_pmf(num_peaks, l, ps):
+    """
+    Returns an array of `vinogradov(N, l, ps)` for `N` in `range(num_peaks)`.
+    The result is cached, so repeated calls with the same parameters (which
+    happens for every point of the histogram during a single minimizer step)
+    are free.
+    """
+    N = np.arange(num_peaks)[:, np.newaxis]
+    i = np.arange(num_peaks)[np.newaxis, :]
+    powers = _power(l*(1-ps), i) * _power(ps, N - i)
+    return np.exp(-l) * np.sum(vinogradov_coeffs(num_peaks) * powers, axis=-1)
+
+def vinogradov_pmf_grad(num_peaks, l, ps):
+    """
+    Returns `vinogradov_pmf(num_peaks, l, ps)` along with its derivatives with
+    respect to `l` and `ps`.
+    """
+    coeffs = vinogradov_coeffs(num_peaks)
+    N = np.arange(num_peaks)[:, np.newaxis]
+    i = np.arange(num_peaks)[np.newaxis, :]
+    a = l*(1-ps)
+    terms = coeffs*_power(a, i)*_power(ps, N-i)
+    dterms_dl = coeffs*i*_power(a, i-1)*(1-ps)*_power(ps, N-i)
+    dterms_dps = coeffs*(-i*l*_power(a, i-1)*_power(ps, N-i) + (N-i)*_power(a, i)*_power(ps, N-i-1))
+    pmf = np.exp(-l)*np.sum(terms, axis=-1)
+    dpmf_dl = -pmf + np.exp(-l)*np.sum(dterms_dl, axis=-1)
+    dpmf_dps = np.exp(-l)*np.sum(dterms_dps, axis=-1)
+    return pmf, dpmf_dl, dpmf_dps
@@ -5,19 +5,16 @@
 #include "fft.h"
 #include "keyb.h"
 #include "X742CorrectionRoutines.h"
-#include "hdf5.h"
+#include "writer.h"
+#include "builder.h"
 #include <unistd.h> /* for access(). */
 #include <signal.h> /* for SIGINT. */
 #include <sys/statvfs.h>
+#include <time.h>
 
-#define WF_SIZE 10000
-#define BS_SIZE 10
 #define RECORD_LENGTH 1024
 #define POST_TRIGGER 30
 
-char *GitSHA1(void);
-char *GitDirty(void);
-
 extern int dc_file[MAX_CH];
 extern int thr_file[MAX_CH];
 int cal_ok[MAX_CH] = { 0 };
@@ -1201,406 +1198,33 @@ int Set_calibrated_DCO(int handle, int ch, WaveDumpConfig_t *WDcfg, CAEN_DGTZ_Bo
 }
 
 
-/* Gets the average reading across all events and samples for each channel */
-void get_baselines(float data[][32][1024], float *baselines, int n, unsigned long chmask, int nsamples)
+/* Gets the average reading across all events and samples for each channel
+ * in `chmask`. The baselines of the other channels aren't changed. */
+void get_baselines(float data[][WRITER_MAX_CHANNELS][1024], float *baselines, int n, unsigned long chmask, int nsamples)
 {
     int i, j, k;
 
-    for (j = 0; j < 32; j++)
-        baselines[j] = 0;
+    for (j = 0; j < WRITER_MAX_CHANNELS; j++) {
+        if (!(chmask & (1UL << j)))
+            continue;
 
-    for (i = 0; i < n; i++) {
-        for (j = 0; j < 32; j++) {
-            if (!(chmask & (1 << j))) {
-                baselines[j] = 0;
-                continue;
-            }
+        baselines[j] = 0;
 
+        for (i = 0; i < n; i++) {
             for (k = 0; k < nsamples; k++) {
                 baselines[j] += data[i][j][k];
             }
         }
-    }
 
-    for (j = 0; j < 32; j++) {
         baselines[j] /= n*nsamples;
     }
 }
 
-/* Write events to an HDF5 output file. If the file doesn't exist, it will
- * be created and attributes such as the record_length, post_trigger,
- * barcode, and voltage will be written.
- *
- * The output file is set up to use gzip compression, but right now it's
- * turned off. The reason is that with the full compression (gzip level 9),
- * it was too slow and so the data taking time was dominated by the
- * compression. There is probably some way to speed this up, and if so, it
- * can be re-enabled. */
-int add_to_output_file(char *filename, char *group_name, float data[WF_SIZE][32][1024], float baseline_data[BS_SIZE][32][1024], int n, unsigned long chmask, int nsamples, WaveDumpConfig_t *WDcfg, int gzip_compression_level, int starting_channel)
+static double get_time(void)
 {
-    hid_t file, space, dset, dcpl, mem_space, file_space, group_id, baseline_group_id;
-    herr_t status;
-    htri_t avail;
-    int ndims;
-    hsize_t dims[2], chunk[2], extdims[2], maxdims[2];
-    char dset_name[256];
-    hsize_t start[2], count[2];
-    int i, j, k;
-    unsigned int filter_info;
-    hid_t aid, atype, attr;
-    char baseline_group_name[256];
-
-    chunk[0] = 1024;
-    chunk[1] = 1024;
-    /* Check if file exists. */
-    if (access(filename, F_OK) != 0) {
-        /* File doesn't exist. Create it. */
-
-        /* Check if gzip compression is available and can be used for both
-         * compression and decompression.  Normally we do not perform error
-         * checking in these examples for the sake of clarity, but in this
-         * case we will make an exception because this filter is an
-         * optional part of the hdf5 library. */
-        avail = H5Zfilter_avail(H5Z_FILTER_DEFLATE);
-        if (!avail) {
-            fprintf(stderr, "gzip filter not available.\n");
-            return 1;
-        }
-
-        status = H5Zget_filter_info(H5Z_FILTER_DEFLATE, &filter_info);
-
-        if (!(filter_info & H5Z_FILTER_CONFIG_ENCODE_ENABLED) || !(filter_info & H5Z_FILTER_CONFIG_DECODE_ENABLED)) {
-            fprintf(stderr, "gzip filter not available for encoding and decoding.\n");
-            return 1;
-        }
-
-        /* Create a new file using the default properties. */
-        file = H5Fcreate(filename, H5F_ACC_TRUNC, H5P_DEFAULT, H5P_DEFAULT);
-    } else {
-        file = H5Fopen(filename, H5F_ACC_RDWR, H5P_DEFAULT);
-    }
-
-    /* If group not in file, create the group. Else, extend the dataset in
-     * the group. */
-    if (H5Lexists(file, group_name, H5P_DEFAULT) <= 0) { 
-        group_id = H5Gcreate (file, group_name, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
-        
-        aid = H5Screate(H5S_SCALAR);
-        attr = H5Acreate2(group_id, "record_length", H5T_NATIVE_INT, aid, H5P_DEFAULT, H5P_DEFAULT);
-        int record_length = WDcfg->RecordLength;
-        int ret = H5Awrite(attr, H5T_NATIVE_INT, &record_length);
-
-        if (ret) {
-            fprintf(stderr, "failed to write record length to hdf5 file.\n");
-            return 1;
-        }
-
-        H5Sclose(aid);
-        H5Aclose(attr);
-
-        /* Creating an attribute for the root group that flags this file as
-         * being data collected from the CAEN digitizer. */
-        aid = H5Screate(H5S_SCALAR);
-        atype = H5Tcopy(H5T_C_S1);
-        H5Tset_size(atype, 100);
-        H5Tset_strpad(atype, H5T_STR_NULLTERM);
-        attr = H5Acreate2(group_id, "data_source", atype, aid, H5P_DEFAULT, H5P_DEFAULT);
-        ret = H5Awrite(attr, atype, "CAEN");
-
-        if (ret) {
-            fprintf(stderr, "failed to write data source to hdf5 file.\n");
-            return 1;
-        }
-
-        H5Sclose(aid);
-        H5Aclose(attr);
-        H5Tclose(atype);
-
-        aid = H5Screate(H5S_SCALAR);
-        attr = H5Acreate2(group_id, "post_trigger", H5T_NATIVE_INT, aid, H5P_DEFAULT, H5P_DEFAULT);
-        int post_trigger = WDcfg->PostTrigger;
-        ret = H5Awrite(attr, H5T_NATIVE_INT, &post_trigger);
-
-        if (ret) {
-            fprintf(stderr, "failed to write post trigger to hdf5 file.\n");
-            return 1;
-        }
-
-        H5Sclose(aid);
-        H5Aclose(attr);
-
-        aid = H5Screate(H5S_SCALAR);
-        attr = H5Acreate2(group_id, "drs4_frequency", H5T_NATIVE_INT, aid, H5P_DEFAULT, H5P_DEFAULT);
-        int drs4_frequency = 0;
-        switch (WDcfg->DRS4Frequency) {
-        case 0:
-            drs4_frequency = 5000;
-            break;
-        case 1:
-            drs4_frequency = 2500;
-            break;
-        case 2:
-            drs4_frequency = 1000;
-            break;
-        case 3:
-            drs4_frequency = 750;
-            break;
-        default:
-            fprintf(stderr, "unknown DRS4 frequency %i\n", WDcfg->DRS4Frequency);
-            return 1;
-        }
-        ret = H5Awrite(attr, H5T_NATIVE_INT, &drs4_frequency);
-
-        if (ret) {
-            fprintf(stderr, "failed to write DRS4 frequency to hdf5 file.\n");
-            return 1;
-        }
-
-        H5Sclose(aid);
-        H5Aclose(attr);
-
-        aid = H5Screate(H5S_SCALAR);
-        attr = H5Acreate2(group_id, "barcode", H5T_NATIVE_INT, aid, H5P_DEFAULT, H5P_DEFAULT);
-        ret = H5Awrite(attr, H5T_NATIVE_INT, &WDcfg->barcode);
-
-        if (ret) {
-            fprintf(stderr, "failed to write barcode to hdf5 file.\n");
-            return 1;
-        }
-
-        H5Sclose(aid);
-        H5Aclose(attr);
-
-        aid = H5Screate(H5S_SCALAR);
-        attr = H5Acreate2(group_id, "voltage", H5T_NATIVE_FLOAT, aid, H5P_DEFAULT, H5P_DEFAULT);
-        ret = H5Awrite(attr, H5T_NATIVE_FLOAT, &WDcfg->voltage);
-
-        if (ret) {
-            fprintf(stderr, "failed to write voltage to hdf5 file.\n");
-            return 1;
-        }
-
-        H5Sclose(aid);
-        H5Aclose(attr);
-
-        aid = H5Screate(H5S_SCALAR);
-        atype = H5Tcopy(H5T_C_S1);
-        H5Tset_size(atype, 100);
-        H5Tset_strpad(atype, H5T_STR_NULLTERM);
-        attr = H5Acreate2(group_id, "git_sha1", atype, aid, H5P_DEFAULT, H5P_DEFAULT);
-        ret = H5Awrite(attr, atype, GitSHA1());
-
-        if (ret) {
-            fprintf(stderr, "failed to write git_sha1 to hdf5 file.\n");
-            return 1;
-        }
-
-        printf("git sha1 = %s\n", GitSHA1());
-
-        H5Sclose(aid);
-        H5Aclose(attr);
-        H5Tclose(atype);
-
-        aid = H5Screate(H5S_SCALAR);
-        atype = H5Tcopy(H5T_C_S1);
-        H5Tset_size(atype, 100);
-        H5Tset_strpad(atype, H5T_STR_NULLTERM);
-        attr = H5Acreate2(group_id, "git_dirty", atype, aid, H5P_DEFAULT, H5P_DEFAULT);
-        ret = H5Awrite(attr, atype, GitDirty());
-
-        if (ret) {
-            fprintf(stderr, "failed to write git_sha1 to hdf5 file.\n");
-            return 1;
-        }
-
-        H5Sclose(aid);
-        H5Aclose(attr);
-        H5Tclose(atype);
-        
-        /* Writing the baseline data to the file in separate datasets */
-        sprintf(baseline_group_name, "baseline_%s", group_name);
-        baseline_group_id = H5Gcreate(group_id, baseline_group_name, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
-        for (i = 0; i < 32; i++) {
-            if (!(chmask & (1 << i))) continue;
-            maxdims[0] = BS_SIZE;
-            maxdims[1] = nsamples;
-            dims[0] = BS_SIZE;
-            dims[1] = nsamples;
-            
-            space = H5Screate_simple(2, dims, maxdims);
-            
-            float wdata[BS_SIZE][1024];
-            for (j = 0; j < BS_SIZE; j++)
-                for (k = 0; k < nsamples; k++)
-                    wdata[j][k] = baseline_data[j][i][k];
-
-            sprintf(dset_name, "base_ch%i", i+starting_channel);
-            
-            dset = H5Dcreate(baseline_group_id, dset_name, H5T_NATIVE_FLOAT, space, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
-
-            /* Write the data to the dataset. */
-            status = H5Dwrite(dset, H5T_NATIVE_FLOAT, H5S_ALL, H5S_ALL, H5P_DEFAULT, wdata);
-
-            /* Close and release resources. */
-            status = H5Dclose(dset);
-            status = H5Sclose(space);
-
-            if (status) {
-                fprintf(stderr, "error closing hdf5 resources.\n");
-                return 1;
-            }
-        }
-        status = H5Gclose(baseline_group_id);
-        if (status) {
-            fprintf(stderr, "error closing hdf5 resources.\n");
-            return 1;
-        }
-
-        /* Writing the actual data to the file */
-        for (i = 0; i < 32; i++) {
-            if (!(chmask & (1 << i))) continue;
-            /* Create dataspace with unlimited dimensions. */
-            maxdims[0] = H5S_UNLIMITED;
-            maxdims[1] = H5S_UNLIMITED;
-            dims[0] = n;
-            dims[1] = nsamples;
-            space = H5Screate_simple(2, dims, maxdims);
-
-            /* Create the dataset creation property list, add the gzip
-             * compression filter and set the chunk size. */
-            dcpl = H5Pcreate(H5P_DATASET_CREATE);
-
-            /* Set gzip level. Right now we set it to 0 (no compression),
-             * since it's *much* faster to write. In the future if we can
-             * make it faster and/or need smaller files you can increase
-             * this to 9. */
-            status = H5Pset_deflate(dcpl, gzip_compression_level);
-            status = H5Pset_chunk(dcpl, 2, chunk);
-
-            sprintf(dset_name, "ch%i", i+starting_channel);
-
-            float *wdata = malloc(n*nsamples*sizeof(float));
-
-            for (j = 0; j < n; j++)
-                for (k = 0; k < nsamples; k++)
-                    wdata[j*nsamples + k] = data[j][i][k];
-
-            /* Create the compressed unlimited dataset. */
-            dset = H5Dcreate(group_id, dset_name, H5T_NATIVE_FLOAT, space, H5P_DEFAULT, dcpl, H5P_DEFAULT);
-
-            /* Write the data to the dataset. */
-            status = H5Dwrite(dset, H5T_NATIVE_FLOAT, H5S_ALL, H5S_ALL, H5P_DEFAULT, wdata);
-
-            free(wdata);
-
-            /* Close and release resources. */
-            status = H5Pclose(dcpl);
-            status = H5Dclose(dset);
-            status = H5Sclose(space);
-
-            if (status) {
-                fprintf(stderr, "error closing hdf5 resources.\n");
-                return 1;
-            }
-        }
-        status = H5Gclose(group_id);
-        status = H5Fclose(file);
-
-        if (status) {
-            fprintf(stderr, "error closing hdf5 file.\n");
-            return 1;
-        }
-
-        return 0;
-    }
-
-    /* Extend the dataset.
-     *
-     * Note: This is really confusing. I couldn't have done this without the
-     * stack overflow answer here:
-     * https://stackoverflow.com/questions/15379399/writing-appending-arrays-of-float-to-the-only-dataset-in-hdf5-file-in-c. */
-    group_id = H5Gopen(file, group_name, H5P_DEFAULT);
-    for (i = 0; i < 32; i++) {
-        if (!(chmask & (1 << i))) continue;
-
-        sprintf(dset_name, "ch%i", i);
-        if ((dset = H5Dopen(group_id, dset_name, H5P_DEFAULT)) < 0) {
-            fprintf(stderr, "couldn't find dataset for %s. skipping...\n", dset_name);
-        }
-
-        /* Get dataspace and allocate memory for read buffer. This is a two
-         * dimensional dataset so the dynamic allocation must be done in
-         * steps. */
-        file_space = H5Dget_space(dset);
-        ndims = H5Sget_simple_extent_dims(file_space, dims, NULL);
-
-        extdims[0] = n;
-        extdims[1] = nsamples;
-
-        /* Memory dataspace resized. */
-        mem_space = H5Screate_simple(ndims, extdims, NULL);
-
-        /* Update dims so it now has the new size. */
-        dims[0] += extdims[0];
-
-        /* Extend the dataset. */
-        status = H5Dset_extent(dset, dims);
-
-        if (status) {
-            fprintf(stderr, "error extending dataset.\n");
-            return 1;
-        }
-
-        /* Retrieve the dataspace for the newly extended dataset. */
-        file_space = H5Dget_space(dset);
-
-        /* Subtract a hyperslab reflecting the original dimensions from the
-         * selection. The selection now contains only the newly extended
-         * portions of the dataset. */
-        start[0] = dims[0]-extdims[0];
-        start[1] = 0;
-        count[0] = extdims[0];
-        count[1] = extdims[1];
-        status = H5Sselect_hyperslab(file_space, H5S_SELECT_SET, start, NULL, count, NULL);
-
-        if (status) {
-            fprintf(stderr, "error selecting hyperslab.\n");
-            return 1;
-        }
-
-        float *wdata = malloc(n*nsamples*sizeof(float));
-        
-        for (j = 0; j < n; j++)
-            for (k = 0; k < nsamples; k++)
-                wdata[j*nsamples + k] = data[j][i][k];
-
-        /* Write the data to the selected portion of the dataset. */
-        status = H5Dwrite(dset, H5T_NATIVE_FLOAT, mem_space, file_space, H5P_DEFAULT, wdata);
-
-        if (status) {
-            fprintf(stderr, "error writing to hdf5 file.\n");
-            return 1;
-        }
-
-        /* Close and release resources. */
-        free(wdata);
-        status = H5Sclose(mem_space);
-        status = H5Dclose(dset);
-        status = H5Sclose(file_space);
-
-        if (status) {
-            fprintf(stderr, "error closing hdf5 resources.\n");
-            return 1;
-        }
-    }
-    status = H5Gclose(group_id);
-    status = H5Fclose(file);
-    if (status) {
-        fprintf(stderr, "error closing hdf5 file.\n");
-        return 1;
-    }
-
-    return 0;
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec/1e9;
 }
 
 void print_help()
@@ -1609,12 +1233,42 @@ void print_help()
     "  -b, --barcode Barcode of the module being tested\n"
     "  -v, --voltage Voltage (V)\n"
     "  -t, --trigger Type of trigger: \"software\", \"external\", or \"self\".\n"
+    "  --trigger-rate\n"
+    "                rate of software triggers in Hz (default: 1000)\n"
+    "  --stats-interval\n"
+    "                seconds between the lines with the event rate, or 0 to\n"
+    "                not print them (default: 1)\n"
     "  -l, --label   Name of hdf5 group to write data to (sodium, spe)\n"
     "  --threshold   Trigger threshold (volts) (default: -0.1)\n"
     "  --gzip-compression-level\n"
-    "                gzip compression level (default: 0)\n"
+    "                gzip compression level (default: 0, or 1 with --uint16)\n"
+    "  --uint16      store the samples as uint16 ADC counts with the shuffle\n"
+    "                filter instead of floats\n"
     "  --starting-channel\n"
     "                number of first channel (default: 0)\n"
+    "  --buffers     number of event buffers between the readout and the\n"
+    "                writer thread (default: 2)\n"
+    "  --batch-size  number of events written to the file at a time\n"
+    "                (default: 1000)\n"
+    "  --swmr        write the file in single-writer/multiple-reader mode so\n"
+    "                that it can be read while it's written (see\n"
+    "                analyze-waveforms --follow)\n"
+    "  --charge-only integrate the waveforms while reading them out and only\n"
+    "                write the charges and every --prescale'th waveform\n"
+    "  --prescale    write every N'th waveform with --charge-only\n"
+    "                (default: 1000)\n"
+    "  --start-time  start of the --charge-only integration relative to the\n"
+    "                trigger in ns (default: -50)\n"
+    "  --integration-time\n"
+    "                length of the --charge-only integration in ns\n"
+    "                (default: 175)\n"
+    "  --raw         write the samples without the DRS4 corrections along\n"
+    "                with the correction tables and the start cells\n"
+    "  --boards      number of digitizers to read out at once (default: 1).\n"
+    "                The channels of digitizer N are numbered from 16*N\n"
+    "  --time-window\n"
+    "                maximum difference between the trigger times of the\n"
+    "                events from every digitizer in ns (default: 1000)\n"
     "  --help        Output this help and exit.\n"
     "\n");
     exit(1);
@@ -1738,17 +1392,6 @@ WaveDumpConfig_t get_spe_settings()
     return get_default_settings();
 }
 
-void print_wfdata(float data[WF_SIZE][32][1024]) {
-    int i, j;	
-    for(i = 0; i < 15; i++) {
-	printf("[");
-	for(j = 0; j < 5; j++) {
-	    printf("%.3f, ", data[i][0][j]);
-	}
-	printf("...\n");
-    }
-}
-
 long get_free_space(void)
 {
     /* Returns the amount of free space in the current working directory. */
@@ -1787,9 +1430,32 @@ int main(int argc, char *argv[])
     char *label = NULL;
     CAEN_DGTZ_X742_EVENT_t *Event742 = NULL;
     double threshold = -0.1;
-    int gzip_compression_level = 0;
+    int gzip_compression_level = -1;
+    int uint16 = 0;
     int starting_channel = 0;
-    unsigned long channel_mask = 0xffff;
+    unsigned long channel_mask = 0;
+    int nbuffers = WRITER_NBUFFERS;
+    int batch_size = WRITER_BATCH_SIZE;
+    int swmr = 0;
+    int charge_only = 0;
+    int raw = 0;
+    double trigger_rate = TRIGGER_RATE;
+    Trigger_t trigger;
+    double stats_interval = TELEMETRY_INTERVAL;
+    Telemetry_t telemetry;
+    double t0, t1, decode_time, copy_time;
+    int prescale = 1000;
+    float start_time = CHARGE_START_TIME;
+    float integration_time = CHARGE_INTEGRATION_TIME;
+    ChargeWindow_t charge_window;
+    Writer_t writer;
+    int b, nboards = 1;
+    double time_window = BUILDER_TIME_WINDOW;
+    int handles[BUILDER_MAX_BOARDS];
+    char *buffers[BUILDER_MAX_BOARDS];
+    CAEN_DGTZ_X742_EVENT_t *events[BUILDER_MAX_BOARDS];
+    CAEN_DGTZ_DRS4Correction_t raw_tables[WRITER_MAX_GROUPS];
+    Builder_t builder;
 
     FILE *f_ini;
     CAEN_DGTZ_DRS4Correction_t X742Tables[MAX_X742_GROUP_SIZE];
@@ -1807,6 +1473,10 @@ int main(int argc, char *argv[])
             print_help();
         } else if ((!strcmp(argv[i],"-t") || !strcmp(argv[i],"--trigger")) && i < argc - 1) {
             trig_type = argv[++i];            
+        } else if ((!strcmp(argv[i],"--trigger-rate")) && i < argc - 1) {
+            trigger_rate = atof(argv[++i]);
+        } else if ((!strcmp(argv[i],"--stats-interval")) && i < argc - 1) {
+            stats_interval = atof(argv[++i]);
         } else if ((!strcmp(argv[i],"-l") || !strcmp(argv[i],"--label")) && i < argc - 1) {
             label = argv[++i];            
         } else if ((!strcmp(argv[i],"-b") || !strcmp(argv[i],"--barcode")) && i < argc - 1) {
@@ -1819,6 +1489,28 @@ int main(int argc, char *argv[])
             gzip_compression_level = atoi(argv[++i]);
         } else if ((!strcmp(argv[i],"--starting-channel")) && i < argc - 1) {
             starting_channel = atoi(argv[++i]);
+        } else if (!strcmp(argv[i],"--uint16")) {
+            uint16 = 1;
+        } else if ((!strcmp(argv[i],"--buffers")) && i < argc - 1) {
+            nbuffers = atoi(argv[++i]);
+        } else if ((!strcmp(argv[i],"--batch-size")) && i < argc - 1) {
+            batch_size = atoi(argv[++i]);
+        } else if (!strcmp(argv[i],"--swmr")) {
+            swmr = 1;
+        } else if (!strcmp(argv[i],"--charge-only")) {
+            charge_only = 1;
+        } else if (!strcmp(argv[i],"--raw")) {
+            raw = 1;
+        } else if ((!strcmp(argv[i],"--prescale")) && i < argc - 1) {
+            prescale = atoi(argv[++i]);
+        } else if ((!strcmp(argv[i],"--start-time")) && i < argc - 1) {
+            start_time = atof(argv[++i]);
+        } else if ((!strcmp(argv[i],"--integration-time")) && i < argc - 1) {
+            integration_time = atof(argv[++i]);
+        } else if ((!strcmp(argv[i],"--boards")) && i < argc - 1) {
+            nboards = atoi(argv[++i]);
+        } else if ((!strcmp(argv[i],"--time-window")) && i < argc - 1) {
+            time_window = atof(argv[++i]);
         } else if ((!strcmp(argv[i],"--channel-mask")) && i < argc - 1) {
             channel_mask = strtoul(argv[++i],NULL,0);
 
@@ -1859,14 +1551,52 @@ int main(int argc, char *argv[])
         exit(1);
     }
 
+    /* The charges are integrated online, so they have to be computed from
+     * corrected samples. */
+    if (raw && charge_only) {
+        fprintf(stderr, "--raw can't be used with --charge-only\n");
+        exit(1);
+    }
+
+    if (trigger_rate <= 0 || trigger_rate > TRIGGER_MAX_RATE) {
+        fprintf(stderr, "--trigger-rate must be between 0 and %i Hz\n", TRIGGER_MAX_RATE);
+        exit(1);
+    }
+
+    if (nboards < 1 || nboards > BUILDER_MAX_BOARDS) {
+        fprintf(stderr, "--boards must be between 1 and %i\n", BUILDER_MAX_BOARDS);
+        exit(1);
+    }
+
+    if (time_window <= 0) {
+        fprintf(stderr, "--time-window must be positive\n");
+        exit(1);
+    }
+
+    /* By default, every channel of every digitizer is read out. */
+    if (channel_mask == 0)
+        channel_mask = ~0UL >> (WRITER_MAX_CHANNELS - nboards*BOARD_NCHANNELS);
+
+    if (nboards*BOARD_NCHANNELS < WRITER_MAX_CHANNELS && (channel_mask >> nboards*BOARD_NCHANNELS)) {
+        fprintf(stderr, "--channel-mask has channels beyond the %i digitizers\n", nboards);
+        exit(1);
+    }
+
+    /* Without compression the shuffle filter doesn't do anything, so uint16
+     * data is compressed with the fastest gzip level by default. */
+    if (gzip_compression_level < 0)
+        gzip_compression_level = uint16 ? 1 : 0;
+
     signal(SIGINT, sigint_handler);
 
     int nchannels = 0;
-    for (i = 0; i < 16; i++)
-        if (channel_mask & (1 << i))
+    for (i = 0; i < WRITER_MAX_CHANNELS; i++)
+        if (channel_mask & (1UL << i))
             nchannels += 1;
 
-    double space_needed = nevents*nchannels*1024*sizeof(float)/pow(2,30);
+    double space_needed = nevents*nchannels*1024*(uint16 ? sizeof(uint16_t) : sizeof(float))/pow(2,30);
+    if (charge_only)
+        space_needed = space_needed/prescale + nevents*nchannels*sizeof(float)/pow(2,30);
     
     double free_space = get_free_space()/pow(2, 30);
     printf("Required disk space:  %.0fG\n", space_needed);
@@ -1896,335 +1626,369 @@ int main(int argc, char *argv[])
         fclose(f_ini);
     }
 
-    /* Open the digitizer. */
-    ret = CAEN_DGTZ_OpenDigitizer(0, 0, 0, 0, &handle);
+    WriterBuffer_t *wbuf = NULL;
+    int nwaveforms = 0;
+    static float bdata[BS_SIZE][WRITER_MAX_CHANNELS][1024];
+    float baselines[WRITER_MAX_CHANNELS] = {0};
+    float thresholds[16];
+    int nsamples = 0;
 
-    if (ret) {
-        fprintf(stderr, "unable to open digitizer! Is it turned on?\n");
-        exit(1);
-    }
+    /* Only the channels of the enabled groups are read out, so the other
+     * channels aren't stored. */
+    unsigned long readout_mask = channel_mask;
 
-    ret = CAEN_DGTZ_GetInfo(handle, &BoardInfo);
+    /* Set up every digitizer in turn. The channels of digitizer `b` are
+     * numbered from `b*BOARD_NCHANNELS` in `channel_mask`, the baselines and
+     * the output file. */
+    for (b = 0; b < nboards; b++) {
+        unsigned long board_mask = (channel_mask >> b*BOARD_NCHANNELS) & 0xffff;
+        int offset = b*BOARD_NCHANNELS;
 
-    if (ret) {
-        fprintf(stderr, "unable to get board info.\n");
-        exit(1);
-    }
+        /* Open the digitizer. */
+        ret = CAEN_DGTZ_OpenDigitizer(0, b, 0, 0, &handle);
 
-    printf("Connected to CAEN Digitizer Model %s\n", BoardInfo.ModelName);
-    printf("ROC FPGA Release is %s\n", BoardInfo.ROC_FirmwareRel);
-    printf("AMC FPGA Release is %s\n", BoardInfo.AMC_FirmwareRel);
+        if (ret) {
+            fprintf(stderr, "unable to open digitizer %i! Is it turned on?\n", b);
+            exit(1);
+        }
 
-    /* Check firmware rivision (DPP firmwares cannot be used with WaveDump) */
-    sscanf(BoardInfo.AMC_FirmwareRel, "%d", &MajorNumber);
-    if (MajorNumber >= 128) {
-        printf("This digitizer has a DPP firmware! quitting...\n");
-        exit(1);
-    }
+        ret = CAEN_DGTZ_GetInfo(handle, &BoardInfo);
 
-    /* Get Number of Channels, Number of bits, Number of Groups of the board */
-    ret = GetMoreBoardInfo(handle, BoardInfo, &WDcfg);
+        if (ret) {
+            fprintf(stderr, "unable to get board info.\n");
+            exit(1);
+        }
 
-    if (ret) {
-        fprintf(stderr, "invalid board type\n");
-        exit(1);
-    }
+        printf("Connected to CAEN Digitizer Model %s\n", BoardInfo.ModelName);
+        printf("ROC FPGA Release is %s\n", BoardInfo.ROC_FirmwareRel);
+        printf("AMC FPGA Release is %s\n", BoardInfo.AMC_FirmwareRel);
 
-    /* Check for possible board internal errors */
-    ret = CheckBoardFailureStatus(handle, BoardInfo);
+        /* Check firmware rivision (DPP firmwares cannot be used with WaveDump) */
+        sscanf(BoardInfo.AMC_FirmwareRel, "%d", &MajorNumber);
+        if (MajorNumber >= 128) {
+            printf("This digitizer has a DPP firmware! quitting...\n");
+            exit(1);
+        }
 
-    if (ret) {
-        fprintf(stderr, "CheckBoardFailureStatus() returned 1\n");
-        exit(1);
-    }
+        /* Get Number of Channels, Number of bits, Number of Groups of the board */
+        ret = GetMoreBoardInfo(handle, BoardInfo, &WDcfg);
 
-    //set default DAC calibration coefficients
-    for (i = 0; i < MAX_SET; i++) {
-        WDcfg.DAC_Calib.cal[i] = 1;
-        WDcfg.DAC_Calib.offset[i] = 0;
-    }
+        if (ret) {
+            fprintf(stderr, "invalid board type\n");
+            exit(1);
+        }
 
-    //load DAC calibration data (if present in flash)
-    if (BoardInfo.FamilyCode != CAEN_DGTZ_XX742_FAMILY_CODE)//XX742 not considered
-        Load_DAC_Calibration_From_Flash(handle, &WDcfg, BoardInfo);
+        if (nboards > 1 && WDcfg.Nch > BOARD_NCHANNELS) {
+            fprintf(stderr, "can only read out several digitizers with up to %i channels\n", BOARD_NCHANNELS);
+            exit(1);
+        }
 
-    // Perform calibration (if needed).
-    if (WDcfg.StartupCalibration)
-        calibrate(handle, &WDrun, BoardInfo);
+        /* Check for possible board internal errors */
+        ret = CheckBoardFailureStatus(handle, BoardInfo);
 
-    // mask the channels not available for this model
-    if ((BoardInfo.FamilyCode != CAEN_DGTZ_XX740_FAMILY_CODE) && (BoardInfo.FamilyCode != CAEN_DGTZ_XX742_FAMILY_CODE)){
-        WDcfg.EnableMask &= (1<<WDcfg.Nch)-1;
-    } else {
-        WDcfg.EnableMask &= (1<<(WDcfg.Nch/8))-1;
-    }
-    if ((BoardInfo.FamilyCode == CAEN_DGTZ_XX751_FAMILY_CODE) && WDcfg.DesMode) {
-        WDcfg.EnableMask &= 0xAA;
-    }
-    if ((BoardInfo.FamilyCode == CAEN_DGTZ_XX731_FAMILY_CODE) && WDcfg.DesMode) {
-        WDcfg.EnableMask &= 0x55;
-    }
-    // Set plot mask
-    if ((BoardInfo.FamilyCode != CAEN_DGTZ_XX740_FAMILY_CODE) && (BoardInfo.FamilyCode != CAEN_DGTZ_XX742_FAMILY_CODE)){
-        WDrun.ChannelPlotMask = WDcfg.EnableMask;
-    } else {
-        WDrun.ChannelPlotMask = (WDcfg.FastTriggerEnabled == 0) ? 0xFF: 0x1FF;
-    }
-
-    if ((BoardInfo.FamilyCode == CAEN_DGTZ_XX730_FAMILY_CODE) || (BoardInfo.FamilyCode == CAEN_DGTZ_XX725_FAMILY_CODE)) {
-            WDrun.GroupPlotSwitch = 0;
-    }
+        if (ret) {
+            fprintf(stderr, "CheckBoardFailureStatus() returned 1\n");
+            exit(1);
+        }
 
-    /* program the digitizer */
-    ret = ProgramDigitizer(handle, WDcfg, BoardInfo);
+        //set default DAC calibration coefficients
+        for (i = 0; i < MAX_SET; i++) {
+            WDcfg.DAC_Calib.cal[i] = 1;
+            WDcfg.DAC_Calib.offset[i] = 0;
+        }
 
-    if (ret) {
-        fprintf(stderr, "error calling ProgramDigitizer()\n");
-        exit(1);
-    }
+        //load DAC calibration data (if present in flash)
+        if (BoardInfo.FamilyCode != CAEN_DGTZ_XX742_FAMILY_CODE)//XX742 not considered
+            Load_DAC_Calibration_From_Flash(handle, &WDcfg, BoardInfo);
 
-    usleep(300000);
+        // Perform calibration (if needed).
+        if (WDcfg.StartupCalibration)
+            calibrate(handle, &WDrun, BoardInfo);
 
-    //check for possible failures after programming the digitizer
-    ret = CheckBoardFailureStatus(handle, BoardInfo);
+        // mask the channels not available for this model
+        if ((BoardInfo.FamilyCode != CAEN_DGTZ_XX740_FAMILY_CODE) && (BoardInfo.FamilyCode != CAEN_DGTZ_XX742_FAMILY_CODE)){
+            WDcfg.EnableMask &= (1<<WDcfg.Nch)-1;
+        } else {
+            WDcfg.EnableMask &= (1<<(WDcfg.Nch/8))-1;
+        }
+        if ((BoardInfo.FamilyCode == CAEN_DGTZ_XX751_FAMILY_CODE) && WDcfg.DesMode) {
+            WDcfg.EnableMask &= 0xAA;
+        }
+        if ((BoardInfo.FamilyCode == CAEN_DGTZ_XX731_FAMILY_CODE) && WDcfg.DesMode) {
+            WDcfg.EnableMask &= 0x55;
+        }
+        // Set plot mask
+        if ((BoardInfo.FamilyCode != CAEN_DGTZ_XX740_FAMILY_CODE) && (BoardInfo.FamilyCode != CAEN_DGTZ_XX742_FAMILY_CODE)){
+            WDrun.ChannelPlotMask = WDcfg.EnableMask;
+        } else {
+            WDrun.ChannelPlotMask = (WDcfg.FastTriggerEnabled == 0) ? 0xFF: 0x1FF;
+        }
 
-    if (ret) {
-        fprintf(stderr, "error calling CheckBoardFailureStatus()\n");
-        exit(1);
-    }
+        if ((BoardInfo.FamilyCode == CAEN_DGTZ_XX730_FAMILY_CODE) || (BoardInfo.FamilyCode == CAEN_DGTZ_XX725_FAMILY_CODE)) {
+                WDrun.GroupPlotSwitch = 0;
+        }
 
-    // Select the next enabled group for plotting
-    if ((WDcfg.EnableMask) && (BoardInfo.FamilyCode == CAEN_DGTZ_XX742_FAMILY_CODE || BoardInfo.FamilyCode == CAEN_DGTZ_XX740_FAMILY_CODE))
-        if( ((WDcfg.EnableMask>>WDrun.GroupPlotIndex)&0x1)==0 )
-            GoToNextEnabledGroup(&WDrun, &WDcfg);
+        /* program the digitizer */
+        ret = ProgramDigitizer(handle, WDcfg, BoardInfo);
 
-    // Read again the board infos, just in case some of them were changed by the programming
-    // (like, for example, the TSample and the number of channels if DES mode is changed)
-    if(ReloadCfgStatus > 0) {
-        ret = CAEN_DGTZ_GetInfo(handle, &BoardInfo);
-        if (ret) {
-            ErrCode = ERR_BOARD_INFO_READ;
-            goto QuitProgram;
-        }
-        ret = GetMoreBoardInfo(handle,BoardInfo, &WDcfg);
         if (ret) {
-            ErrCode = ERR_INVALID_BOARD_TYPE;
-            goto QuitProgram;
+            fprintf(stderr, "error calling ProgramDigitizer()\n");
+            exit(1);
         }
 
-        // Reload Correction Tables if changed
-        if(BoardInfo.FamilyCode == CAEN_DGTZ_XX742_FAMILY_CODE && (ReloadCfgStatus & (0x1 << CFGRELOAD_CORRTABLES_BIT)) ) {
-            if(WDcfg.useCorrections != -1) { // Use Manual Corrections
-                uint32_t GroupMask = 0;
+        usleep(300000);
 
-                // Disable Automatic Corrections
-                if ((ret = CAEN_DGTZ_DisableDRS4Correction(handle)) != CAEN_DGTZ_Success)
-                    goto QuitProgram;
+        //check for possible failures after programming the digitizer
+        ret = CheckBoardFailureStatus(handle, BoardInfo);
 
-                // Load the Correction Tables from the Digitizer flash
-                if ((ret = CAEN_DGTZ_GetCorrectionTables(handle, WDcfg.DRS4Frequency, (void*)X742Tables)) != CAEN_DGTZ_Success)
-                    goto QuitProgram;
+        if (ret) {
+            fprintf(stderr, "error calling CheckBoardFailureStatus()\n");
+            exit(1);
+        }
 
-                if(WDcfg.UseManualTables != -1) { // The user wants to use some custom tables
-                    uint32_t gr;
-                                        int32_t clret;
-                                        
-                    GroupMask = WDcfg.UseManualTables;
+        // Select the next enabled group for plotting
+        if ((WDcfg.EnableMask) && (BoardInfo.FamilyCode == CAEN_DGTZ_XX742_FAMILY_CODE || BoardInfo.FamilyCode == CAEN_DGTZ_XX740_FAMILY_CODE))
+            if( ((WDcfg.EnableMask>>WDrun.GroupPlotIndex)&0x1)==0 )
+                GoToNextEnabledGroup(&WDrun, &WDcfg);
 
-                    for(gr = 0; gr < WDcfg.MaxGroupNumber; gr++) {
-                        if (((GroupMask>>gr)&0x1) == 0)
-                            continue;
-                        if ((clret = LoadCorrectionTable(WDcfg.TablesFilenames[gr], &(X742Tables[gr]))) != 0)
-                            printf("Error [%d] loading custom table from file '%s' for group [%u].\n", clret, WDcfg.TablesFilenames[gr], gr);
-                    }
-                }
-                // Save to file the Tables read from flash
-                GroupMask = (~GroupMask) & ((0x1<<WDcfg.MaxGroupNumber)-1);
-                SaveCorrectionTables("X742Table", GroupMask, X742Tables);
+        // Read again the board infos, just in case some of them were changed by the programming
+        // (like, for example, the TSample and the number of channels if DES mode is changed)
+        if(ReloadCfgStatus > 0) {
+            ret = CAEN_DGTZ_GetInfo(handle, &BoardInfo);
+            if (ret) {
+                ErrCode = ERR_BOARD_INFO_READ;
+                goto QuitProgram;
             }
-            else { // Use Automatic Corrections
-                if ((ret = CAEN_DGTZ_LoadDRS4CorrectionData(handle, WDcfg.DRS4Frequency)) != CAEN_DGTZ_Success)
-                    goto QuitProgram;
-                if ((ret = CAEN_DGTZ_EnableDRS4Correction(handle)) != CAEN_DGTZ_Success)
-                    goto QuitProgram;
+            ret = GetMoreBoardInfo(handle,BoardInfo, &WDcfg);
+            if (ret) {
+                ErrCode = ERR_INVALID_BOARD_TYPE;
+                goto QuitProgram;
             }
-        }
-    }
 
-    // Allocate memory for the event data and readout buffer
-    ret = CAEN_DGTZ_AllocateEvent(handle, (void**)&Event742);
+            // Reload Correction Tables if changed
+            if(BoardInfo.FamilyCode == CAEN_DGTZ_XX742_FAMILY_CODE && (ReloadCfgStatus & (0x1 << CFGRELOAD_CORRTABLES_BIT)) ) {
+                if(WDcfg.useCorrections != -1) { // Use Manual Corrections
+                    uint32_t GroupMask = 0;
 
-    if (ret != CAEN_DGTZ_Success) {
-        ErrCode = ERR_MALLOC;
-        goto QuitProgram;
-    }
+                    // Disable Automatic Corrections
+                    if ((ret = CAEN_DGTZ_DisableDRS4Correction(handle)) != CAEN_DGTZ_Success)
+                        goto QuitProgram;
 
-    /* WARNING: This malloc must be done after the digitizer programming */
-    ret = CAEN_DGTZ_MallocReadoutBuffer(handle, &buffer,&AllocatedSize);
+                    // Load the Correction Tables from the Digitizer flash
+                    if ((ret = CAEN_DGTZ_GetCorrectionTables(handle, WDcfg.DRS4Frequency, (void*)X742Tables)) != CAEN_DGTZ_Success)
+                        goto QuitProgram;
 
-    if (ret) {
-        ErrCode = ERR_MALLOC;
-        goto QuitProgram;
-    }
-
-    usleep(300000);
-
-    CAEN_DGTZ_SWStopAcquisition(handle);
+                    if(WDcfg.UseManualTables != -1) { // The user wants to use some custom tables
+                        uint32_t gr;
+                                            int32_t clret;
+                                        
+                        GroupMask = WDcfg.UseManualTables;
 
-    /* First, in order to self-trigger we need to set the digitizer into
-     * transparent mode and read some data from the board to get an idea of
-     * the un-calibrated baseline.
-     *
-     * See page 35 of the DT5742 manual. */
+                        for(gr = 0; gr < WDcfg.MaxGroupNumber; gr++) {
+                            if (((GroupMask>>gr)&0x1) == 0)
+                                continue;
+                            if ((clret = LoadCorrectionTable(WDcfg.TablesFilenames[gr], &(X742Tables[gr]))) != 0)
+                                printf("Error [%d] loading custom table from file '%s' for group [%u].\n", clret, WDcfg.TablesFilenames[gr], gr);
+                        }
+                    }
+                    // Save to file the Tables read from flash
+                    GroupMask = (~GroupMask) & ((0x1<<WDcfg.MaxGroupNumber)-1);
+                    SaveCorrectionTables("X742Table", GroupMask, X742Tables);
+                }
+                else { // Use Automatic Corrections
+                    if ((ret = CAEN_DGTZ_LoadDRS4CorrectionData(handle, WDcfg.DRS4Frequency)) != CAEN_DGTZ_Success)
+                        goto QuitProgram;
+                    if ((ret = CAEN_DGTZ_EnableDRS4Correction(handle)) != CAEN_DGTZ_Success)
+                        goto QuitProgram;
+                }
+            }
+        }
 
-    /* First, we get the register value of 0x8000, and then set the 13th bit
-     * to set it in transparent mode. */
-    ret = CAEN_DGTZ_ReadRegister(handle, 0x8000, &data);
+        // Allocate memory for the event data and readout buffer
+        ret = CAEN_DGTZ_AllocateEvent(handle, (void**)&Event742);
 
-    if (ret) {
-        fprintf(stderr, "failed to read register 0x8000!\n");
-        exit(1);
-    }
+        if (ret != CAEN_DGTZ_Success) {
+            ErrCode = ERR_MALLOC;
+            goto QuitProgram;
+        }
 
-    data |= 1 << 13;
-    ret = CAEN_DGTZ_WriteRegister(handle, 0x8000, data);
+        /* WARNING: This malloc must be done after the digitizer programming */
+        ret = CAEN_DGTZ_MallocReadoutBuffer(handle, &buffer,&AllocatedSize);
 
-    if (ret) {
-        fprintf(stderr, "failed to write register 0x8000!\n");
-        exit(1);
-    }
+        if (ret) {
+            ErrCode = ERR_MALLOC;
+            goto QuitProgram;
+        }
 
-    /* Now, we take some data. */
-    CAEN_DGTZ_SWStartAcquisition(handle);
+        usleep(300000);
 
-    for (i = 0; i < BS_SIZE; i++) {
-        CAEN_DGTZ_SendSWtrigger(handle);
-        usleep(10000);
-    }
+        CAEN_DGTZ_SWStopAcquisition(handle);
 
-    /* Read data from the board */
-    ret = CAEN_DGTZ_ReadData(handle, CAEN_DGTZ_SLAVE_TERMINATED_READOUT_MBLT, buffer, &BufferSize);
+        /* First, in order to self-trigger we need to set the digitizer into
+         * transparent mode and read some data from the board to get an idea of
+         * the un-calibrated baseline.
+         *
+         * See page 35 of the DT5742 manual. */
 
-    CAEN_DGTZ_SWStopAcquisition(handle);
+        /* First, we get the register value of 0x8000, and then set the 13th bit
+         * to set it in transparent mode. */
+        ret = CAEN_DGTZ_ReadRegister(handle, 0x8000, &data);
 
-    if (ret) {
-        fprintf(stderr, "error reading data in transparent mode!\n");
-        exit(1);
-    }
+        if (ret) {
+            fprintf(stderr, "failed to read register 0x8000!\n");
+            exit(1);
+        }
 
-    NumEvents = 0;
-    if (BufferSize != 0) {
-        ret = CAEN_DGTZ_GetNumEvents(handle, buffer, BufferSize, &NumEvents);
+        data |= 1 << 13;
+        ret = CAEN_DGTZ_WriteRegister(handle, 0x8000, data);
 
         if (ret) {
-            fprintf(stderr, "error calling CAEN_DGTZ_GetNumEvents()!\n");
+            fprintf(stderr, "failed to write register 0x8000!\n");
             exit(1);
         }
-    } else {
-        fprintf(stderr, "error: didn't get any events when in transparent mode! quitting...\n");
-        exit(1);
-    }
 
-    static float wfdata[WF_SIZE][32][1024];
-    static float bdata[BS_SIZE][32][1024];
-    float baselines[32];
-    float thresholds[16];
+        /* Now, we take some data. */
+        CAEN_DGTZ_SWStartAcquisition(handle);
 
-    int nsamples = 0;
+        for (i = 0; i < BS_SIZE; i++) {
+            CAEN_DGTZ_SendSWtrigger(handle);
+            usleep(10000);
+        }
+
+        /* Read data from the board */
+        ret = CAEN_DGTZ_ReadData(handle, CAEN_DGTZ_SLAVE_TERMINATED_READOUT_MBLT, buffer, &BufferSize);
 
-    if (NumEvents > WF_SIZE)
-        NumEvents = WF_SIZE;
-    /* Analyze the data we got from transparent mode*/
-    for(i = 0; i < NumEvents; i++) {
-        /* Get one event from the readout buffer */
-        ret = CAEN_DGTZ_GetEventInfo(handle, buffer, BufferSize, i, &EventInfo, &EventPtr);
+        CAEN_DGTZ_SWStopAcquisition(handle);
 
         if (ret) {
-            fprintf(stderr, "error calling CAEN_DGTZ_GetEventInfo()!\n");
+            fprintf(stderr, "error reading data in transparent mode!\n");
             exit(1);
         }
 
-        ret = CAEN_DGTZ_DecodeEvent(handle, EventPtr, (void**)&Event742);
+        NumEvents = 0;
+        if (BufferSize != 0) {
+            ret = CAEN_DGTZ_GetNumEvents(handle, buffer, BufferSize, &NumEvents);
 
-        if (ret) {
-            fprintf(stderr, "error calling CAEN_DGTZ_DecodeEvent()!\n");
+            if (ret) {
+                fprintf(stderr, "error calling CAEN_DGTZ_GetNumEvents()!\n");
+                exit(1);
+            }
+        } else {
+            fprintf(stderr, "error: didn't get any events when in transparent mode! quitting...\n");
             exit(1);
         }
 
-        for (int gr = 0; gr < (WDcfg.Nch/8); gr++) {
-            if (Event742->GrPresent[gr]) {
-                for (ch = 0; ch < 8; ch++) {
-                    int Size = Event742->DataGroup[gr].ChSize[ch];
+        if (NumEvents > BS_SIZE)
+            NumEvents = BS_SIZE;
+        /* Analyze the data we got from transparent mode*/
+        for(i = 0; i < NumEvents; i++) {
+            /* Get one event from the readout buffer */
+            ret = CAEN_DGTZ_GetEventInfo(handle, buffer, BufferSize, i, &EventInfo, &EventPtr);
 
-                    if (Size <= 0)
-                        continue;
+            if (ret) {
+                fprintf(stderr, "error calling CAEN_DGTZ_GetEventInfo()!\n");
+                exit(1);
+            }
 
-                    nsamples = Size;
+            ret = CAEN_DGTZ_DecodeEvent(handle, EventPtr, (void**)&Event742);
 
-                    for (int j = 0; j < Size; j++) {
-                        bdata[i][gr*8 + ch][j] = Event742->DataGroup[gr].DataChannel[ch][j];
+            if (ret) {
+                fprintf(stderr, "error calling CAEN_DGTZ_DecodeEvent()!\n");
+                exit(1);
+            }
+
+            for (int gr = 0; gr < (WDcfg.Nch/8); gr++) {
+                if (Event742->GrPresent[gr]) {
+                    for (ch = 0; ch < 8; ch++) {
+                        int Size = Event742->DataGroup[gr].ChSize[ch];
+
+                        if (Size <= 0)
+                            continue;
+
+                        nsamples = Size;
+
+                        for (int j = 0; j < Size; j++) {
+                            bdata[i][offset + gr*8 + ch][j] = Event742->DataGroup[gr].DataChannel[ch][j];
+                        }
                     }
+                } else {
+                    fprintf(stderr, "Warning: missing baseline data for group %i for event %i\n", gr, i);
                 }
-            } else {
-                fprintf(stderr, "Warning: missing baseline data for group %i for event %i\n", gr, i);
             }
         }
-    }
 
-    /* Do we still want to get baselines like this when there will
-     * be a source in the dark box? It might average some SPEs or
-     * a 511 signal */
-    get_baselines(bdata, baselines, NumEvents, channel_mask, nsamples);
+        /* Do we still want to get baselines like this when there will
+         * be a source in the dark box? It might average some SPEs or
+         * a 511 signal */
+        get_baselines(bdata, baselines, NumEvents, board_mask << offset, nsamples);
 
-    printf("Baselines for channels:\n");
-    for (i = 0; i < 32; i++)
-        printf("    ch %2i = %.0f\n", i, baselines[i]);
+        printf("Baselines for channels:\n");
+        for (i = 0; i < BOARD_NCHANNELS; i++)
+            printf("    ch %2i = %.0f\n", offset + i, baselines[offset + i]);
 
-    for (i = 0; i < 16; i++)
-        thresholds[i] = 1e99;
+        for (i = 0; i < 16; i++)
+            thresholds[i] = 1e99;
 
-    /* Since we have to set the offset and threshold for the whole group, we
-     * set the threshold to the minimum baseline for all channels within a
-     * group. */
-    for (i = 0; i < 16; i++) {
-        if (channel_mask & (1 << i)) {
-            thresholds[i] = baselines[i];
+        /* Since we have to set the offset and threshold for the whole group, we
+         * set the threshold to the minimum baseline for all channels within a
+         * group. */
+        for (i = 0; i < 16; i++) {
+            if (board_mask & (1 << i)) {
+                thresholds[i] = baselines[offset + i];
+            }
         }
-    }
 
-    /* This is how the CAEN API says to set self-triggers, but we found that
-     * it didn't work, so we wrote directly to the registers instead. Maybe
-     * it has to do with the order in which we're programming the digitizer.
-     * These types of functions are usually called in `Program_Digitizer`.
-     */
-    // ret = CAEN_DGTZ_SetChannelSelfTrigger(handle, CAEN_DGTZ_TRGMODE_ACQ_ONLY, 0xffff);
-    // 
-    // if (ret) {
-    //     fprintf(stderr, "failed to set self trigger!\n");
-    //     exit(1);
-    // }
+        /* This is how the CAEN API says to set self-triggers, but we found that
+         * it didn't work, so we wrote directly to the registers instead. Maybe
+         * it has to do with the order in which we're programming the digitizer.
+         * These types of functions are usually called in `Program_Digitizer`.
+         */
+        // ret = CAEN_DGTZ_SetChannelSelfTrigger(handle, CAEN_DGTZ_TRGMODE_ACQ_ONLY, 0xffff);
+        // 
+        // if (ret) {
+        //     fprintf(stderr, "failed to set self trigger!\n");
+        //     exit(1);
+        // }
     
-    /* Set the channels to trigger on themselves */
-    if (strcmp(trig_type, "self") == 0) {
-        /* Page 45 of UM4270_DT5742_UserManual_rev10.pdf gives the
-         * instructions of how to set up self-trigger. */
-        int units_per_volt = (int) pow(2, (double) BoardInfo.ADC_NBits);
-        for (i = 0; i < 16; i++) {
-            thresholds[i] += threshold*units_per_volt;
-
-            if (thresholds[i] < 1e99) {
-                int group = i/8;
-                int channel = i % 8;
-                /* This sets the trigger level */
-                printf("setting trigger threshold for channel %i to %i\n", i, (int) thresholds[i]);
-                ret = CAEN_DGTZ_WriteRegister(handle, 0x1080 + 256*group, (channel << 12) | ((int) thresholds[i] & 0xfff));
+        /* Set the channels to trigger on themselves */
+        if (strcmp(trig_type, "self") == 0) {
+            /* Page 45 of UM4270_DT5742_UserManual_rev10.pdf gives the
+             * instructions of how to set up self-trigger. */
+            int units_per_volt = (int) pow(2, (double) BoardInfo.ADC_NBits);
+            for (i = 0; i < 16; i++) {
+                thresholds[i] += threshold*units_per_volt;
+
+                if (thresholds[i] < 1e99) {
+                    int group = i/8;
+                    int channel = i % 8;
+                    /* This sets the trigger level */
+                    printf("setting trigger threshold for channel %i to %i\n", i, (int) thresholds[i]);
+                    ret = CAEN_DGTZ_WriteRegister(handle, 0x1080 + 256*group, (channel << 12) | ((int) thresholds[i] & 0xfff));
+
+                    if (ret) {
+                        fprintf(stderr, "failed to write register 0x%04x!\n", 0x1080 + 256*group);
+                        exit(1);
+                    }
+                } else {
+                    ret = CAEN_DGTZ_WriteRegister(handle, 0x10A8 + 256*i, 0);
 
-                if (ret) {
-                    fprintf(stderr, "failed to write register 0x%04x!\n", 0x1080 + 256*group);
-                    exit(1);
+                    if (ret) {
+                        fprintf(stderr, "failed to write register 0x%04x!\n", 0x10A8 + 256*i);
+                        exit(1);
+                    }
                 }
-            } else {
-                ret = CAEN_DGTZ_WriteRegister(handle, 0x10A8 + 256*i, 0);
+            }
+
+            for (i = 0; i < 2; i++) {
+                /* This sets which channels are allowed to cause a trigger
+                 * event. If a channel is not allowed, then even if it crosses
+                 * the trigger threshold, the event will not be acquired.
+                 *
+                 * When at least one channel in a group causes a trigger event,
+                 * then the signal from all the channels in that group are
+                 * acquired. */
+                printf("setting channel mask for group %i to 0x%02x\n", i, (int) (board_mask >> i*8) & 0xff);
+                ret = CAEN_DGTZ_WriteRegister(handle, 0x10A8 + 256*i, (int) (board_mask >> i*8) & 0xff);
 
                 if (ret) {
                     fprintf(stderr, "failed to write register 0x%04x!\n", 0x10A8 + 256*i);
@@ -2233,177 +1997,417 @@ int main(int argc, char *argv[])
             }
         }
 
-        for (i = 0; i < 2; i++) {
-            /* This sets which channels are allowed to cause a trigger
-             * event. If a channel is not allowed, then even if it crosses
-             * the trigger threshold, the event will not be acquired.
-             *
-             * When at least one channel in a group causes a trigger event,
-             * then the signal from all the channels in that group are
-             * acquired. */
-            printf("setting channel mask for group %i to 0x%02x\n", i, (int) (channel_mask >> i*8) & 0xff);
-            ret = CAEN_DGTZ_WriteRegister(handle, 0x10A8 + 256*i, (int) (channel_mask >> i*8) & 0xff);
+        /* Deactivating ability to self trigger */
+        if (strcmp(trig_type, "external") == 0 || strcmp(trig_type, "software") == 0) {
+            ret = CAEN_DGTZ_WriteRegister(handle, 0x10A8, 0x00);
+            if (ret)
+                fprintf(stderr, "failed to deactivate triggers!\n");
+            ret = CAEN_DGTZ_WriteRegister(handle, 0x11A8, 0x00);
+            if (ret)
+                fprintf(stderr, "failed to deactivate triggers!\n");
+        }
 
+        /* Enabling external trigger for laser */
+        if (strcmp(trig_type, "external") == 0) {
+            ret = CAEN_DGTZ_ReadRegister(handle, 0x810C, &data);
+            if (ret) {
+                fprintf(stderr, "failed to read register 0x810C!\n");
+                exit(1);
+            }
+            data |= (1 << 30);
+            ret = CAEN_DGTZ_WriteRegister(handle, 0x810C, data);
             if (ret) {
-                fprintf(stderr, "failed to write register 0x%04x!\n", 0x10A8 + 256*i);
+                fprintf(stderr, "failed to write register 0x810C!\n");
+                exit(1);
+            }
+            ret = CAEN_DGTZ_ReadRegister(handle, 0x811C, &data);
+            if (ret) {
+                fprintf(stderr, "failed to read register 0x811C!\n");
+                exit(1);
+            }
+            data |= 1;
+            data &= ~(1 << 10);
+            data &= ~(1 << 11);
+            ret = CAEN_DGTZ_WriteRegister(handle, 0x811C, data);
+            if (ret) {
+                fprintf(stderr, "failed to write register 0x811C!\n");
                 exit(1);
             }
         }
-    }
-
-    /* Deactivating ability to self trigger */
-    if (strcmp(trig_type, "external") == 0 || strcmp(trig_type, "software") == 0) {
-        ret = CAEN_DGTZ_WriteRegister(handle, 0x10A8, 0x00);
-        if (ret)
-            fprintf(stderr, "failed to deactivate triggers!\n");
-        ret = CAEN_DGTZ_WriteRegister(handle, 0x11A8, 0x00);
-        if (ret)
-            fprintf(stderr, "failed to deactivate triggers!\n");
-    }
+    
+        /* Now, we switch back to output mode. */
+        ret = CAEN_DGTZ_ReadRegister(handle, 0x8000, &data);
 
-    /* Enabling external trigger for laser */
-    if (strcmp(trig_type, "external") == 0) {
-        ret = CAEN_DGTZ_ReadRegister(handle, 0x810C, &data);
         if (ret) {
-            fprintf(stderr, "failed to read register 0x810C!\n");
+            fprintf(stderr, "failed to read register 0x8000!\n");
             exit(1);
         }
-        data |= (1 << 30);
-        ret = CAEN_DGTZ_WriteRegister(handle, 0x810C, data);
+
+        data &= ~(1 << 13);
+
+        ret = CAEN_DGTZ_WriteRegister(handle, 0x8000, data);
+
         if (ret) {
-            fprintf(stderr, "failed to write register 0x810C!\n");
+            fprintf(stderr, "failed to write register 0x8000!\n");
             exit(1);
         }
-        ret = CAEN_DGTZ_ReadRegister(handle, 0x811C, &data);
-        if (ret) {
-            fprintf(stderr, "failed to read register 0x811C!\n");
+
+        for (i = 0; i < WDcfg.Nch/8; i++)
+            if (!(WDcfg.EnableMask & (1 << i)))
+                readout_mask &= ~(0xffUL << (offset + i*8));
+
+        if (nsamples != WDcfg.RecordLength) {
+            fprintf(stderr, "got %i samples per channel in transparent mode, but the record length is %i!\n", nsamples, WDcfg.RecordLength);
             exit(1);
         }
-        data |= 1;
-        data &= ~(1 << 10);
-        data &= ~(1 << 11);
-        ret = CAEN_DGTZ_WriteRegister(handle, 0x811C, data);
-        if (ret) {
-            fprintf(stderr, "failed to write register 0x811C!\n");
-            exit(1);
+
+        /* In raw mode, the DRS4 corrections are turned off after the baselines
+         * are measured, and the samples are corrected offline with the
+         * correction tables instead (see drs4_correction.py). If the tables
+         * weren't loaded from the config file, they're read from the flash of
+         * the digitizer. The tables of every digitizer follow those of the one
+         * before, like the channels. */
+        if (raw) {
+            if (WDcfg.useCorrections == -1 && CAEN_DGTZ_GetCorrectionTables(handle, WDcfg.DRS4Frequency, (void*)X742Tables) != CAEN_DGTZ_Success) {
+                fprintf(stderr, "failed to read the DRS4 correction tables!\n");
+                exit(1);
+            }
+
+            if (CAEN_DGTZ_DisableDRS4Correction(handle) != CAEN_DGTZ_Success) {
+                fprintf(stderr, "failed to disable the DRS4 corrections!\n");
+                exit(1);
+            }
+
+            for (i = 0; i < BOARD_NCHANNELS/8; i++)
+                raw_tables[offset/8 + i] = X742Tables[i];
         }
+
+        handles[b] = handle;
+        buffers[b] = buffer;
+        events[b] = Event742;
     }
-    
-    /* Now, we switch back to output mode. */
-    ret = CAEN_DGTZ_ReadRegister(handle, 0x8000, &data);
 
-    if (ret) {
-        fprintf(stderr, "failed to read register 0x8000!\n");
+    if (charge_only && charge_window_init(&charge_window, &WDcfg, WDcfg.RecordLength, start_time, integration_time)) {
+        fprintf(stderr, "invalid integration window! quitting...\n");
         exit(1);
     }
 
-    data &= ~(1 << 13);
+    /* With several digitizers, the acquisition of all but the first one is
+     * started by the one before it through the S-IN input, so that their
+     * trigger time tags are reset at the same time, and the first one is
+     * started by software. */
+    if (nboards > 1) {
+        for (b = 0; b < nboards; b++) {
+            ret = CAEN_DGTZ_SetAcquisitionMode(handles[b], b == 0 ? CAEN_DGTZ_SW_CONTROLLED : CAEN_DGTZ_S_IN_CONTROLLED);
+            if (b < nboards - 1)
+                ret |= CAEN_DGTZ_SetRunSynchronizationMode(handles[b], CAEN_DGTZ_RUN_SYNC_TrgOutSinDaisyChain);
 
-    ret = CAEN_DGTZ_WriteRegister(handle, 0x8000, data);
+            if (ret) {
+                fprintf(stderr, "failed to set up the run synchronization of digitizer %i!\n", b);
+                exit(1);
+            }
+        }
+    }
 
-    if (ret) {
-        fprintf(stderr, "failed to write register 0x8000!\n");
+    /* The software triggers are set up before the output file is opened,
+     * since the writer writes their rate to it, but only started once the
+     * acquisition is running. */
+    memset(&trigger, 0, sizeof(trigger));
+    if (strcmp(trig_type, "software") == 0 && trigger_init(&trigger, handles[0], trigger_rate)) {
+        fprintf(stderr, "failed to set up the software triggers! quitting...\n");
         exit(1);
     }
 
-    CAEN_DGTZ_SWStartAcquisition(handle);
+    /* Open the output file and start the writer thread. */
+    if (writer_open(&writer, output_filename, label, bdata, readout_mask, WDcfg.RecordLength, &WDcfg, gzip_compression_level, starting_channel, nbuffers, batch_size, uint16, charge_only ? &charge_window : NULL, prescale, swmr, raw ? raw_tables : NULL, nboards*BOARD_NCHANNELS/8, strcmp(trig_type, "software") == 0 ? &trigger : NULL, &telemetry)) {
+        fprintf(stderr, "failed to open output file! quitting...\n");
+        exit(1);
+    }
+
+    /* The last digitizer is started first, so that all of the others are
+     * armed when the first one starts them. */
+    for (b = nboards - 1; b >= 0; b--)
+        CAEN_DGTZ_SWStartAcquisition(handles[b]);
+
+    /* Software triggers (for SPE runs without the laser) are sent at a fixed
+     * rate by a separate thread, so the trigger rate doesn't depend on how
+     * long the readout and the writer take. With several digitizers, they're
+     * sent to the first one, which passes them on to the others. */
+    telemetry_init(&telemetry, stats_interval);
+    if (strcmp(trig_type, "software") == 0 && trigger_start(&trigger)) {
+        fprintf(stderr, "failed to start the software triggers! quitting...\n");
+        exit(1);
+    }
+
+    /* With several digitizers, every one is read out by its own thread, and
+     * their events are put together by trigger time. */
+    if (nboards > 1 && builder_start(&builder, handles, buffers, events, nboards, readout_mask, WDcfg.RecordLength, time_window, &trigger)) {
+        fprintf(stderr, "failed to start the readout of the digitizers! quitting...\n");
+        exit(1);
+    }
 
-    /* Now, we go into the main loop where we get events. */
+    /* Now, we go into the main loop where we get events. The events are
+     * copied into a buffer from the writer until it holds `batch_size`
+     * events, which may take several readouts, and then handed to the writer
+     * thread, which writes them while we read out the next events.
+     *
+     * With --charge-only, the waveforms are integrated here, and only the
+     * charges and every `prescale`th waveform are copied to the buffer. */
 
     int nread = 0;
-    while (!stop && total_events < nevents) {
-        if (strcmp(trig_type, "software") == 0) {
-            /* Sending software triggers for SPE analysis without laser */
-            printf("sending sw trigger\n");
-            for (i = 0; i < 100; i++) {
-                usleep(1000);
-                CAEN_DGTZ_SendSWtrigger(handle);
+    if (nboards > 1) {
+        while (!stop && total_events < nevents) {
+            if (trigger.error) {
+                ErrCode = ERR_READOUT;
+                break;
             }
-        }
 
-        ret = CAEN_DGTZ_ReadData(handle, CAEN_DGTZ_SLAVE_TERMINATED_READOUT_MBLT, buffer, &BufferSize);
+            ret = builder_next(&builder, 0.01);
 
-        if (ret) {
-            fprintf(stderr, "error calling CAEN_DGTZ_ReadData()!\n");
-            exit(1);
-        }
+            if (ret < 0) {
+                ErrCode = ERR_READOUT;
+                break;
+            }
 
-        NumEvents = 0;
-        if (BufferSize != 0) {
-            ret = CAEN_DGTZ_GetNumEvents(handle, buffer, BufferSize, &NumEvents);
+            telemetry.bytes_read = builder_bytes_read(&builder);
+            telemetry_print(&telemetry, total_events, nevents);
 
-            if (ret) {
-                fprintf(stderr, "error calling CAEN_DGTZ_GetNumEvents()!\n");
-                exit(1);
+            if (ret == 0)
+                continue;
+
+            if (wbuf == NULL) {
+                if ((wbuf = writer_get_buffer(&writer)) == NULL) {
+                    ErrCode = ERR_OUTFILE_WRITE;
+                    break;
+                }
+                nread = 0;
+                nwaveforms = 0;
+            }
+
+            int keep = !charge_only || total_events % prescale == 0;
+
+            /* Copy the waveforms of every digitizer into the buffer. The
+             * readout threads already decoded them. */
+            t0 = get_time();
+            for (b = 0; b < nboards; b++) {
+                for (ch = 0; ch < BOARD_NCHANNELS; ch++) {
+                    int channel = b*BOARD_NCHANNELS + ch;
+                    float *y = builder_samples(&builder, b, ch);
+
+                    if (!(readout_mask & (1UL << channel)))
+                        continue;
+
+                    if (charge_only)
+                        writer_charges(&writer, wbuf, channel)[nread] = charge_integrate(&charge_window, y);
+
+                    if (keep)
+                        memcpy(writer_samples(&writer, wbuf, channel, nwaveforms), y, writer.nsamples*sizeof(float));
+
+                    if (raw)
+                        writer_start_cells(&writer, wbuf, channel)[nwaveforms] = builder_start_cell(&builder, b, ch);
+                }
+            }
+            builder_release(&builder);
+            telemetry_add(&telemetry, TELEMETRY_COPY, get_time() - t0);
+
+            nread += 1;
+            nwaveforms += keep;
+            total_events += 1;
+
+            /* Hand the full buffer to the writer thread. */
+            if (nread == batch_size) {
+                printf("writing %i events to file\n", nread);
+                if (writer_submit(&writer, nread, nwaveforms)) {
+                    fprintf(stderr, "failed to write events to file! quitting...\n");
+                    ErrCode = ERR_OUTFILE_WRITE;
+                    break;
+                }
+                wbuf = NULL;
+                nread = 0;
             }
         }
 
-        if (NumEvents > WF_SIZE)
-            NumEvents = WF_SIZE;
-        printf("got %i events\n", NumEvents);
-	printf("%i / %i\n", total_events + NumEvents, nevents);
+        /* The readout threads have to be stopped before the software
+         * triggers, since they hold the trigger lock while they read out the
+         * digitizers. The readout and decode stages of every digitizer are
+         * added to those of the run. */
+        builder_stop(&builder);
+        telemetry.events = builder.nbuilt;
+        telemetry.bytes_read = builder_bytes_read(&builder);
+        for (b = 0; b < nboards; b++)
+            telemetry_merge_stages(&telemetry, &builder.boards[b].telemetry);
+    } else {
+        while (!stop && total_events < nevents) {
+            if (trigger.error) {
+                ErrCode = ERR_READOUT;
+                break;
+            }
 
-        /* Analyze data */
-        nread = 0;
-        for (i = 0; i < NumEvents; i++) {
-            /* Get one event from the readout buffer */
-            ret = CAEN_DGTZ_GetEventInfo(handle, buffer, BufferSize, i, &EventInfo, &EventPtr);
+            ret = read_events(handle, buffer, &BufferSize, &NumEvents, &trigger, &telemetry);
 
             if (ret) {
-                fprintf(stderr, "error calling CAEN_DGTZ_GetEventInfo()!\n");
-                exit(1);
+                ErrCode = ERR_READOUT;
+                break;
             }
 
-            ret = CAEN_DGTZ_DecodeEvent(handle, EventPtr, (void**)&Event742);
+            telemetry_print(&telemetry, total_events + NumEvents, nevents);
 
-            if (ret) {
-                fprintf(stderr, "error calling CAEN_DGTZ_DecodeEvent()!\n");
-                exit(1);
+            if (NumEvents == 0) {
+                usleep(1000);
+                continue;
             }
 
-            for (int gr = 0; gr < (WDcfg.Nch/8); gr++) {
-                if (Event742->GrPresent[gr]) {
-                    for (ch = 0; ch < 8; ch++) {
-                        int Size = Event742->DataGroup[gr].ChSize[ch];
+            /* Analyze data. The time spent decoding and copying the events is
+             * summed over the readout. */
+            decode_time = 0;
+            copy_time = 0;
+            for (i = 0; i < NumEvents; i++) {
+                /* Get an empty buffer from the writer. This only blocks if the
+                 * writer thread is still busy with all of the other buffers. */
+                if (wbuf == NULL) {
+                    if ((wbuf = writer_get_buffer(&writer)) == NULL) {
+                        ErrCode = ERR_OUTFILE_WRITE;
+                        break;
+                    }
+                    nread = 0;
+                    nwaveforms = 0;
+                }
 
-                        if (Size <= 0)
-                            continue;
+                int keep = !charge_only || total_events % prescale == 0;
 
-                        nsamples = Size;
+                /* Get one event from the readout buffer */
+                t0 = get_time();
+                ret = CAEN_DGTZ_GetEventInfo(handle, buffer, BufferSize, i, &EventInfo, &EventPtr);
 
-                        for (int j = 0; j < Size; j++) {
-                            wfdata[nread][gr*8 + ch][j] = Event742->DataGroup[gr].DataChannel[ch][j];
+                if (ret) {
+                    fprintf(stderr, "error calling CAEN_DGTZ_GetEventInfo()!\n");
+                    ErrCode = ERR_EVENT_BUILD;
+                    break;
+                }
+
+                ret = CAEN_DGTZ_DecodeEvent(handle, EventPtr, (void**)&Event742);
+
+                if (ret) {
+                    fprintf(stderr, "error calling CAEN_DGTZ_DecodeEvent()!\n");
+                    ErrCode = ERR_EVENT_BUILD;
+                    break;
+                }
+
+                t1 = get_time();
+                decode_time += t1 - t0;
+
+                for (int gr = 0; gr < (WDcfg.Nch/8); gr++) {
+                    if (Event742->GrPresent[gr]) {
+                        for (ch = 0; ch < 8; ch++) {
+                            int Size = Event742->DataGroup[gr].ChSize[ch];
+
+                            if (Size <= 0 || !(readout_mask & (1 << (gr*8 + ch))))
+                                continue;
+
+                            if (Size != writer.nsamples) {
+                                fprintf(stderr, "got %i samples for channel %i, but the record length is %i!\n", Size, gr*8 + ch, writer.nsamples);
+                                ErrCode = ERR_EVENT_BUILD;
+                                break;
+                            }
+
+                            if (charge_only)
+                                writer_charges(&writer, wbuf, gr*8 + ch)[nread] = charge_integrate(&charge_window, Event742->DataGroup[gr].DataChannel[ch]);
+
+                            if (keep)
+                                memcpy(writer_samples(&writer, wbuf, gr*8 + ch, nwaveforms), Event742->DataGroup[gr].DataChannel[ch], Size*sizeof(float));
+
+                            if (raw)
+                                writer_start_cells(&writer, wbuf, gr*8 + ch)[nwaveforms] = Event742->DataGroup[gr].StartIndexCell;
                         }
+                    } else {
+                        fprintf(stderr, "Warning: missing data for group %i for event %i\n", gr, total_events);
                     }
-                } else {
-                    fprintf(stderr, "Warning: missing data for group %i for event %i\n", gr, nread);
+                }
+
+                copy_time += get_time() - t1;
+
+                if (ErrCode)
+                    break;
+
+                nread += 1;
+                nwaveforms += keep;
+                total_events += 1;
+
+                /* Hand the full buffer to the writer thread. */
+                if (nread == batch_size) {
+                    printf("writing %i events to file\n", nread);
+                    if (writer_submit(&writer, nread, nwaveforms)) {
+                        fprintf(stderr, "failed to write events to file! quitting...\n");
+                        ErrCode = ERR_OUTFILE_WRITE;
+                        break;
+                    }
+                    wbuf = NULL;
+                    nread = 0;
                 }
             }
-            nread += 1;
-        }
+
+            telemetry_add(&telemetry, TELEMETRY_DECODE, decode_time);
+            telemetry_add(&telemetry, TELEMETRY_COPY, copy_time);
+
+            if (ErrCode)
+                break;
 	
-        if (nread > 0) {
-            printf("writing %i events to file\n", nread);
-            if (add_to_output_file(output_filename, label, wfdata, bdata, nread, channel_mask, nsamples, &WDcfg, gzip_compression_level, starting_channel)) {
-                fprintf(stderr, "failed to write events to file! quitting...\n");
-                exit(1);
-            }
+            usleep(1000);
         }
 
-        total_events += nread;
-        nread = 0;
-	
-        usleep(1000);
     }
 
-    if (stop)
-        fprintf(stderr, "ctrl-c caught. writing out %i events\n", nread);
+    /* Stop the software triggers and count the events they left in the
+     * memory of the digitizer as accepted. These aren't written, since the
+     * run already has enough events. */
+    if (trigger.running) {
+        trigger_stop(&trigger);
+        for (b = 0; b < nboards && !ErrCode; b++) {
+            if (read_events(handles[b], buffers[b], &BufferSize, &NumEvents, &trigger, NULL) == 0 && NumEvents > 0)
+                printf("discarding %i events left in digitizer %i\n", NumEvents, b);
+        }
+        trigger_summary(&trigger);
+    }
+
+    if (nboards > 1)
+        builder_summary(&builder);
+
+    /* Write out the last partial batch. */
+    if (wbuf != NULL && nread > 0) {
+        printf("writing %i events to file\n", nread);
+        if (writer_submit(&writer, nread, nwaveforms)) {
+            fprintf(stderr, "failed to write events to file!\n");
+            if (!ErrCode)
+                ErrCode = ERR_OUTFILE_WRITE;
+        }
+    }
 
-    if (nread > 0 && add_to_output_file(output_filename, label, wfdata, bdata, nread, channel_mask, nsamples, &WDcfg, gzip_compression_level, starting_channel)) {
+    if (stop)
+        fprintf(stderr, "ctrl-c caught. writing out the remaining events\n");
+
+    /* Without software triggers, we can't tell how many triggers the
+     * digitizer lost, but its memory can only fill up while the readout is
+     * waiting for the writer. */
+    if (strcmp(trig_type, "software") == 0)
+        telemetry_stop(&telemetry, trigger_live_time(&trigger));
+    else
+        telemetry_stop(&telemetry, telemetry_get_time() - telemetry.start_time - telemetry.time[TELEMETRY_WAIT]);
+
+    for (b = 0; b < nboards; b++)
+        CAEN_DGTZ_SWStopAcquisition(handles[b]);
+
+    /* Wait for the writer thread to write out all of the events we've read
+     * and close the output file, even if there was a readout error. */
+    if (writer_close(&writer)) {
         fprintf(stderr, "failed to write events to file!\n");
+        if (!ErrCode)
+            ErrCode = ERR_OUTFILE_WRITE;
     }
 
-    CAEN_DGTZ_SWStopAcquisition(handle);
+    telemetry_summary(&telemetry);
+
+    if (ErrCode)
+        goto QuitProgram;
 
     return 0;
 
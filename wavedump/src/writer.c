@@ -0,0 +1,1187 @@
+/* Writes the events from the digitizer to an HDF5 file.
+ *
+ * The file, group, and datasets are opened once at the start of the run and
+ * kept open until the end, and the events are written by a separate thread
+ * (see writer.h). */
+
+#include "writer.h"
+#include <unistd.h> /* for access(). */
+#include <time.h>
+
+char *GitSHA1(void);
+char *GitDirty(void);
+
+static double get_time(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec/1e9;
+}
+
+static int write_int_attr(hid_t group_id, char *name, int value)
+{
+    hid_t aid, attr;
+    herr_t status;
+
+    aid = H5Screate(H5S_SCALAR);
+    attr = H5Acreate2(group_id, name, H5T_NATIVE_INT, aid, H5P_DEFAULT, H5P_DEFAULT);
+    status = H5Awrite(attr, H5T_NATIVE_INT, &value);
+    H5Aclose(attr);
+    H5Sclose(aid);
+
+    if (status) {
+        fprintf(stderr, "failed to write %s to hdf5 file.\n", name);
+        return 1;
+    }
+
+    return 0;
+}
+
+static int write_float_attr(hid_t group_id, char *name, float value)
+{
+    hid_t aid, attr;
+    herr_t status;
+
+    aid = H5Screate(H5S_SCALAR);
+    attr = H5Acreate2(group_id, name, H5T_NATIVE_FLOAT, aid, H5P_DEFAULT, H5P_DEFAULT);
+    status = H5Awrite(attr, H5T_NATIVE_FLOAT, &value);
+    H5Aclose(attr);
+    H5Sclose(aid);
+
+    if (status) {
+        fprintf(stderr, "failed to write %s to hdf5 file.\n", name);
+        return 1;
+    }
+
+    return 0;
+}
+
+static int write_string_attr(hid_t group_id, char *name, char *value)
+{
+    hid_t aid, atype, attr;
+    herr_t status;
+
+    aid = H5Screate(H5S_SCALAR);
+    atype = H5Tcopy(H5T_C_S1);
+    H5Tset_size(atype, 100);
+    H5Tset_strpad(atype, H5T_STR_NULLTERM);
+    attr = H5Acreate2(group_id, name, atype, aid, H5P_DEFAULT, H5P_DEFAULT);
+    status = H5Awrite(attr, atype, value);
+    H5Aclose(attr);
+    H5Tclose(atype);
+    H5Sclose(aid);
+
+    if (status) {
+        fprintf(stderr, "failed to write %s to hdf5 file.\n", name);
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Reads the scalar attribute `name` into `value` if it exists. */
+static int read_attr(hid_t group_id, char *name, hid_t type, void *value)
+{
+    hid_t attr;
+    herr_t status;
+
+    if (H5Aexists(group_id, name) <= 0)
+        return 0;
+
+    attr = H5Aopen(group_id, name, H5P_DEFAULT);
+    status = H5Aread(attr, type, value);
+    H5Aclose(attr);
+
+    if (status) {
+        fprintf(stderr, "failed to read %s from hdf5 file.\n", name);
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Writes the scalar attribute `name`, creating it if it doesn't exist yet.
+ * Existing attributes can still be written in SWMR mode. */
+static int update_attr(hid_t group_id, char *name, hid_t type, void *value)
+{
+    hid_t aid, attr;
+    herr_t status;
+
+    if (H5Aexists(group_id, name) > 0) {
+        attr = H5Aopen(group_id, name, H5P_DEFAULT);
+    } else {
+        aid = H5Screate(H5S_SCALAR);
+        attr = H5Acreate2(group_id, name, type, aid, H5P_DEFAULT, H5P_DEFAULT);
+        H5Sclose(aid);
+    }
+    status = H5Awrite(attr, type, value);
+    H5Aclose(attr);
+
+    if (status) {
+        fprintf(stderr, "failed to write %s to hdf5 file.\n", name);
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Reads the software trigger statistics of the previous runs written to the
+ * group, which the statistics of this run are added to. */
+static int read_trigger_attrs(Writer_t *w)
+{
+    WriterTriggerStats_t *s = &w->trigger_base;
+    double mean = 0;
+
+    memset(s, 0, sizeof(WriterTriggerStats_t));
+
+    if (read_attr(w->group, "sw_triggers_requested", H5T_NATIVE_LONG, &s->requested) ||
+        read_attr(w->group, "sw_triggers_sent", H5T_NATIVE_LONG, &s->sent) ||
+        read_attr(w->group, "sw_triggers_missed", H5T_NATIVE_LONG, &s->missed) ||
+        read_attr(w->group, "sw_triggers_accepted", H5T_NATIVE_LONG, &s->accepted) ||
+        read_attr(w->group, "sw_trigger_time", H5T_NATIVE_DOUBLE, &s->time) ||
+        read_attr(w->group, "live_time", H5T_NATIVE_DOUBLE, &s->live_time) ||
+        read_attr(w->group, "readouts", H5T_NATIVE_LONG, &s->readouts) ||
+        read_attr(w->group, "readout_latency_mean", H5T_NATIVE_DOUBLE, &mean) ||
+        read_attr(w->group, "readout_latency_max", H5T_NATIVE_DOUBLE, &s->readout_max))
+        return 1;
+
+    s->readout_time = mean*s->readouts;
+
+    return 0;
+}
+
+/* Writes the software trigger statistics of every run written to the group:
+ * the target rate of the last run, the number of triggers requested, sent,
+ * missed by the trigger thread, and accepted by the digitizer, the time during which triggers were sent,
+ * the dead time and live time, and the number of readouts and their mean
+ * and maximum latency (s). */
+static int write_trigger_attrs(Writer_t *w, WriterTriggerStats_t *s)
+{
+    double dead_time, mean;
+
+    /* The same as `trigger_dead_time()` */
+    dead_time = s->sent ? 1 - (double) s->accepted/s->sent : 0;
+    if (dead_time < 0)
+        dead_time = 0;
+    mean = s->readouts ? s->readout_time/s->readouts : 0;
+
+    if (update_attr(w->group, "sw_trigger_rate", H5T_NATIVE_DOUBLE, &w->trigger->rate) ||
+        update_attr(w->group, "sw_triggers_requested", H5T_NATIVE_LONG, &s->requested) ||
+        update_attr(w->group, "sw_triggers_sent", H5T_NATIVE_LONG, &s->sent) ||
+        update_attr(w->group, "sw_triggers_missed", H5T_NATIVE_LONG, &s->missed) ||
+        update_attr(w->group, "sw_triggers_accepted", H5T_NATIVE_LONG, &s->accepted) ||
+        update_attr(w->group, "sw_trigger_time", H5T_NATIVE_DOUBLE, &s->time) ||
+        update_attr(w->group, "dead_time", H5T_NATIVE_DOUBLE, &dead_time) ||
+        update_attr(w->group, "live_time", H5T_NATIVE_DOUBLE, &s->live_time) ||
+        update_attr(w->group, "readouts", H5T_NATIVE_LONG, &s->readouts) ||
+        update_attr(w->group, "readout_latency_mean", H5T_NATIVE_DOUBLE, &mean) ||
+        update_attr(w->group, "readout_latency_max", H5T_NATIVE_DOUBLE, &s->readout_max))
+        return 1;
+
+    return 0;
+}
+
+/* Reads the telemetry of the previous runs written to the group, which the
+ * telemetry of this run is added to. */
+static int read_telemetry(Writer_t *w)
+{
+    Telemetry_t *t = &w->telemetry_base;
+    hid_t group, dset;
+    herr_t status = 0;
+    double run_time = 0;
+    char name[256];
+    int i;
+
+    memset(t, 0, sizeof(Telemetry_t));
+
+    if (H5Lexists(w->group, "telemetry", H5P_DEFAULT) <= 0)
+        return 0;
+
+    group = H5Gopen(w->group, "telemetry", H5P_DEFAULT);
+
+    dset = H5Dopen(group, "latency", H5P_DEFAULT);
+    status |= H5Dread(dset, H5T_NATIVE_LONG, H5S_ALL, H5S_ALL, H5P_DEFAULT, t->hist);
+    status |= H5Dclose(dset);
+
+    dset = H5Dopen(group, "readout_size", H5P_DEFAULT);
+    status |= H5Dread(dset, H5T_NATIVE_LONG, H5S_ALL, H5S_ALL, H5P_DEFAULT, t->sizes);
+    status |= H5Dclose(dset);
+
+    for (i = 0; i < TELEMETRY_NSTAGES; i++) {
+        sprintf(name, "%s_count", telemetry_stages[i]);
+        status |= read_attr(group, name, H5T_NATIVE_LONG, &t->count[i]);
+        sprintf(name, "%s_time", telemetry_stages[i]);
+        status |= read_attr(group, name, H5T_NATIVE_DOUBLE, &t->time[i]);
+    }
+
+    status |= read_attr(group, "events", H5T_NATIVE_LONG, &t->events);
+    status |= read_attr(group, "bytes_read", H5T_NATIVE_LONG, &t->bytes_read);
+    status |= read_attr(group, "bytes_written", H5T_NATIVE_LONG, &t->bytes_written);
+    status |= read_attr(group, "run_time", H5T_NATIVE_DOUBLE, &run_time);
+    status |= read_attr(group, "live_time", H5T_NATIVE_DOUBLE, &t->live_time);
+    t->stop_time = run_time;
+
+    status |= H5Gclose(group);
+
+    if (status) {
+        fprintf(stderr, "failed to read the telemetry from the hdf5 file. Was it written by a different version of wavedump?\n");
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Creates the `telemetry` group with the latency histograms of every stage
+ * (the `latency` dataset, [stage][bin]), the upper edges of their bins (s),
+ * and the histogram of the number of events per readout. */
+static int create_telemetry(Writer_t *w)
+{
+    hid_t group, space, dset;
+    hsize_t dims[2] = {TELEMETRY_NSTAGES, TELEMETRY_NBINS};
+    herr_t status = 0;
+    double edges[TELEMETRY_NBINS];
+    char stages[100] = "";
+    int i;
+
+    for (i = 0; i < TELEMETRY_NBINS; i++)
+        edges[i] = TELEMETRY_MIN_TIME*pow(10, (double) (i + 1)/TELEMETRY_BINS_PER_DECADE);
+
+    for (i = 0; i < TELEMETRY_NSTAGES; i++) {
+        if (i) strcat(stages, ",");
+        strcat(stages, telemetry_stages[i]);
+    }
+
+    group = H5Gcreate(w->group, "telemetry", H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+
+    space = H5Screate_simple(2, dims, NULL);
+    dset = H5Dcreate(group, "latency", H5T_NATIVE_LONG, space, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    status |= write_string_attr(dset, "stages", stages);
+    status |= H5Dclose(dset);
+    status |= H5Sclose(space);
+
+    space = H5Screate_simple(1, dims + 1, NULL);
+    dset = H5Dcreate(group, "bin_edges", H5T_NATIVE_DOUBLE, space, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    status |= H5Dwrite(dset, H5T_NATIVE_DOUBLE, H5S_ALL, H5S_ALL, H5P_DEFAULT, edges);
+    status |= H5Dclose(dset);
+    status |= H5Sclose(space);
+
+    dims[0] = TELEMETRY_NSIZES;
+    space = H5Screate_simple(1, dims, NULL);
+    dset = H5Dcreate(group, "readout_size", H5T_NATIVE_LONG, space, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    status |= H5Dclose(dset);
+    status |= H5Sclose(space);
+
+    status |= H5Gclose(group);
+
+    if (status) {
+        fprintf(stderr, "failed to create the telemetry group.\n");
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Writes the telemetry of every run written to the group: the histograms,
+ * and as attributes of the `telemetry` group, the number of times each
+ * stage was timed, the total, mean, p50 and p99 time (s), the number of
+ * events and bytes read out and written (before compression), and the run
+ * time and live time (s). */
+static int write_telemetry(Writer_t *w, Telemetry_t *t)
+{
+    hid_t group, dset;
+    herr_t status = 0;
+    double value;
+    char name[256];
+    int i;
+
+    group = H5Gopen(w->group, "telemetry", H5P_DEFAULT);
+
+    dset = H5Dopen(group, "latency", H5P_DEFAULT);
+    status |= H5Dwrite(dset, H5T_NATIVE_LONG, H5S_ALL, H5S_ALL, H5P_DEFAULT, t->hist);
+    status |= H5Dclose(dset);
+
+    dset = H5Dopen(group, "readout_size", H5P_DEFAULT);
+    status |= H5Dwrite(dset, H5T_NATIVE_LONG, H5S_ALL, H5S_ALL, H5P_DEFAULT, t->sizes);
+    status |= H5Dclose(dset);
+
+    for (i = 0; i < TELEMETRY_NSTAGES; i++) {
+        sprintf(name, "%s_count", telemetry_stages[i]);
+        status |= update_attr(group, name, H5T_NATIVE_LONG, &t->count[i]);
+        sprintf(name, "%s_time", telemetry_stages[i]);
+        status |= update_attr(group, name, H5T_NATIVE_DOUBLE, &t->time[i]);
+        sprintf(name, "%s_mean", telemetry_stages[i]);
+        value = t->count[i] ? t->time[i]/t->count[i] : 0;
+        status |= update_attr(group, name, H5T_NATIVE_DOUBLE, &value);
+        sprintf(name, "%s_p50", telemetry_stages[i]);
+        value = telemetry_percentile(t, i, 0.5);
+        status |= update_attr(group, name, H5T_NATIVE_DOUBLE, &value);
+        sprintf(name, "%s_p99", telemetry_stages[i]);
+        value = telemetry_percentile(t, i, 0.99);
+        status |= update_attr(group, name, H5T_NATIVE_DOUBLE, &value);
+    }
+
+    status |= update_attr(group, "events", H5T_NATIVE_LONG, &t->events);
+    status |= update_attr(group, "bytes_read", H5T_NATIVE_LONG, &t->bytes_read);
+    status |= update_attr(group, "bytes_written", H5T_NATIVE_LONG, &t->bytes_written);
+    value = t->stop_time - t->start_time;
+    status |= update_attr(group, "run_time", H5T_NATIVE_DOUBLE, &value);
+    status |= update_attr(group, "live_time", H5T_NATIVE_DOUBLE, &t->live_time);
+
+    status |= H5Gclose(group);
+
+    if (status) {
+        fprintf(stderr, "failed to write the telemetry to the hdf5 file.\n");
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Writes the attributes of a new group such as the record_length,
+ * post_trigger, barcode, and voltage, how the samples are stored, and in
+ * charge-only mode, the integration window and prescale. Only the ones in
+ * UPLOAD_ATTRS in analyze-waveforms have to be the same for the sodium and
+ * SPE data of a run. */
+static int write_group_attrs(hid_t group_id, WaveDumpConfig_t *WDcfg, int uint16, int gzip_compression_level, ChargeWindow_t *charge_window, int prescale, int raw, int starting_channel)
+{
+    int drs4_frequency = get_drs4_frequency(WDcfg->DRS4Frequency);
+
+    if (drs4_frequency < 0) {
+        fprintf(stderr, "unknown DRS4 frequency %i\n", WDcfg->DRS4Frequency);
+        return 1;
+    }
+
+    /* Flag the data as being collected from the CAEN digitizer. */
+    if (write_int_attr(group_id, "record_length", WDcfg->RecordLength) ||
+        write_string_attr(group_id, "data_source", "CAEN") ||
+        write_int_attr(group_id, "post_trigger", WDcfg->PostTrigger) ||
+        write_int_attr(group_id, "drs4_frequency", drs4_frequency) ||
+        write_int_attr(group_id, "barcode", WDcfg->barcode) ||
+        write_float_attr(group_id, "voltage", WDcfg->voltage) ||
+        write_string_attr(group_id, "git_sha1", GitSHA1()) ||
+        write_string_attr(group_id, "git_dirty", GitDirty()) ||
+        write_string_attr(group_id, "encoding", uint16 ? "uint16" : "float32") ||
+        write_int_attr(group_id, "adc_scale", uint16 ? WRITER_ADC_SCALE : 1) ||
+        write_int_attr(group_id, "shuffle", uint16) ||
+        write_int_attr(group_id, "gzip_compression_level", gzip_compression_level) ||
+        write_int_attr(group_id, "starting_channel", starting_channel) ||
+        write_int_attr(group_id, "raw", raw))
+        return 1;
+
+    if (charge_window &&
+        (write_int_attr(group_id, "charge_only", 1) ||
+         write_int_attr(group_id, "prescale", prescale) ||
+         write_float_attr(group_id, "charge_start_time", charge_window->start_time) ||
+         write_float_attr(group_id, "charge_integration_time", charge_window->integration_time) ||
+         write_float_attr(group_id, "charge_baseline_time", CHARGE_BASELINE_TIME)))
+        return 1;
+
+    printf("git sha1 = %s\n", GitSHA1());
+
+    return 0;
+}
+
+/* Writes the baseline data to the file in separate datasets. */
+static int write_baselines(hid_t group_id, char *group_name, float baseline_data[BS_SIZE][WRITER_MAX_CHANNELS][1024], unsigned long chmask, int nsamples, int starting_channel)
+{
+    hid_t baseline_group_id, space, dset;
+    herr_t status;
+    hsize_t dims[2];
+    char baseline_group_name[256];
+    char dset_name[256];
+    float wdata[BS_SIZE][1024];
+    int i, j, k;
+
+    sprintf(baseline_group_name, "baseline_%s", group_name);
+    baseline_group_id = H5Gcreate(group_id, baseline_group_name, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    for (i = 0; i < WRITER_MAX_CHANNELS; i++) {
+        if (!(chmask & (1UL << i))) continue;
+        dims[0] = BS_SIZE;
+        dims[1] = nsamples;
+
+        space = H5Screate_simple(2, dims, dims);
+
+        for (j = 0; j < BS_SIZE; j++)
+            for (k = 0; k < nsamples; k++)
+                wdata[j][k] = baseline_data[j][i][k];
+
+        sprintf(dset_name, "base_ch%i", i+starting_channel);
+
+        dset = H5Dcreate(baseline_group_id, dset_name, H5T_NATIVE_FLOAT, space, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+        status = H5Dwrite(dset, H5T_NATIVE_FLOAT, H5S_ALL, H5S_ALL, H5P_DEFAULT, wdata);
+        H5Dclose(dset);
+        H5Sclose(space);
+
+        if (status) {
+            fprintf(stderr, "error writing baseline data to hdf5 file.\n");
+            H5Gclose(baseline_group_id);
+            return 1;
+        }
+    }
+
+    if (H5Gclose(baseline_group_id)) {
+        fprintf(stderr, "error closing hdf5 resources.\n");
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Writes the DRS4 correction tables of every group of channels of the
+ * digitizer to the `drs4_tables` group, so that the raw samples can be
+ * corrected later (see `drs4_correction.py`). The tables are only written
+ * when the group is created, since they're the same for every run with the
+ * same digitizer and sampling frequency.
+ *
+ * The `ngroups` tables are for the groups of 8 channels starting at channel
+ * 0, so with several digitizers, the tables of every digitizer follow those
+ * of the one before. */
+static int write_correction_tables(hid_t group_id, CAEN_DGTZ_DRS4Correction_t *tables, int ngroups)
+{
+    hid_t tables_group_id, space, dset;
+    herr_t status = 0;
+    hsize_t dims[3] = {ngroups, MAX_X742_CHANNEL_SIZE, 1024};
+    static int16_t cell[WRITER_MAX_GROUPS][MAX_X742_CHANNEL_SIZE][1024];
+    static int8_t nsample[WRITER_MAX_GROUPS][MAX_X742_CHANNEL_SIZE][1024];
+    static float times[WRITER_MAX_GROUPS][1024];
+    int i;
+
+    if (ngroups > WRITER_MAX_GROUPS) {
+        fprintf(stderr, "too many DRS4 correction tables.\n");
+        return 1;
+    }
+
+    for (i = 0; i < ngroups; i++) {
+        memcpy(cell[i], tables[i].cell, sizeof(cell[i]));
+        memcpy(nsample[i], tables[i].nsample, sizeof(nsample[i]));
+        memcpy(times[i], tables[i].time, sizeof(times[i]));
+    }
+
+    tables_group_id = H5Gcreate(group_id, "drs4_tables", H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+
+    space = H5Screate_simple(3, dims, NULL);
+    dset = H5Dcreate(tables_group_id, "cell", H5T_NATIVE_SHORT, space, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    status |= H5Dwrite(dset, H5T_NATIVE_SHORT, H5S_ALL, H5S_ALL, H5P_DEFAULT, cell);
+    H5Dclose(dset);
+    dset = H5Dcreate(tables_group_id, "nsample", H5T_NATIVE_SCHAR, space, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    status |= H5Dwrite(dset, H5T_NATIVE_SCHAR, H5S_ALL, H5S_ALL, H5P_DEFAULT, nsample);
+    H5Dclose(dset);
+    H5Sclose(space);
+
+    dims[1] = 1024;
+    space = H5Screate_simple(2, dims, NULL);
+    dset = H5Dcreate(tables_group_id, "time", H5T_NATIVE_FLOAT, space, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+    status |= H5Dwrite(dset, H5T_NATIVE_FLOAT, H5S_ALL, H5S_ALL, H5P_DEFAULT, times);
+    H5Dclose(dset);
+    H5Sclose(space);
+
+    if (status) {
+        fprintf(stderr, "error writing DRS4 correction tables to hdf5 file.\n");
+        H5Gclose(tables_group_id);
+        return 1;
+    }
+
+    if (H5Gclose(tables_group_id)) {
+        fprintf(stderr, "error closing hdf5 resources.\n");
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Creates or opens the one dimensional dataset `name` of `type` for one
+ * value per event with chunks of WRITER_CHARGE_CHUNK events. */
+static hid_t open_event_dataset(hid_t group_id, int create, char *name, hid_t type, int gzip_compression_level)
+{
+    hid_t space, dcpl, dset;
+    hsize_t dims[1], maxdims[1], chunk[1];
+
+    if (!create)
+        return H5Dopen(group_id, name, H5P_DEFAULT);
+
+    dims[0] = 0;
+    maxdims[0] = H5S_UNLIMITED;
+    chunk[0] = WRITER_CHARGE_CHUNK;
+    space = H5Screate_simple(1, dims, maxdims);
+
+    dcpl = H5Pcreate(H5P_DATASET_CREATE);
+    H5Pset_deflate(dcpl, gzip_compression_level);
+    H5Pset_chunk(dcpl, 1, chunk);
+
+    dset = H5Dcreate(group_id, name, type, space, H5P_DEFAULT, dcpl, H5P_DEFAULT);
+
+    H5Pclose(dcpl);
+    H5Sclose(space);
+
+    return dset;
+}
+
+/* Creates or opens the `charge_chN` dataset of channel `i` in charge-only
+ * mode. Events can only be appended to an existing group if it was taken in
+ * the same mode. */
+static int open_charge_dataset(Writer_t *w, int create, int i, int gzip_compression_level, int starting_channel)
+{
+    char dset_name[256];
+
+    sprintf(dset_name, "charge_ch%i", i+starting_channel);
+
+    if (!create && (H5Lexists(w->group, dset_name, H5P_DEFAULT) > 0) != w->charge_only) {
+        fprintf(stderr, "can't append to a group which was%s taken with --charge-only.\n", w->charge_only ? "n't" : "");
+        return 1;
+    }
+
+    if (!w->charge_only)
+        return 0;
+
+    w->charge_dset[i] = open_event_dataset(w->group, create, dset_name, H5T_NATIVE_FLOAT, gzip_compression_level);
+
+    if (w->charge_dset[i] < 0) {
+        fprintf(stderr, "couldn't %s dataset %s.\n", create ? "create" : "open", dset_name);
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Creates or opens the `start_cell_chN` dataset of channel `i` in raw mode.
+ * Like in charge-only mode, events can only be appended to an existing group
+ * if it was taken in the same mode. */
+static int open_start_cell_dataset(Writer_t *w, int create, int i, int gzip_compression_level, int starting_channel)
+{
+    char dset_name[256];
+
+    sprintf(dset_name, "start_cell_ch%i", i+starting_channel);
+
+    if (!create && (H5Lexists(w->group, dset_name, H5P_DEFAULT) > 0) != w->raw) {
+        fprintf(stderr, "can't append to a group which was%s taken with --raw.\n", w->raw ? "n't" : "");
+        return 1;
+    }
+
+    if (!w->raw)
+        return 0;
+
+    w->start_cell_dset[i] = open_event_dataset(w->group, create, dset_name, H5T_NATIVE_USHORT, gzip_compression_level);
+
+    if (w->start_cell_dset[i] < 0) {
+        fprintf(stderr, "couldn't %s dataset %s.\n", create ? "create" : "open", dset_name);
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Creates or opens the datasets for every channel. The default chunk cache
+ * (1 MB) is smaller than a single chunk, which means that every write of a
+ * partial chunk goes straight to disk, i.e. the chunk is read, decompressed,
+ * updated, compressed, and written again for every batch of events. Instead,
+ * the cache is set to hold a few chunks of each dataset so that a chunk is
+ * only compressed and written once it's full (or when the file is closed).
+ *
+ * The samples are 12 bit ADC counts, so in uint16 mode they're stored as
+ * uint16 fixed point numbers (see WRITER_ADC_SCALE) with the shuffle filter
+ * in front of gzip. Shuffling groups the
+ * (mostly constant) high bytes of the samples together, so that even the
+ * fastest gzip level compresses them well.
+ *
+ * In charge-only mode, a one dimensional `charge_chN` dataset is also
+ * created or opened for every channel, and in raw mode a `start_cell_chN`
+ * dataset. */
+static int open_datasets(Writer_t *w, int create, int nsamples, int gzip_compression_level, int starting_channel)
+{
+    hid_t space, dcpl, dapl, dtype;
+    hsize_t dims[2], maxdims[2], chunk[2];
+    char dset_name[256];
+    int i, uint16 = -1;
+
+    if (w->uint16) {
+        chunk[0] = WRITER_UINT16_CHUNK;
+        chunk[1] = nsamples;
+    } else {
+        chunk[0] = 1024;
+        chunk[1] = 1024;
+    }
+
+    /* In charge-only mode only a few waveforms are written per batch, so
+     * the chunks are made small enough that they aren't mostly empty. */
+    if (w->charge_only && chunk[0] > w->max_waveforms)
+        chunk[0] = w->max_waveforms;
+
+    dapl = H5Pcreate(H5P_DATASET_ACCESS);
+    H5Pset_chunk_cache(dapl, 521, WRITER_CACHE_CHUNKS*chunk[0]*chunk[1]*(w->uint16 ? sizeof(uint16_t) : sizeof(float)), 1.0);
+
+    for (i = 0; i < WRITER_MAX_CHANNELS; i++) {
+        if (!(w->chmask & (1UL << i))) continue;
+
+        sprintf(dset_name, "ch%i", i+starting_channel);
+
+        if (create) {
+            /* Create dataspace with unlimited dimensions. */
+            maxdims[0] = H5S_UNLIMITED;
+            maxdims[1] = H5S_UNLIMITED;
+            dims[0] = 0;
+            dims[1] = nsamples;
+            space = H5Screate_simple(2, dims, maxdims);
+
+            /* Create the dataset creation property list, add the gzip
+             * compression filter and set the chunk size. With the full
+             * compression (gzip level 9) the writer can't keep up with the
+             * digitizer, so the default is 0 (no compression). */
+            dcpl = H5Pcreate(H5P_DATASET_CREATE);
+            if (w->uint16)
+                H5Pset_shuffle(dcpl);
+            H5Pset_deflate(dcpl, gzip_compression_level);
+            H5Pset_chunk(dcpl, 2, chunk);
+
+            w->dset[i] = H5Dcreate(w->group, dset_name, w->uint16 ? H5T_NATIVE_USHORT : H5T_NATIVE_FLOAT, space, H5P_DEFAULT, dcpl, dapl);
+
+            H5Pclose(dcpl);
+            H5Sclose(space);
+        } else {
+            w->dset[i] = H5Dopen(w->group, dset_name, dapl);
+        }
+
+        if (w->dset[i] < 0) {
+            fprintf(stderr, "couldn't %s dataset %s.\n", create ? "create" : "open", dset_name);
+            H5Pclose(dapl);
+            return 1;
+        }
+
+        if (open_charge_dataset(w, create, i, gzip_compression_level, starting_channel) ||
+            open_start_cell_dataset(w, create, i, gzip_compression_level, starting_channel)) {
+            H5Pclose(dapl);
+            return 1;
+        }
+
+        if (!create) {
+            /* Events appended to an existing group are stored in the same
+             * way as the events which are already there. */
+            dtype = H5Dget_type(w->dset[i]);
+            if (uint16 == -1)
+                uint16 = H5Tget_class(dtype) == H5T_INTEGER;
+            else if (uint16 != (H5Tget_class(dtype) == H5T_INTEGER))
+                fprintf(stderr, "Warning: channels in the same group are stored with different types!\n");
+            H5Tclose(dtype);
+        }
+    }
+
+    H5Pclose(dapl);
+
+    if (!create && uint16 != -1 && uint16 != w->uint16) {
+        fprintf(stderr, "Warning: existing group is stored as %s, so the new events will be too.\n", uint16 ? "uint16" : "float32");
+        w->uint16 = uint16;
+    }
+
+    return 0;
+}
+
+/* Converts the samples of channel `i` of the events in `buf` to uint16
+ * fixed point numbers in `w->wdata`. */
+static void convert_channel(Writer_t *w, WriterBuffer_t *buf, int i)
+{
+    float *samples = writer_samples(w, buf, i, 0);
+    float v;
+    long j;
+
+    for (j = 0; j < (long) buf->nwaveforms*w->nsamples; j++) {
+        v = samples[j]*WRITER_ADC_SCALE;
+        if (v < 0)
+            v = 0;
+        else if (v > 65535)
+            v = 65535;
+        w->wdata[j] = (uint16_t) (v + 0.5f);
+    }
+}
+
+/* Appends `n` rows of `data` to the one or two dimensional dataset `dset`.
+ * For two dimensional datasets, the rows have `w->nsamples` samples. */
+static int append(Writer_t *w, hid_t dset, int n, hid_t mem_type, void *data)
+{
+    hid_t mem_space, file_space;
+    hsize_t dims[2], extdims[2], start[2] = {0, 0};
+    herr_t status;
+    int rank;
+
+    file_space = H5Dget_space(dset);
+    rank = H5Sget_simple_extent_ndims(file_space);
+    H5Sget_simple_extent_dims(file_space, dims, NULL);
+    H5Sclose(file_space);
+
+    if (rank == 2 && dims[1] != w->nsamples) {
+        fprintf(stderr, "number of samples changed from %i to %i!\n", (int) dims[1], w->nsamples);
+        return 1;
+    }
+
+    extdims[0] = n;
+    extdims[1] = w->nsamples;
+    mem_space = H5Screate_simple(rank, extdims, NULL);
+
+    /* Extend the dataset and select the newly extended part of it. */
+    start[0] = dims[0];
+    dims[0] += extdims[0];
+    status = H5Dset_extent(dset, dims);
+
+    if (status) {
+        fprintf(stderr, "error extending dataset.\n");
+        H5Sclose(mem_space);
+        return 1;
+    }
+
+    file_space = H5Dget_space(dset);
+    status = H5Sselect_hyperslab(file_space, H5S_SELECT_SET, start, NULL, extdims, NULL);
+
+    if (status) {
+        fprintf(stderr, "error selecting hyperslab.\n");
+        H5Sclose(mem_space);
+        H5Sclose(file_space);
+        return 1;
+    }
+
+    status = H5Dwrite(dset, mem_type, mem_space, file_space, H5P_DEFAULT, data);
+
+    H5Sclose(mem_space);
+    H5Sclose(file_space);
+
+    if (status) {
+        fprintf(stderr, "error writing to hdf5 file.\n");
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Appends the events in `buf` to the datasets. The events of each channel
+ * are contiguous in the buffer, so float samples are written directly from
+ * it, and only uint16 samples need to be converted first.
+ *
+ * In SWMR mode, the datasets are flushed after the events are written so
+ * that `analyze-waveforms --follow` can read them. This writes out the last
+ * partially filled chunk of every dataset, which is written again once it
+ * has more events. */
+static int write_buffer(Writer_t *w, WriterBuffer_t *buf)
+{
+    int i;
+
+    for (i = 0; i < WRITER_MAX_CHANNELS; i++) {
+        if (!(w->chmask & (1UL << i))) continue;
+
+        if (w->charge_only && append(w, w->charge_dset[i], buf->n, H5T_NATIVE_FLOAT, writer_charges(w, buf, i)))
+            return 1;
+
+        if (buf->nwaveforms == 0)
+            continue;
+
+        if (w->raw && append(w, w->start_cell_dset[i], buf->nwaveforms, H5T_NATIVE_USHORT, writer_start_cells(w, buf, i)))
+            return 1;
+
+        if (w->uint16) {
+            convert_channel(w, buf, i);
+            if (append(w, w->dset[i], buf->nwaveforms, H5T_NATIVE_USHORT, w->wdata))
+                return 1;
+        } else {
+            if (append(w, w->dset[i], buf->nwaveforms, H5T_NATIVE_FLOAT, writer_samples(w, buf, i, 0)))
+                return 1;
+        }
+    }
+
+    if (w->swmr) {
+        for (i = 0; i < WRITER_MAX_CHANNELS; i++) {
+            if (!(w->chmask & (1UL << i))) continue;
+
+            if (H5Dflush(w->dset[i]) < 0 || (w->charge_only && H5Dflush(w->charge_dset[i]) < 0) || (w->raw && H5Dflush(w->start_cell_dset[i]) < 0)) {
+                fprintf(stderr, "error flushing hdf5 file.\n");
+                return 1;
+            }
+        }
+    }
+
+    return 0;
+}
+
+/* Returns the number of bytes of a buffer written to the file before
+ * compression. */
+static long buffer_bytes(Writer_t *w, WriterBuffer_t *buf)
+{
+    long bytes;
+
+    bytes = (long) buf->nwaveforms*w->nsamples*(w->uint16 ? sizeof(uint16_t) : sizeof(float));
+    if (w->charge_only)
+        bytes += (long) buf->n*sizeof(float);
+    if (w->raw)
+        bytes += (long) buf->nwaveforms*sizeof(uint16_t);
+
+    return bytes*w->nchannels;
+}
+
+static void *writer_thread(void *arg)
+{
+    Writer_t *w = (Writer_t *) arg;
+    WriterBuffer_t *buf;
+    double t0;
+
+    pthread_mutex_lock(&w->lock);
+    while (1) {
+        while (w->count == 0 && !w->done)
+            pthread_cond_wait(&w->filled, &w->lock);
+
+        if (w->count == 0)
+            break;
+
+        buf = &w->buffers[w->tail];
+        pthread_mutex_unlock(&w->lock);
+
+        t0 = get_time();
+        if (write_buffer(w, buf)) {
+            pthread_mutex_lock(&w->lock);
+            w->error = 1;
+            pthread_cond_broadcast(&w->emptied);
+            break;
+        }
+
+        if (w->telemetry) {
+            telemetry_add(w->telemetry, TELEMETRY_WRITE, get_time() - t0);
+            w->telemetry->bytes_written += buffer_bytes(w, buf);
+        }
+
+        pthread_mutex_lock(&w->lock);
+        w->write_time += get_time() - t0;
+        w->nevents += buf->n;
+        w->nbatches += 1;
+        w->tail = (w->tail + 1) % w->nbuffers;
+        w->count -= 1;
+        pthread_cond_signal(&w->emptied);
+    }
+    pthread_mutex_unlock(&w->lock);
+
+    return NULL;
+}
+
+/* Opens the output file and starts the writer thread. If the file doesn't
+ * exist, it will be created. If the group doesn't exist in the file, it will
+ * be created along with its attributes, the baseline data and a dataset for
+ * every channel. Otherwise, the events are appended to the existing
+ * datasets.
+ *
+ * If `uint16` is nonzero, the samples of new groups are stored as uint16
+ * instead of floats (see `open_datasets()`).
+ *
+ * The event buffers are sized for `batch_size` events with `nsamples`
+ * samples for each of the channels in `chmask`, so that several instances
+ * of wavedump with only a few channels enabled can run on the same
+ * computer.
+ *
+ * If `charge_window` isn't NULL, the events are written in charge-only mode,
+ * i.e. the readout writes the charges of every event into the buffers along
+ * with the waveforms of every `prescale`th event.
+ *
+ * If `swmr` is nonzero, the file is written in single-writer/multiple-reader
+ * mode, so that it can be read while the events are written. This needs the
+ * latest version of the file format, so a file can only be appended to in
+ * SWMR mode if it was created in SWMR mode.
+ *
+ * If `tables` isn't NULL, the samples are written without the DRS4
+ * corrections, i.e. the readout writes the start cell of every waveform into
+ * the buffers, and the `ntables` correction tables of the groups of channels
+ * are written along with the events.
+ *
+ * If `trigger` isn't NULL, the statistics of the software triggers are
+ * written to the attributes of the group when the file is closed (see
+ * `write_trigger_attrs()`). The attributes are created here, since they
+ * can't be created once SWMR mode is started.
+ *
+ * If `telemetry` isn't NULL, the writer thread records how long it took to
+ * write every batch in it, `writer_get_buffer()` records how long the
+ * readout waited for a buffer, and the telemetry of the run is written to
+ * the `telemetry` group when the file is closed (see `write_telemetry()`). */
+int writer_open(Writer_t *w, char *filename, char *group_name, float baseline_data[BS_SIZE][WRITER_MAX_CHANNELS][1024], unsigned long chmask, int nsamples, WaveDumpConfig_t *WDcfg, int gzip_compression_level, int starting_channel, int nbuffers, int batch_size, int uint16, ChargeWindow_t *charge_window, int prescale, int swmr, CAEN_DGTZ_DRS4Correction_t *tables, int ntables, Trigger_t *trigger, Telemetry_t *telemetry)
+{
+    htri_t avail;
+    hid_t fapl;
+    unsigned int filter_info;
+    int i, create;
+    size_t size;
+
+    memset(w, 0, sizeof(Writer_t));
+    w->chmask = chmask;
+    w->uint16 = uint16;
+    w->nsamples = nsamples;
+    w->batch_size = batch_size;
+    w->max_waveforms = batch_size;
+    w->charge_only = charge_window != NULL;
+    w->prescale = prescale;
+    w->swmr = swmr;
+    w->raw = tables != NULL;
+    w->trigger = trigger;
+    w->telemetry = telemetry;
+
+    for (i = 0; i < WRITER_MAX_CHANNELS; i++) {
+        if (chmask & (1UL << i))
+            w->index[i] = w->nchannels++;
+        else
+            w->index[i] = -1;
+    }
+
+    if (nbuffers < 2 || nbuffers > WRITER_MAX_BUFFERS) {
+        fprintf(stderr, "number of buffers must be between 2 and %i.\n", WRITER_MAX_BUFFERS);
+        return 1;
+    }
+
+    if (batch_size < 1 || batch_size > WRITER_MAX_BATCH_SIZE) {
+        fprintf(stderr, "batch size must be between 1 and %i.\n", WRITER_MAX_BATCH_SIZE);
+        return 1;
+    }
+
+    if (nsamples < 1 || nsamples > 1024) {
+        fprintf(stderr, "invalid number of samples %i.\n", nsamples);
+        return 1;
+    }
+
+    if (w->charge_only) {
+        if (prescale < 1) {
+            fprintf(stderr, "prescale must be at least 1.\n");
+            return 1;
+        }
+
+        /* A batch of events can only start in the middle of `prescale`
+         * events, so this is the most waveforms a batch can have. */
+        w->max_waveforms = (batch_size + prescale - 1)/prescale;
+    }
+
+    w->nbuffers = nbuffers;
+
+#if !H5_VERSION_GE(1,10,0)
+    if (swmr) {
+        fprintf(stderr, "SWMR mode needs hdf5 1.10 or later.\n");
+        return 1;
+    }
+#endif
+
+    if (uint16 && H5Zfilter_avail(H5Z_FILTER_SHUFFLE) <= 0) {
+        fprintf(stderr, "shuffle filter not available.\n");
+        return 1;
+    }
+
+    fapl = H5Pcreate(H5P_FILE_ACCESS);
+    if (swmr)
+        H5Pset_libver_bounds(fapl, H5F_LIBVER_LATEST, H5F_LIBVER_LATEST);
+
+    /* Check if file exists. */
+    if (access(filename, F_OK) != 0) {
+        /* Check if gzip compression is available and can be used for both
+         * compression and decompression, since this filter is an optional
+         * part of the hdf5 library. */
+        avail = H5Zfilter_avail(H5Z_FILTER_DEFLATE);
+        if (!avail) {
+            fprintf(stderr, "gzip filter not available.\n");
+            return 1;
+        }
+
+        H5Zget_filter_info(H5Z_FILTER_DEFLATE, &filter_info);
+
+        if (!(filter_info & H5Z_FILTER_CONFIG_ENCODE_ENABLED) || !(filter_info & H5Z_FILTER_CONFIG_DECODE_ENABLED)) {
+            fprintf(stderr, "gzip filter not available for encoding and decoding.\n");
+            return 1;
+        }
+
+        w->file = H5Fcreate(filename, H5F_ACC_TRUNC, H5P_DEFAULT, fapl);
+    } else {
+        w->file = H5Fopen(filename, H5F_ACC_RDWR, fapl);
+    }
+
+    H5Pclose(fapl);
+
+    if (w->file < 0) {
+        fprintf(stderr, "unable to open output file %s.\n", filename);
+        return 1;
+    }
+
+    create = H5Lexists(w->file, group_name, H5P_DEFAULT) <= 0;
+
+    if (create) {
+        w->group = H5Gcreate(w->file, group_name, H5P_DEFAULT, H5P_DEFAULT, H5P_DEFAULT);
+
+        if (write_group_attrs(w->group, WDcfg, uint16, gzip_compression_level, charge_window, prescale, w->raw, starting_channel) ||
+            write_baselines(w->group, group_name, baseline_data, chmask, nsamples, starting_channel) ||
+            (tables && write_correction_tables(w->group, tables, ntables)))
+            return 1;
+    } else {
+        w->group = H5Gopen(w->file, group_name, H5P_DEFAULT);
+    }
+
+    if (open_datasets(w, create, nsamples, gzip_compression_level, starting_channel))
+        return 1;
+
+    if (trigger && (read_trigger_attrs(w) || write_trigger_attrs(w, &w->trigger_base)))
+        return 1;
+
+    if (telemetry && (read_telemetry(w) ||
+                      (H5Lexists(w->group, "telemetry", H5P_DEFAULT) <= 0 && create_telemetry(w)) ||
+                      write_telemetry(w, &w->telemetry_base)))
+        return 1;
+
+#if H5_VERSION_GE(1,10,0)
+    /* No more objects or attributes can be created once SWMR mode is
+     * started, so everything has to be created before this. */
+    if (swmr && H5Fstart_swmr_write(w->file) < 0) {
+        fprintf(stderr, "unable to start SWMR mode. Can only append to files in SWMR mode which were created with --swmr.\n");
+        return 1;
+    }
+#endif
+
+    if (w->uint16) {
+        w->wdata = malloc((size_t) w->max_waveforms*nsamples*sizeof(uint16_t));
+
+        if (!w->wdata) {
+            fprintf(stderr, "failed to allocate memory for the writer.\n");
+            return 1;
+        }
+    }
+
+    size = (size_t) w->nchannels*w->max_waveforms*nsamples*sizeof(float);
+    if (w->charge_only)
+        size += (size_t) w->nchannels*batch_size*sizeof(float);
+    if (w->raw)
+        size += (size_t) w->nchannels*w->max_waveforms*sizeof(uint16_t);
+    printf("allocating %i buffers of %i events (%.0f MB)\n", w->nbuffers, batch_size, w->nbuffers*size/pow(2,20));
+
+    for (i = 0; i < w->nbuffers; i++) {
+        w->buffers[i].data = malloc((size_t) w->nchannels*w->max_waveforms*nsamples*sizeof(float));
+        if (w->charge_only)
+            w->buffers[i].charge = malloc((size_t) w->nchannels*batch_size*sizeof(float));
+        if (w->raw)
+            w->buffers[i].start_cell = malloc((size_t) w->nchannels*w->max_waveforms*sizeof(uint16_t));
+
+        if (!w->buffers[i].data || (w->charge_only && !w->buffers[i].charge) || (w->raw && !w->buffers[i].start_cell)) {
+            fprintf(stderr, "failed to allocate memory for the event buffers.\n");
+            return 1;
+        }
+    }
+
+    pthread_mutex_init(&w->lock, NULL);
+    pthread_cond_init(&w->filled, NULL);
+    pthread_cond_init(&w->emptied, NULL);
+
+    if (pthread_create(&w->thread, NULL, writer_thread, w)) {
+        fprintf(stderr, "failed to start the writer thread.\n");
+        return 1;
+    }
+
+    return 0;
+}
+
+/* Returns an empty buffer to be filled with events, waiting for the writer
+ * thread if it hasn't finished with any of the buffers yet. Returns NULL if
+ * the writer thread failed. */
+WriterBuffer_t *writer_get_buffer(Writer_t *w)
+{
+    WriterBuffer_t *buf = NULL;
+    double t0, wait;
+
+    t0 = get_time();
+    pthread_mutex_lock(&w->lock);
+    if (w->count == w->nbuffers && !w->error) {
+        while (w->count == w->nbuffers && !w->error)
+            pthread_cond_wait(&w->emptied, &w->lock);
+        wait = get_time() - t0;
+        w->nstalls += 1;
+        w->stall_time += wait;
+        fprintf(stderr, "Warning: waited %.0f ms for the writer to free a buffer\n", wait*1000);
+    }
+    if (!w->error)
+        buf = &w->buffers[w->head];
+    pthread_mutex_unlock(&w->lock);
+
+    if (w->telemetry)
+        telemetry_add(w->telemetry, TELEMETRY_WAIT, get_time() - t0);
+
+    return buf;
+}
+
+/* Hands the `n` events and `nwaveforms` waveforms in the buffer returned by
+ * the last call to `writer_get_buffer()` to the writer thread. Without
+ * charge-only mode, `nwaveforms` should be equal to `n`. */
+int writer_submit(Writer_t *w, int n, int nwaveforms)
+{
+    int error;
+
+    pthread_mutex_lock(&w->lock);
+    error = w->error;
+    if (!error) {
+        w->buffers[w->head].n = n;
+        w->buffers[w->head].nwaveforms = nwaveforms;
+        w->head = (w->head + 1) % w->nbuffers;
+        w->count += 1;
+        pthread_cond_signal(&w->filled);
+    }
+    pthread_mutex_unlock(&w->lock);
+
+    return error;
+}
+
+/* Waits for the writer thread to write all of the submitted events and closes
+ * the output file. */
+int writer_close(Writer_t *w)
+{
+    WriterTriggerStats_t s;
+    int i;
+    herr_t status = 0;
+
+    pthread_mutex_lock(&w->lock);
+    w->done = 1;
+    pthread_cond_signal(&w->filled);
+    pthread_mutex_unlock(&w->lock);
+
+    pthread_join(w->thread, NULL);
+
+    if (w->trigger) {
+        s = w->trigger_base;
+        s.requested += w->trigger->requested;
+        s.sent += w->trigger->sent;
+        s.missed += w->trigger->missed;
+        s.accepted += w->trigger->accepted;
+        s.time += w->trigger->stop_time - w->trigger->start_time;
+        s.live_time += trigger_live_time(w->trigger);
+        s.readouts += w->trigger->readouts;
+        s.readout_time += w->trigger->readout_time;
+        if (w->trigger->readout_max > s.readout_max)
+            s.readout_max = w->trigger->readout_max;
+        status |= write_trigger_attrs(w, &s);
+    }
+
+    if (w->telemetry) {
+        telemetry_merge(&w->telemetry_base, w->telemetry);
+        status |= write_telemetry(w, &w->telemetry_base);
+    }
+
+    for (i = 0; i < WRITER_MAX_CHANNELS; i++) {
+        if (!(w->chmask & (1UL << i))) continue;
+        status |= H5Dclose(w->dset[i]);
+        if (w->charge_only)
+            status |= H5Dclose(w->charge_dset[i]);
+        if (w->raw)
+            status |= H5Dclose(w->start_cell_dset[i]);
+    }
+    status |= H5Gclose(w->group);
+    status |= H5Fclose(w->file);
+
+    for (i = 0; i < w->nbuffers; i++) {
+        free(w->buffers[i].data);
+        free(w->buffers[i].charge);
+        free(w->buffers[i].start_cell);
+    }
+    free(w->wdata);
+
+    pthread_mutex_destroy(&w->lock);
+    pthread_cond_destroy(&w->filled);
+    pthread_cond_destroy(&w->emptied);
+
+    printf("wrote %li events in %li batches (%.3f s writing)\n", w->nevents, w->nbatches, w->write_time);
+    if (w->nstalls)
+        printf("readout waited for the writer %li times (%.3f s total). Try a lower --gzip-compression-level or more --buffers.\n", w->nstalls, w->stall_time);
+
+    if (status) {
+        fprintf(stderr, "error closing hdf5 file.\n");
+        return 1;
+    }
+
+    return w->error;
+}
@@ -0,0 +1,184 @@
+#ifndef _WRITER_H_
+#define _WRITER_H_
+
+#include <pthread.h>
+#include "hdf5.h"
+#include "wavedump.h"
+#include "charge.h"
+#include "trigger.h"
+#include "telemetry.h"
+
+/* Default and maximum number of events written at a time. The default
+ * matches WRITER_UINT16_CHUNK, so that every batch fills whole chunks. */
+#define WRITER_BATCH_SIZE 1000
+#define WRITER_MAX_BATCH_SIZE 10000
+/* Maximum number of channels, i.e. 16 channels for each of up to 4
+ * digitizers, and the number of groups of 8 channels. */
+#define WRITER_MAX_CHANNELS 64
+#define WRITER_MAX_GROUPS (WRITER_MAX_CHANNELS/8)
+
+/* Number of events taken in transparent mode to measure the baselines. */
+#define BS_SIZE 10
+
+/* Default and maximum number of event buffers shared between the readout and
+ * the writer thread. */
+#define WRITER_NBUFFERS 2
+#define WRITER_MAX_BUFFERS 8
+
+/* Number of chunks of each dataset which fit in its chunk cache. */
+#define WRITER_CACHE_CHUNKS 2
+
+/* Number of events per chunk of the uint16 datasets. This divides the
+ * default number of events `analyze-waveforms` reads at a time (`--chunks`)
+ * so that every chunk is only read and decompressed once. */
+#define WRITER_UINT16_CHUNK 1000
+
+/* Number of events per chunk of the charge and start cell datasets. */
+#define WRITER_CHARGE_CHUNK 16384
+
+/* Number of steps per ADC count of the uint16 samples. The DRS4 corrections
+ * leave the samples with a fractional part, which has to be kept since the
+ * baselines are found from the median of the samples. Rounding to whole ADC
+ * counts would bias the SPE charges by up to half an ADC count times the
+ * integration window. 12 bit samples times 16 still fit in 16 bits. */
+#define WRITER_ADC_SCALE 16
+
+/* A batch of events stored channel by channel, i.e. as
+ * [channel][event][sample], where only the channels which are written to the
+ * file are stored (see `writer_samples()`). The events of each channel are
+ * contiguous, so they can be written to their dataset without copying them
+ * first.
+ *
+ * In charge-only mode, `charge` holds the charges of all `n` events
+ * ([channel][event], see `writer_charges()`) and `data` only holds the
+ * waveforms of every `prescale`th event. Otherwise, the waveforms of all of
+ * the events are kept.
+ *
+ * In raw mode, `start_cell` holds the index of the first DRS4 cell of every
+ * waveform ([channel][event], see `writer_start_cells()`). */
+typedef struct {
+    float *data;
+    float *charge;
+    uint16_t *start_cell;
+    int n;
+    int nwaveforms;
+} WriterBuffer_t;
+
+/* Software trigger statistics summed over every run written to a group. */
+typedef struct {
+    long requested;
+    long sent;
+    long missed;
+    long accepted;
+    double time;
+    double live_time;
+    long readouts;
+    double readout_time;
+    double readout_max;
+} WriterTriggerStats_t;
+
+/* An output file which stays open for the whole run. Events are written by a
+ * separate thread so that reading out the digitizer overlaps with
+ * compressing and writing the previous events to disk.
+ *
+ * The readout gets an empty buffer with `writer_get_buffer()`, fills it, and
+ * hands it to the writer thread with `writer_submit()`. If every buffer is
+ * still waiting to be written, `writer_get_buffer()` blocks until one is
+ * free, and the time spent waiting is counted as back-pressure. */
+typedef struct {
+    hid_t file;
+    hid_t group;
+    hid_t dset[WRITER_MAX_CHANNELS];
+    unsigned long chmask;
+    /* Position of each channel in the event buffers, or -1 if the channel
+     * isn't written. */
+    int index[WRITER_MAX_CHANNELS];
+    int nchannels;
+    int nsamples;
+    int batch_size;
+    /* Maximum number of waveforms in a buffer. */
+    int max_waveforms;
+
+    /* Whether the waveforms are integrated online, in which case the charges
+     * are written to the `charge_chN` datasets and only every `prescale`th
+     * waveform is written. */
+    int charge_only;
+    int prescale;
+    hid_t charge_dset[WRITER_MAX_CHANNELS];
+
+    /* Whether the file is written in single-writer/multiple-reader mode, in
+     * which case the datasets are flushed after every batch so that readers
+     * see the new events. */
+    int swmr;
+    /* Whether the samples aren't corrected for the DRS4 cells, in which case
+     * the start cell of every waveform is written to the `start_cell_chN`
+     * datasets. */
+    int raw;
+    hid_t start_cell_dset[WRITER_MAX_CHANNELS];
+    /* Software triggers sent during the run, whose statistics are added to
+     * those of the previous runs in `trigger_base` and written to the
+     * attributes of the group when the file is closed. */
+    Trigger_t *trigger;
+    WriterTriggerStats_t trigger_base;
+    /* Telemetry of the run, which is added to that of the previous runs in
+     * `telemetry_base` and written to the `telemetry` group when the file
+     * is closed. */
+    Telemetry_t *telemetry;
+    Telemetry_t telemetry_base;
+    /* Whether the samples are stored as uint16 ADC counts instead of
+     * floats. */
+    int uint16;
+    /* Buffer for converting one channel to uint16. */
+    uint16_t *wdata;
+
+    WriterBuffer_t buffers[WRITER_MAX_BUFFERS];
+    int nbuffers;
+    /* Next buffer to be filled by the readout. */
+    int head;
+    /* Next buffer to be written by the writer thread. */
+    int tail;
+    /* Number of buffers waiting to be written. */
+    int count;
+    int done;
+    int error;
+
+    pthread_t thread;
+    pthread_mutex_t lock;
+    pthread_cond_t filled;
+    pthread_cond_t emptied;
+
+    long nevents;
+    long nbatches;
+    long nstalls;
+    double stall_time;
+    double write_time;
+} Writer_t;
+
+/* Returns a pointer to the samples of channel `ch` of the `n`th waveform in
+ * a buffer returned by `writer_get_buffer()`. The channel must be in
+ * `w->chmask`. */
+static inline float *writer_samples(Writer_t *w, WriterBuffer_t *buf, int ch, int n)
+{
+    return buf->data + ((long) w->index[ch]*w->max_waveforms + n)*w->nsamples;
+}
+
+/* Returns a pointer to the charges of channel `ch` in a buffer returned by
+ * `writer_get_buffer()` in charge-only mode. */
+static inline float *writer_charges(Writer_t *w, WriterBuffer_t *buf, int ch)
+{
+    return buf->charge + (long) w->index[ch]*w->batch_size;
+}
+
+/* Returns a pointer to the start cells of channel `ch` in a buffer returned
+ * by `writer_get_buffer()` in raw mode. */
+static inline uint16_t *writer_start_cells(Writer_t *w, WriterBuffer_t *buf, int ch)
+{
+    return buf->start_cell + (long) w->index[ch]*w->max_waveforms;
+}
+
+int writer_open(Writer_t *w, char *filename, char *group_name, float baseline_data[BS_SIZE][WRITER_MAX_CHANNELS][1024], unsigned long chmask, int nsamples, WaveDumpConfig_t *WDcfg, int gzip_compression_level, int starting_channel, int nbuffers, int batch_size, int uint16, ChargeWindow_t *charge_window, int prescale, int swmr, CAEN_DGTZ_DRS4Correction_t *tables, int ntables, Trigger_t *trigger, Telemetry_t *telemetry);
+WriterBuffer_t *writer_get_buffer(Writer_t *w);
+int writer_submit(Writer_t *w, int n, int nwaveforms);
+int writer_close(Writer_t *w);
+
+#endif
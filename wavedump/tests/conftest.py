@@ -0,0 +1,44 @@
+"""
+Shared setup for the tests of the scripts in `wavedump/src`.
+
+The helper modules are imported straight from `wavedump/src`, and the scripts
+without a `.py` extension are run with `run_script`, the same way as on the
+command line.
+"""
+
+from __future__ import print_function, division
+from importlib.machinery import SourceFileLoader
+import subprocess
+import os
+import sys
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+sys.path.insert(0, SRC_DIR)
+
+def load_script(name):
+    """
+    Imports one of the scripts in `wavedump/src` which don't end in `.py`.
+    """
+    return SourceFileLoader(name.replace('-', '_'), os.path.join(SRC_DIR, name)).load_module()
+
+def run_script(name, *args):
+    """
+    Runs the script `name` in `wavedump/src` with the command line arguments
+    `args`, and returns its output. Fails the test if the script fails.
+    """
+    result = subprocess.run([sys.executable, os.path.join(SRC_DIR, name)] + [str(arg) for arg in args],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    assert result.returncode == 0, result.stdout
+    return result.stdout
+
+@pytest.fixture(scope='session')
+def generated(tmp_path_factory):
+    """
+    A file of synthetic waveforms from `generate-waveforms` with the default
+    truth values, shared by all the tests.
+    """
+    filename = str(tmp_path_factory.mktemp('generated') / 'generated.hdf5')
+    run_script('generate-waveforms', filename, '-n', 5000, '--seed', 0)
+    return filename
@@ -0,0 +1,48 @@
+"""
+Tests of the vectorized baseline subtraction.
+"""
+
+from __future__ import print_function, division
+from argparse import Namespace
+import numpy as np
+import h5py
+import baseline_funcs
+import fit_numpy_funcs
+from conftest import load_script
+
+def test_masked_median():
+    rng = np.random.default_rng(0)
+    y = rng.standard_normal((1000, 128))
+    # Pulses of different lengths, so the rows have different numbers of
+    # unmasked samples, including even and odd ones.
+    for i in range(len(y)):
+        start = rng.integers(0, 100)
+        y[i,start:start+rng.integers(0, 20)] -= 10
+    y[0] = -10
+    mask = y > -3
+
+    expected = np.array([np.median(y[i,mask[i]]) if mask[i].any() else np.nan for i in range(len(y))])
+    np.testing.assert_array_equal(baseline_funcs.masked_median(y, mask), expected)
+    np.testing.assert_array_equal(baseline_funcs.masked_median(y.T, mask.T),
+                                  [np.median(y[mask[:,i],i]) for i in range(y.shape[1])])
+
+    median = baseline_funcs.masked_median(y.astype(np.float32), mask)
+    assert median.dtype == np.float32
+    np.testing.assert_allclose(median, expected, rtol=1e-6)
+
+def test_pre_trigger_baseline(generated):
+    # The median of the whole waveform (method 0, which method 1 starts from)
+    # is pulled down by the SPE pulses, but the samples before the trigger
+    # give the SPE charge the data was generated with.
+    aw = load_script('analyze-waveforms')
+    args = Namespace(chunks=10000, float32=False, stream=False, drs4_correction=7,
+                     drs4_tables=None, start_time=[50], integration_time=[300],
+                     integration_method=5)
+    with h5py.File(generated, 'r') as f:
+        result = aw.analyze_channel(f, 'spe', 'ch0', args)
+        truth = f.attrs['truth_spe_charge']
+    counts, edges = aw.get_numpy_hist(result['charge'], result['bins'])
+    f_counts, f_edges = aw.get_numpy_hist(result['f_charge'], result['f_bins'])
+    fit = fit_numpy_funcs.fit_spe(counts, edges, f_counts, f_edges)
+    assert fit is not None
+    assert abs(fit[0] - truth) < 0.03*truth
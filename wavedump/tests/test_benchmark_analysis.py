@@ -0,0 +1,18 @@
+"""
+Tests that `benchmark-analysis` runs and that its SPE charge isn't biased
+with the default integration method.
+"""
+
+from __future__ import print_function, division
+import json
+from conftest import run_script
+
+def test_benchmark_analysis(tmp_path):
+    filename = str(tmp_path / 'benchmark.json')
+    run_script('benchmark-analysis', '--events', 5000, '--json', filename)
+    with open(filename) as f:
+        result, = json.load(f)
+    assert result['events'] == 5000
+    for stage in ('generate', 'convert_data', 'spe_baseline_subtraction', 'integrate', 'fit'):
+        assert result[f'{stage}_time'] > 0
+    assert abs(result['spe_bias']) < 0.03
@@ -0,0 +1,68 @@
+"""
+Tests of the cache keys of the charges and of storing them in the cache.
+"""
+
+from __future__ import print_function, division
+from argparse import Namespace
+import h5py
+import numpy as np
+import charge_cache
+import pulse_features
+
+def get_args(**kwargs):
+    args = Namespace(chunks=10000, float32=False, stream=False, drs4_correction=7,
+                     drs4_tables=None, start_time=[50], integration_time=[300],
+                     integration_method=1)
+    for name, value in kwargs.items():
+        setattr(args, name, value)
+    return args
+
+def get_entry_name(group, **kwargs):
+    return charge_cache.get_entry_name(charge_cache.get_key('identity', 'version', group, 'ch0', get_args(**kwargs)))
+
+def test_get_key():
+    for group in ('sodium', 'spe'):
+        assert get_entry_name(group) == get_entry_name(group)
+        for name, value in [('chunks', 1000), ('float32', True), ('stream', True), ('drs4_correction', 1)]:
+            assert get_entry_name(group, **{name: value}) != get_entry_name(group)
+
+    # The SPE window doesn't change the sodium charges
+    assert get_entry_name('sodium', start_time=[30]) == get_entry_name('sodium')
+    assert get_entry_name('spe', start_time=[30]) != get_entry_name('spe')
+
+def get_result(n=1000):
+    rng = np.random.default_rng(0)
+    features = np.zeros(n, dtype=pulse_features.feature_dtype())
+    for name in pulse_features.FEATURES:
+        features[name] = rng.standard_normal(n)
+    return {'features': features, 'charge': features['charge'], 'sodium_rise_time': features['rise_time'],
+            'sodium_fall_time': features['fall_time'], 'f_charge': None, 'a': 10}
+
+def test_save_load(tmp_path):
+    cache_filename = str(tmp_path / 'cache.hdf5')
+    key = charge_cache.get_key('identity', 'version', 'sodium', 'ch0', get_args())
+    result = get_result()
+    charge_cache.save(cache_filename, key, result)
+
+    # The charges are only stored as part of the feature table
+    with h5py.File(cache_filename, 'r') as f:
+        assert sorted(f[charge_cache.get_entry_name(key)]) == ['features']
+
+    cached = charge_cache.load(cache_filename, key)
+    assert sorted(cached) == sorted(result)
+    for k in ('features', 'charge', 'sodium_rise_time', 'sodium_fall_time'):
+        np.testing.assert_array_equal(cached[k], result[k])
+    assert cached['f_charge'] is None
+    assert cached['a'] == 10
+
+def test_save_load_charge_only(tmp_path):
+    # With --charge-only, the charges are the online ones, not the ones in
+    # the feature table of the prescaled waveforms.
+    cache_filename = str(tmp_path / 'cache.hdf5')
+    key = charge_cache.get_key('identity', 'version', 'spe', 'ch0', get_args())
+    result = get_result()
+    result['charge'] = np.arange(5000, dtype=np.float32)
+    charge_cache.save(cache_filename, key, result)
+    cached = charge_cache.load(cache_filename, key)
+    np.testing.assert_array_equal(cached['charge'], result['charge'])
+    np.testing.assert_array_equal(cached['sodium_rise_time'], result['sodium_rise_time'])
@@ -0,0 +1,42 @@
+"""
+Tests the analysis of files taken with `wavedump --charge-only`, using the
+stand-in CAENDigitizer library in `wavedump/fake-digitizer`. Skipped if
+`wavedump` or the fake library haven't been built.
+"""
+
+from __future__ import print_function, division
+import subprocess
+import os
+import h5py
+import pytest
+from conftest import SRC_DIR, run_script
+
+FAKE_DIGITIZER_DIR = os.path.join(SRC_DIR, '..', 'fake-digitizer')
+
+@pytest.fixture(scope='module')
+def charge_only(tmp_path_factory):
+    wavedump = os.path.join(SRC_DIR, 'wavedump')
+    if not os.path.exists(wavedump) or not os.path.exists(os.path.join(FAKE_DIGITIZER_DIR, 'libCAENDigitizer.so')):
+        pytest.skip("wavedump and the fake digitizer aren't built")
+
+    filename = str(tmp_path_factory.mktemp('charge_only') / 'charge_only.hdf5')
+    env = dict(os.environ, LD_LIBRARY_PATH=FAKE_DIGITIZER_DIR, FAKE_DGTZ_RATE='10000', FAKE_DGTZ_SEED='1')
+    for label in ('sodium', 'spe'):
+        subprocess.run([wavedump, '-o', filename, '-l', label, '-b', '1', '-v', '50', '-n', '2000', '--charge-only'],
+                       env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return filename
+
+def test_analyze_charge_only(charge_only, tmp_path):
+    output = str(tmp_path / 'output.hdf5')
+    run_script('analyze-waveforms', charge_only, '-o', output, '--fit-backend', 'numpy', '--no-cache')
+
+    with h5py.File(charge_only, 'r') as f:
+        channels = [name for name in f['spe'] if name.startswith('charge_')]
+
+    # Every channel is analyzed once from its online charges, and the
+    # `charge_chN` datasets aren't analyzed as channels of their own.
+    with h5py.File(output, 'r') as f:
+        for group in ('sodium', 'spe'):
+            for channel in channels:
+                assert f'{group}_{channel[len("charge_"):]}' in f
+                assert f'{group}_{channel}' not in f
@@ -0,0 +1,185 @@
+"""
+Tests of the upload of the results to the database, with a fake connection
+instead of psycopg2.
+"""
+
+from __future__ import print_function, division
+import os
+import shutil
+import h5py
+import numpy as np
+import pytest
+import db_upload
+
+RUN = {'voltage': 50, 'institution': 'Caltech', 'git_sha1': 'abcdef12', 'git_dirty': '0',
+       'filename': 'run.hdf5', 'upload_id': 'id'}
+
+class FakeError(Exception):
+    pass
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, params):
+        self.conn.queries.append(query)
+        if query.startswith('INSERT INTO runs'):
+            if params['upload_id'] in self.conn.runs:
+                self.result = None
+            else:
+                self.conn.runs[params['upload_id']] = len(self.conn.runs) + 1
+                self.result = (self.conn.runs[params['upload_id']],)
+        elif query.startswith('SELECT run FROM runs'):
+            self.result = (self.conn.runs[params[0]],)
+
+    def fetchone(self):
+        return self.result
+
+    def copy_expert(self, query, buf):
+        self.conn.copied.append(buf.read())
+
+class FakeConnection(object):
+    """
+    Connection which keeps the upload ids of the runs inserted and the rows
+    sent with COPY.
+    """
+    def __init__(self):
+        self.runs = {}
+        self.queries = []
+        self.copied = []
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+def get_channels():
+    channels = []
+    for i in range(2):
+        channel = {column: 1.0 for column in db_upload.DATA_COLUMNS}
+        channel.update(channel=i, barcode=1, spe=np.float64(0.5), sodium_charge_histogram_x=np.array([1.0, np.nan]),
+                       sodium_peak=None)
+        channels.append(channel)
+    return channels
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """
+    Replaces the connection to the database with a FakeConnection, which is
+    returned. Setting `conn.down` makes connecting fail.
+    """
+    conn = FakeConnection()
+    conn.down = False
+
+    def connect():
+        if conn.down:
+            raise FakeError("could not connect to server")
+        conn.closed = False
+        return conn
+
+    monkeypatch.setattr(db_upload, 'connect', connect)
+    monkeypatch.setattr(db_upload, 'get_connection_errors', lambda: (FakeError,))
+    return conn
+
+def test_copy_value():
+    assert db_upload.copy_value(None) == '\\N'
+    assert db_upload.copy_value(float('nan')) == 'NaN'
+    assert db_upload.copy_value(np.float32(np.inf)) == 'Infinity'
+    assert db_upload.copy_value(-np.inf) == '-Infinity'
+    assert db_upload.copy_value(0.1) == '0.1'
+    assert db_upload.copy_value(3) == '3'
+    assert db_upload.copy_value(np.array([1.5, np.nan, -np.inf])) == '{1.5,NaN,-Infinity}'
+    assert db_upload.copy_value([1, 2]) == '{1.0,2.0}'
+
+def test_upload(fake_db):
+    assert db_upload.upload(fake_db, RUN, get_channels()) == (1, True)
+    rows = fake_db.copied[0].splitlines()
+    assert len(rows) == 2
+    fields = rows[0].split('\t')
+    assert len(fields) == len(db_upload.DATA_COLUMNS) + 1
+    assert fields[db_upload.DATA_COLUMNS.index('sodium_peak')] == '\\N'
+    assert fields[db_upload.DATA_COLUMNS.index('sodium_charge_histogram_x')] == '{1.0,NaN}'
+    assert fields[-1] == '1'
+
+def test_upload_conflict(fake_db):
+    # Uploading the same run again returns the run already in the database
+    # without inserting the channels again.
+    db_upload.upload(fake_db, RUN, get_channels())
+    assert db_upload.upload(fake_db, RUN, get_channels()) == (1, False)
+    assert fake_db.queries[-1].startswith('SELECT run FROM runs')
+    assert len(fake_db.copied) == 1
+
+def test_spool(fake_db, tmp_path):
+    spool_dir = str(tmp_path / 'spool')
+    fake_db.down = True
+    db_upload.upload_or_spool(spool_dir, RUN, get_channels())
+    filenames = os.listdir(spool_dir)
+    assert filenames == [os.path.basename(db_upload.get_spool_filename(spool_dir, RUN))]
+
+    # The spool is kept until the database can be reached
+    assert db_upload.flush_spool(spool_dir) == 1
+    assert os.listdir(spool_dir) == filenames
+
+    fake_db.down = False
+    assert db_upload.flush_spool(spool_dir) == 0
+    assert os.listdir(spool_dir) == []
+    assert list(fake_db.runs) == [RUN['upload_id']]
+    assert fake_db.closed
+
+    # The channels are the same as if they were uploaded right away
+    conn = FakeConnection()
+    db_upload.upload(conn, RUN, get_channels())
+    assert fake_db.copied == conn.copied
+
+    # Flushing an empty spool does nothing
+    assert db_upload.flush_spool(spool_dir) == 0
+
+def make_run(filename):
+    rng = np.random.default_rng()
+    with h5py.File(filename, 'w') as f:
+        g = f.create_group('spe')
+        g.attrs['barcode'] = 1
+        g.attrs['data_source'] = np.bytes_('CAEN')
+        g.create_dataset('baseline_spe/base_ch0', data=rng.standard_normal((10, 1024)).astype(np.float32))
+        g.create_dataset('ch0', data=rng.standard_normal((2000, 1024)).astype(np.float32), chunks=(100, 1024))
+
+def get_upload_id(filename):
+    with h5py.File(filename, 'r') as f:
+        return db_upload.get_upload_id(f)
+
+def test_get_upload_id(tmp_path):
+    filename = tmp_path / 'run.hdf5'
+    make_run(filename)
+    upload_id = get_upload_id(filename)
+    assert upload_id == get_upload_id(filename)
+
+    # A copy or a touched file is the same run
+    copy = tmp_path / 'copy.hdf5'
+    shutil.copy(filename, copy)
+    os.utime(copy, ns=(0, 0))
+    assert get_upload_id(copy) == upload_id
+
+    # but another run with the same settings isn't
+    make_run(copy)
+    assert get_upload_id(copy) != upload_id
+
+    # and neither is the same run with other settings
+    shutil.copy(filename, copy)
+    with h5py.File(copy, 'a') as f:
+        f['spe'].attrs['barcode'] = 2
+    assert get_upload_id(copy) != upload_id
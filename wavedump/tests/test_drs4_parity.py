@@ -0,0 +1,16 @@
+"""
+Runs `drs4-parity`, which checks the offline DRS4 corrections against
+`ApplyDataCorrection` in `X742CorrectionRoutines.c`. Skipped if there's no C
+compiler.
+"""
+
+from __future__ import print_function, division
+import shutil
+import pytest
+from conftest import run_script
+
+@pytest.mark.skipif(shutil.which('cc') is None, reason="no C compiler")
+@pytest.mark.parametrize('frequency', [750, 1000, 5000])
+def test_drs4_parity(frequency):
+    output = run_script('drs4-parity', '-n', 20, '--frequency', frequency, '--seed', frequency)
+    assert 'drs4_correction matches ApplyDataCorrection' in output
@@ -0,0 +1,106 @@
+"""
+Tests of the numpy SPE and 511 fits on histograms with known truth.
+"""
+
+from __future__ import print_function, division
+import numpy as np
+import h5py
+import pytest
+import fit_numpy_funcs
+import vinogradov
+from conftest import run_script
+
+def make_spe_hist(seed, offset, spe_charge, l=1.0, entries=5000):
+    """
+    Returns the raw and filtered charge histograms of `entries` SPE events
+    with a zero peak at `offset`, binned like `analyze-waveforms` does.
+    """
+    rng = np.random.default_rng(seed)
+    npe = rng.poisson(l, entries)
+    charge = offset + npe*spe_charge + np.sqrt(0.12**2 + npe*0.08**2)*rng.standard_normal(entries)
+    f_charge = 0.01*rng.standard_normal(entries)
+    edges = np.arange(np.percentile(charge, 1), np.percentile(charge, 99), 0.04)
+    f_edges = np.linspace(-0.04, 0.04, 50)
+    return np.histogram(charge, edges)[0], edges, np.histogram(f_charge, f_edges)[0], f_edges
+
+def test_vinogradov_pmf():
+    for l, ps in [(0.5, 0), (1.0, 0.1), (2.0, 0.25)]:
+        pmf = vinogradov.vinogradov_pmf(20, l, ps)
+        assert np.allclose(pmf, [vinogradov.vinogradov(N, l, ps) for N in range(20)])
+
+        # Check the derivatives against finite differences
+        pmf, dpmf_dl, dpmf_dps = vinogradov.vinogradov_pmf_grad(20, l, ps)
+        assert np.allclose(pmf, vinogradov.vinogradov_pmf(20, l, ps))
+        h = 1e-6
+        assert np.allclose(dpmf_dl, (vinogradov.vinogradov_pmf(20, l+h, ps) - vinogradov.vinogradov_pmf(20, l-h, ps))/(2*h), atol=1e-6)
+        if ps > 0:
+            assert np.allclose(dpmf_dps, (vinogradov.vinogradov_pmf(20, l, ps+h) - vinogradov.vinogradov_pmf(20, l, ps-h))/(2*h), atol=1e-6)
+
+@pytest.mark.parametrize('offset', [0, -0.5])
+@pytest.mark.parametrize('filtered', [True, False])
+def test_fit_spe(offset, filtered):
+    # The filtered charges are always centered at zero, so an offset of -0.5
+    # means the zero peak isn't where the filtered data says it is.
+    for seed in range(3):
+        counts, edges, f_counts, f_edges = make_spe_hist(seed, offset, 0.8)
+        if filtered:
+            fit = fit_numpy_funcs.fit_spe(counts, edges, f_counts, f_edges)
+        else:
+            fit = fit_numpy_funcs.fit_spe(counts, edges)
+        assert fit is not None
+        assert fit[0] == pytest.approx(0.8, abs=4*fit[1])
+        assert fit[1] < 0.01
+
+def test_fit_511():
+    for seed in range(3):
+        rng = np.random.default_rng(seed)
+        energy = np.where(rng.random(2000) < 0.4, 0.511, rng.uniform(0, 0.3407, 2000))
+        charge = 0.95*rng.poisson(1000*energy)
+        charge = charge[charge > 200]
+        edges = np.arange(np.percentile(charge, 1), np.percentile(charge, 99), 15)
+        fit = fit_numpy_funcs.fit_511(np.histogram(charge, edges)[0], edges)
+        assert fit is not None
+        assert fit[0] == pytest.approx(0.95*511, abs=4*fit[1])
+
+def test_fit_511_degenerate():
+    # A single filled bin doesn't constrain the gaussian at all
+    edges = np.linspace(0, 100, 101)
+    counts = np.zeros(100)
+    counts[50] = 100
+    assert fit_numpy_funcs.fit_511(counts, edges) is None
+
+def test_analyze_waveforms(generated, tmp_path):
+    output = str(tmp_path / 'output.hdf5')
+    run_script('analyze-waveforms', generated, '-o', output, '--fit-backend', 'numpy', '--no-cache')
+
+    with h5py.File(generated, 'r') as f:
+        truth_spe_charge = f.attrs['truth_spe_charge']
+        truth_light_yield = f.attrs['truth_light_yield']
+
+    with h5py.File(output, 'r') as f:
+        spe = f['spe_ch0'].attrs['fit']
+        sodium = f['sodium_ch0'].attrs['fit']
+
+    # The charges themselves aren't exactly linear in the number of PEs (the
+    # baseline subtraction moves the zero peak by about 0.2 pC with respect to
+    # the other peaks), so this only checks the fits don't go off the rails.
+    assert spe[0] == pytest.approx(truth_spe_charge, rel=0.2)
+    assert sodium[0]/spe[0]/0.511 == pytest.approx(truth_light_yield, rel=0.15)
+
+def test_root_cross_check():
+    ROOT = pytest.importorskip('ROOT')
+    import fit_spe_funcs
+
+    counts, edges, f_counts, f_edges = make_spe_hist(0, -0.5, 0.8)
+    h = ROOT.TH1D('h', 'h', len(counts), edges)
+    f_h = ROOT.TH1D('f_h', 'f_h', len(f_counts), f_edges)
+    for i in range(len(counts)):
+        h.SetBinContent(i+1, counts[i])
+    for i in range(len(f_counts)):
+        f_h.SetBinContent(i+1, f_counts[i])
+    h.SetEntries(np.sum(counts))
+    f_h.SetEntries(np.sum(f_counts))
+
+    root_fit = fit_spe_funcs.fit_spe(h, fit_spe_funcs.fast_vinogradov_model(h), f_h=f_h)
+    numpy_fit = fit_numpy_funcs.fit_spe(counts, edges, f_counts, f_edges)
+    assert numpy_fit[0] == pytest.approx(root_fit[0], abs=2*root_fit[1])
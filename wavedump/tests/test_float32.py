@@ -0,0 +1,48 @@
+"""
+Tests that `analyze-waveforms --float32` gives the same charges and fits as
+the default float64 path.
+"""
+
+from __future__ import print_function, division
+from argparse import Namespace
+import numpy as np
+import h5py
+import pytest
+import fit_numpy_funcs
+from conftest import load_script
+
+def analyze(filename, group, float32):
+    aw = load_script('analyze-waveforms')
+    args = Namespace(chunks=10000, float32=float32, stream=False, drs4_correction=7,
+                     drs4_tables=None, start_time=[50], integration_time=[300],
+                     integration_method=1)
+    with h5py.File(filename, 'r') as f:
+        result = aw.analyze_channel(f, group, 'ch0', args)
+    # The same histograms as the ones `analyze-waveforms` fits
+    result['counts'], result['edges'] = aw.get_numpy_hist(result['charge'], result['bins'])
+    if 'f_charge' in result:
+        result['f_counts'], result['f_edges'] = aw.get_numpy_hist(result['f_charge'], result['f_bins'])
+    return result
+
+@pytest.mark.parametrize('group', ['sodium', 'spe'])
+def test_float32(generated, group):
+    result = analyze(generated, group, False)
+    result32 = analyze(generated, group, True)
+
+    assert result32['charge'].dtype == np.float32
+    np.testing.assert_allclose(result32['charge'], result['charge'], rtol=1e-5, atol=1e-5*np.std(result['charge']))
+    assert np.array_equal(result32['counts'], result['counts'])
+
+    if group == 'sodium':
+        fit = fit_numpy_funcs.fit_511(result['counts'], result['edges'])
+        fit32 = fit_numpy_funcs.fit_511(result32['counts'], result32['edges'])
+    else:
+        # The filtered charges are mostly noise around zero, so they're
+        # integrated with more cancellation than the charges. The recursion
+        # of the filter itself is always done in float64.
+        np.testing.assert_allclose(result32['f_charge'], result['f_charge'], rtol=1e-3, atol=1e-4*np.std(result['f_charge']))
+        fit = fit_numpy_funcs.fit_spe(result['counts'], result['edges'], result['f_counts'], result['f_edges'])
+        fit32 = fit_numpy_funcs.fit_spe(result32['counts'], result32['edges'], result32['f_counts'], result32['f_edges'])
+
+    assert fit32[0] == pytest.approx(fit[0], abs=0.1*fit[1])
+    assert fit32[1] == pytest.approx(fit[1], rel=0.01)
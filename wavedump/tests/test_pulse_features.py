@@ -0,0 +1,57 @@
+"""
+Tests of the single pass pulse feature extraction.
+"""
+
+from __future__ import print_function, division
+import warnings
+import numpy as np
+import pulse_features
+
+def get_crossings_loop(y, fraction):
+    """
+    Returns the samples before the leading and trailing edge crossings of
+    `fraction` times the minimum of the waveform `y`, one sample at a time.
+    """
+    argmin = np.argmin(y)
+    threshold = fraction*y[argmin]
+    il_rising = il_falling = -1
+    for i in range(argmin - 1, -1, -1):
+        if y[i] > threshold:
+            il_rising = i
+            break
+    for i in range(argmin + 1, len(y)):
+        if y[i] > threshold:
+            il_falling = i - 1
+            break
+    return il_rising, il_falling
+
+def get_waveforms(nevents=500, nsamples=256):
+    rng = np.random.default_rng(0)
+    t = np.arange(nsamples)
+    y = 0.5*rng.standard_normal((nevents, nsamples))
+    for i in range(nevents):
+        # Pulses which are cut off at either end of the waveform, or are
+        # entirely outside of it
+        t0 = rng.uniform(-50, nsamples + 10)
+        y[i] -= rng.uniform(0, 50)*np.where(t > t0, np.exp(-(t - t0)/40) - np.exp(-(t - t0)/3), 0)
+    return y
+
+def test_get_crossings():
+    y = get_waveforms()
+    argmin = np.argmin(y, axis=-1)
+    amplitude = y[np.arange(len(y)), argmin]
+    fractions = (pulse_features.LOW, pulse_features.T0, pulse_features.HIGH)
+    crossings = pulse_features.get_crossings(y, argmin, amplitude, fractions)
+    for fraction in fractions:
+        expected = np.array([get_crossings_loop(row, fraction) for row in y])
+        np.testing.assert_array_equal(crossings[fraction][0], expected[:,0])
+        np.testing.assert_array_equal(crossings[fraction][1], expected[:,1])
+
+def test_flat_waveforms():
+    x = np.arange(256, dtype=float)
+    y = np.concatenate((np.zeros((2, 256)), np.ones((2, 256)), get_waveforms(10)))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        features, a, b = pulse_features.extract_features(x, y, 10, 100)
+    for name in ('t0', 'rise_time', 'fall_time'):
+        assert np.all(np.isnan(features[name][:4]))
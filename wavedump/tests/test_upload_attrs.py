@@ -0,0 +1,46 @@
+"""
+Tests of the check that the sodium and SPE data of a run were taken with the
+same settings before it's uploaded.
+"""
+
+from __future__ import print_function, division
+import h5py
+import numpy as np
+import pytest
+from conftest import load_script
+
+aw = load_script('analyze-waveforms')
+
+ATTRS = {'record_length': 1024, 'data_source': np.bytes_('CAEN'), 'post_trigger': 50, 'drs4_frequency': 1000,
+         'barcode': 1, 'voltage': 50, 'git_sha1': np.bytes_('abcdef12'), 'git_dirty': np.bytes_('0'),
+         'encoding': np.bytes_('float32'), 'adc_scale': 1, 'shuffle': 0, 'gzip_compression_level': 9,
+         'starting_channel': 0, 'raw': 0}
+
+def make_file(filename, sodium={}, spe={}):
+    f = h5py.File(filename, 'w')
+    for group, attrs in (('sodium', sodium), ('spe', spe)):
+        g = f.create_group(group)
+        for name, value in dict(ATTRS, **attrs).items():
+            g.attrs[name] = value
+    return f
+
+def test_same_settings(tmp_path):
+    with make_file(tmp_path / 'run.hdf5') as f:
+        aw.check_upload_attrs(f)
+
+def test_storage_attrs(tmp_path):
+    # The SPE data taken with --uint16 and the sodium data without
+    with make_file(tmp_path / 'run.hdf5', spe={'encoding': np.bytes_('uint16'), 'adc_scale': 4, 'shuffle': 1}) as f:
+        aw.check_upload_attrs(f)
+
+def test_conflict(tmp_path):
+    with make_file(tmp_path / 'run.hdf5', spe={'voltage': 51}) as f:
+        with pytest.raises(SystemExit):
+            aw.check_upload_attrs(f)
+
+def test_charge_only(tmp_path):
+    # Sodium data taken with --charge-only and SPE data with the waveforms
+    charge_only = {'charge_only': 1, 'prescale': 100, 'charge_start_time': 50.0,
+                   'charge_integration_time': 300.0, 'charge_baseline_time': 20.0}
+    with make_file(tmp_path / 'run.hdf5', sodium=charge_only) as f:
+        aw.check_upload_attrs(f)
@@ -17,7 +17,9 @@ CREATE TABLE runs (
     institution         inst DEFAULT 'Caltech'::inst NOT NULL,
     git_sha1            text,
     git_dirty           text,
-    filename            text
+    filename            text,
+    -- identity of the input file, so the same file is only uploaded once
+    upload_id           text UNIQUE
 );
 
 -- Table to keep track of the light yield of the BTL modules.
@@ -96,3 +98,10 @@ GRANT SELECT ON ALL SEQUENCES IN SCHEMA public TO cms;
 -----------------------------
 
 ALTER TABLE data OWNER TO btl_admin;
+
+-------------------------------------------------------------------
+-- Indexes, the summary of every run and module, and the cache version
+-------------------------------------------------------------------
+
+\ir run_summary.sql
+\ir cache_version.sql
@@ -0,0 +1,250 @@
+"""
+Cache of the results of the moduledb queries shared by all the gunicorn
+workers.
+
+The results of a module or a channel never change once they're uploaded, so
+the only thing which changes the results of a query is a new run, channel, or
+module being inserted. Every statement which changes the runs, data, or
+modules tables increments the version in the cache_version table (see
+cache_version.sql), and every cached result is stored along with the version
+it was selected at. Each worker checks the version at most once every
+CACHE_VERSION_INTERVAL seconds, and only looks up results of the version it
+last saw.
+
+The results are stored in an sqlite database on the local disk, which is
+shared between the workers without needing another server. A hit only reads
+from it, so the workers never wait on each other for a hit. Results are only
+written on a miss, in a single transaction which:
+
+    - moves the newest version any worker has seen forward to this worker's
+      version (compare-and-set, so a worker which hasn't seen the new version
+      yet can't move it back),
+    - doesn't store the result if a newer version has already been seen,
+      since it's already out of date,
+    - deletes the results of older versions and the expired ones,
+    - evicts the results which expire first once there are more than
+      CACHE_MAX_ENTRIES.
+
+Results expire after CACHE_TTL seconds. The number of hits and misses of
+every query is counted by each worker and added to the same database on the
+next miss, or every CACHE_STATS_INTERVAL seconds, see stats(). The cache can
+be turned off by setting CACHE_ENABLED to False.
+"""
+from __future__ import print_function, division
+from .views import app
+from .db import connection
+from functools import wraps
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+
+CACHE_PATH = app.config.get('CACHE_PATH', os.path.join(tempfile.gettempdir(), 'btl-testing-cache.sqlite'))
+CACHE_TTL = app.config.get('CACHE_TTL', 300)
+CACHE_MAX_ENTRIES = app.config.get('CACHE_MAX_ENTRIES', 1000)
+CACHE_VERSION_INTERVAL = app.config.get('CACHE_VERSION_INTERVAL', 5)
+CACHE_STATS_INTERVAL = app.config.get('CACHE_STATS_INTERVAL', 60)
+
+# sqlite connections can't be shared with the processes gunicorn forks, so
+# this is the connection of the current process and the pid it was opened by.
+_conn = None
+_pid = None
+
+# Latest version of the database and when it was checked.
+_version = None
+_version_time = 0
+
+# Hits and misses of every query which haven't been written to the stats
+# table yet, and when they were last written.
+_counts = {}
+_counts_time = 0
+
+def get_conn():
+    global _conn, _pid, _counts, _counts_time
+
+    if _conn is None or _pid != os.getpid():
+        _conn = sqlite3.connect(CACHE_PATH, timeout=5, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, version INTEGER, expires REAL, value BLOB)")
+        _conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_idx ON cache (expires)")
+        _conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, hits INTEGER DEFAULT 0, misses INTEGER DEFAULT 0)")
+        _conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        _pid = os.getpid()
+        # The counts of the parent process were forked along with it.
+        _counts = {}
+        _counts_time = time.time()
+
+    return _conn
+
+def get_version():
+    """
+    Returns the version of the btl_qa database, checking it at most once
+    every CACHE_VERSION_INTERVAL seconds.
+    """
+    global _version, _version_time
+
+    now = time.time()
+
+    if _version is None or now - _version_time > CACHE_VERSION_INTERVAL:
+        with connection() as conn:
+            _version = conn.execute("SELECT version FROM cache_version").scalar()
+        _version_time = now
+
+    return _version
+
+def invalidate():
+    """
+    Makes this worker check the version of the database on the next query.
+    The other workers will see the new version within CACHE_VERSION_INTERVAL
+    seconds.
+    """
+    global _version
+
+    _version = None
+
+def make_key(name, args, kwargs):
+    """
+    Returns the cache key of a call to `name` with arguments `args` and
+    `kwargs`. Dictionaries in the arguments, like the route arguments, are
+    sorted so the key doesn't depend on their order.
+    """
+    def sort(value):
+        if isinstance(value, dict):
+            return tuple(sorted((k, sort(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(sort(v) for v in value)
+        return value
+
+    return repr((name, sort(args), sort(kwargs)))
+
+def record(name, hit):
+    """
+    Counts a hit or a miss of the query `name` in this worker.
+    """
+    counts = _counts.setdefault(name, [0, 0])
+    counts[0 if hit else 1] += 1
+
+def add_counts(conn):
+    """
+    Adds the hits and misses counted by this worker to the stats table. This
+    should be called in a transaction, and the counts cleared with
+    clear_counts() once it's committed.
+    """
+    for name, (hits, misses) in _counts.items():
+        conn.execute("INSERT OR IGNORE INTO stats (name) VALUES (?)", (name,))
+        conn.execute("UPDATE stats SET hits = hits + ?, misses = misses + ? WHERE name = ?", (hits, misses, name))
+
+def clear_counts():
+    global _counts, _counts_time
+
+    _counts = {}
+    _counts_time = time.time()
+
+def flush_counts(conn):
+    """
+    Writes the hits and misses counted by this worker to the stats table.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        add_counts(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    clear_counts()
+
+def write(conn, key, version, now, result):
+    """
+    Stores `result` of `version` under `key`, unless a newer version has
+    already been seen by another worker, along with the hits and misses
+    counted by this worker. Returns the newest version seen by any worker.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('version', ?)", (version,))
+        conn.execute("UPDATE meta SET value = ? WHERE name = 'version' AND value < ?", (version, version))
+        newest = conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+        conn.execute("DELETE FROM cache WHERE version < ? OR expires <= ?", (newest, now))
+        if version == newest:
+            conn.execute("INSERT OR REPLACE INTO cache (key, version, expires, value) VALUES (?, ?, ?, ?)",
+                         (key, version, now + CACHE_TTL, sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))))
+            conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)", (CACHE_MAX_ENTRIES,))
+        add_counts(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    clear_counts()
+
+    return newest
+
+def cached(func):
+    """
+    Decorator which caches the results of a moduledb query. If the cache
+    can't be used for some reason, the query is just run as if it wasn't
+    cached.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not app.config.get('CACHE_ENABLED', True):
+            return func(*args, **kwargs)
+
+        try:
+            version = get_version()
+            conn = get_conn()
+            key = make_key(name, args, kwargs)
+            now = time.time()
+
+            row = conn.execute("SELECT value FROM cache WHERE key = ? AND version = ? AND expires > ?", (key, version, now)).fetchone()
+
+            if row is not None:
+                record(name, True)
+                if now - _counts_time > CACHE_STATS_INTERVAL:
+                    try:
+                        flush_counts(conn)
+                    except sqlite3.Error as e:
+                        app.logger.warning("failed to write the cache stats: %s" % str(e))
+                return pickle.loads(row[0])
+
+            record(name, False)
+        except Exception as e:
+            app.logger.warning("query cache unavailable: %s" % str(e))
+            return func(*args, **kwargs)
+
+        result = func(*args, **kwargs)
+
+        try:
+            if write(conn, key, version, now, result) > version:
+                # Another worker has already seen a newer version.
+                invalidate()
+        except Exception as e:
+            app.logger.warning("failed to cache the result of %s: %s" % (name, str(e)))
+
+        return result
+
+    return wrapper
+
+def stats():
+    """
+    Returns a dictionary with the number of hits and misses of every cached
+    query and the number of results in the cache. The hits and misses of the
+    other workers since their last miss (or at most CACHE_STATS_INTERVAL
+    seconds) aren't included yet.
+    """
+    conn = get_conn()
+
+    flush_counts(conn)
+
+    queries = {}
+    for name, hits, misses in conn.execute("SELECT name, hits, misses FROM stats ORDER BY name"):
+        total = hits + misses
+        queries[name] = {'hits': hits, 'misses': misses, 'hit_rate': hits/total if total else None}
+
+    entries = conn.execute("SELECT count(*) FROM cache").fetchone()[0]
+
+    return {'queries': queries, 'entries': entries, 'max_entries': CACHE_MAX_ENTRIES, 'ttl': CACHE_TTL, 'version': get_version()}
@@ -1,8 +1,106 @@
 import sqlalchemy
+import sqlalchemy.exc
+import hashlib
+import threading
+from contextlib import contextmanager
+from flask import g, has_app_context
 from .views import app
 
+# Size of the connection pool of each gunicorn worker, and how many more
+# connections can be opened when they're all in use before requests have to
+# wait DB_POOL_TIMEOUT seconds for one to be returned.
+DB_POOL_SIZE = app.config.get('DB_POOL_SIZE', 5)
+DB_MAX_OVERFLOW = app.config.get('DB_MAX_OVERFLOW', 5)
+DB_POOL_TIMEOUT = app.config.get('DB_POOL_TIMEOUT', 10)
+
+# Size of the pool of connections for uploading new modules. These are opened
+# with the password entered in the form, so there's one small pool for every
+# password which was able to log in.
+DB_UPLOAD_POOL_SIZE = app.config.get('DB_UPLOAD_POOL_SIZE', 1)
+
 engine = sqlalchemy.create_engine('postgresql://%s:%s@%s:%i/%s' %
                                  (app.config['DB_USER'], app.config['DB_PASS'],
                                   app.config['DB_HOST'], app.config['DB_PORT'],
                                   app.config['DB_NAME']),
-                                  pool_recycle=3600)
+                                  pool_size=DB_POOL_SIZE,
+                                  max_overflow=DB_MAX_OVERFLOW,
+                                  pool_timeout=DB_POOL_TIMEOUT,
+                                  pool_recycle=3600,
+                                  pool_pre_ping=True)
+
+upload_engines = {}
+upload_engines_lock = threading.Lock()
+
+@contextmanager
+def connection():
+    """
+    Yields a connection to the database from the pool. Within a request, the
+    same connection is used for every query and is returned to the pool when
+    the request is over. Outside of a request, the connection is returned to
+    the pool when the block ends.
+    """
+    if has_app_context():
+        if 'db_conn' not in g:
+            g.db_conn = engine.connect()
+        yield g.db_conn
+    else:
+        conn = engine.connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+@app.teardown_appcontext
+def close_connection(exception):
+    conn = g.pop('db_conn', None)
+
+    if conn is not None:
+        conn.close()
+
+def get_upload_engine(password):
+    """
+    Returns the engine which connects to the database as the btl user with
+    `password`.
+    """
+    # Don't keep the password itself around as a key.
+    key = hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+    with upload_engines_lock:
+        if key not in upload_engines:
+            upload_engines[key] = sqlalchemy.create_engine('postgresql://',
+                connect_args={'dbname': app.config['DB_NAME'],
+                              'user': app.config['DB_BTL_USER'],
+                              'host': app.config['DB_HOST'],
+                              'port': app.config['DB_PORT'],
+                              'password': password},
+                pool_size=DB_UPLOAD_POOL_SIZE,
+                max_overflow=0,
+                pool_timeout=DB_POOL_TIMEOUT,
+                pool_recycle=3600,
+                pool_pre_ping=True)
+
+        return key, upload_engines[key]
+
+@contextmanager
+def upload_connection(password):
+    """
+    Yields a connection to the database as the btl user with `password` in a
+    transaction, which is committed if the block succeeds and rolled back
+    otherwise.
+    """
+    key, upload_engine = get_upload_engine(password)
+
+    try:
+        conn = upload_engine.connect()
+    except sqlalchemy.exc.OperationalError:
+        # Most likely the wrong password, so don't keep a pool for it.
+        with upload_engines_lock:
+            upload_engines.pop(key, None)
+        upload_engine.dispose()
+        raise
+
+    try:
+        with conn.begin():
+            yield conn
+    finally:
+        conn.close()
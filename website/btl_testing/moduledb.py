@@ -1,7 +1,6 @@
-from .db import engine
-from .views import app
-import psycopg2
-import psycopg2.extensions
+from .db import connection, upload_connection
+from .cache import cached, invalidate
+import sqlalchemy.exc
 from wtforms import Form, validators, IntegerField, SelectField, PasswordField, TextAreaField
 
 class ModuleUploadForm(Form):
@@ -18,140 +17,195 @@ def upload_new_module(form):
     """
     Upload a new module to the database.
     """
-    conn = psycopg2.connect(dbname=app.config['DB_NAME'],
-                            user=app.config['DB_BTL_USER'],
-                            host=app.config['DB_HOST'],
-                            password=form.password.data)
-    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    try:
+        with upload_connection(form.password.data) as conn:
+            conn.execute("INSERT INTO modules (barcode, sipm, institution, comments) VALUES (%s, %s, %s, %s)", (form.data['barcode'], form.data['sipm'], form.data['institution'], form.data['comments']))
+    except sqlalchemy.exc.DBAPIError as e:
+        # Show the error from the database instead of the sqlalchemy wrapper
+        # around it.
+        raise e.orig
 
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO modules (barcode, sipm, institution, comments) VALUES (%s, %s, %s, %s)", (form.data['barcode'], form.data['sipm'], form.data['institution'], form.data['comments']))
-    print(cursor.statusmessage)
+    invalidate()
 
+@cached
 def get_module_info(barcode, run=None):
-    conn = engine.connect()
-
-    query = "SELECT *, runs.institution as runs_institution, modules.timestamp as modules_timestamp, modules.institution as modules_institution, runs.timestamp as timestamp FROM (SELECT run, barcode, array_agg(key ORDER BY channel) as keys, array_agg(data.channel ORDER BY channel) as channels, array_agg(data.sodium_peak ORDER BY channel) as sodium_peak, array_agg(spe ORDER BY channel) as spe FROM data GROUP BY (run,barcode)) as channel, runs, modules WHERE channel.run = runs.run AND channel.barcode = modules.barcode"
+    """
+    Returns the results of module `barcode` in run `run`, or in the latest run
+    the module was tested in if `run` is None. The module fields are None if
+    the module hasn't been uploaded.
+    """
+    query = ("SELECT run_summary.run, run_summary.barcode, run_summary.keys, run_summary.channels, run_summary.sodium_peak, run_summary.spe, "
+             "runs.timestamp as timestamp, runs.voltage, runs.git_sha1, runs.git_dirty, runs.filename, runs.institution as runs_institution, "
+             "modules.timestamp as modules_timestamp, modules.sipm, modules.institution as modules_institution, modules.comments "
+             "FROM run_summary JOIN runs ON run_summary.run = runs.run LEFT JOIN modules ON run_summary.barcode = modules.barcode "
+             "WHERE run_summary.barcode = %(barcode)s")
 
     if run is not None:
-        vars = (barcode, run)
-        query += " AND channel.barcode = %s AND runs.run = %s"
-    else:
-        vars = (barcode,)
-        query += " AND channel.barcode = %s"
+        query += " AND run_summary.run = %(run)s"
 
-    query += " ORDER BY runs.timestamp DESC"
+    query += " ORDER BY run_summary.run_timestamp DESC, run_summary.run DESC LIMIT 1"
 
-    result = conn.execute(query,vars)
+    with connection() as conn:
+        result = conn.execute(query, {'barcode': barcode, 'run': run})
 
-    keys = result.keys()
-    row = result.fetchone()
+        keys = result.keys()
+        row = result.fetchone()
 
     if row is None:
-        # No module info?
-        query = "SELECT *, runs.institution as runs_institution, runs.timestamp as timestamp FROM (SELECT run, barcode, array_agg(key ORDER BY channel) as keys, array_agg(data.channel ORDER BY channel) as channels, array_agg(data.sodium_peak ORDER BY channel) as sodium_peak, array_agg(spe ORDER BY channel) as spe FROM data GROUP BY (run,barcode)) as channel, runs WHERE channel.run = runs.run"
+        return None
 
-        if run is not None:
-            vars = (barcode, run)
-            query += " AND channel.barcode = %s AND runs.run = %s"
-        else:
-            vars = (barcode,)
-            query += " AND channel.barcode = %s"
+    return dict(zip(keys,row))
 
-        query += " ORDER BY runs.timestamp DESC"
+# Columns of the data table shown in the channel listing and on the channel
+# status page. The histograms and the average pulse are much bigger than the
+# rest of the row, so they're only selected by get_channel_arrays().
+CHANNEL_COLUMNS = ['key', 'channel', 'timestamp', 'barcode', 'sodium_peak', 'spe', 'sodium_fall_time', 'sodium_rise_time', 'run']
 
-        result = conn.execute(query,vars)
+CHANNEL_ARRAYS = ['sodium_charge_histogram_x', 'sodium_charge_histogram_y', 'spe_charge_histogram_x', 'spe_charge_histogram_y', 'avg_pulse_x', 'avg_pulse_y']
+
+@cached
+def get_channel_info(key):
+    """
+    Returns the results of the channel with key `key` without the histograms
+    and the average pulse, or None if there is no such channel. The module
+    fields are None if the module hasn't been uploaded.
+    """
+    query = ("SELECT %s, runs.voltage, runs.git_sha1, runs.git_dirty, runs.filename, runs.institution as runs_institution, "
+             "modules.timestamp as modules_timestamp, modules.sipm, modules.institution as modules_institution, modules.comments "
+             "FROM data JOIN runs ON data.run = runs.run LEFT JOIN modules ON data.barcode = modules.barcode "
+             "WHERE data.key = %%s") % ", ".join("data.%s" % column for column in CHANNEL_COLUMNS)
+
+    with connection() as conn:
+        result = conn.execute(query, (key,))
 
         keys = result.keys()
         row = result.fetchone()
 
-        if row is None:
-            return None
+    if row is None:
+        return None
 
     return dict(zip(keys,row))
 
-def get_channel_info(key):
-    conn = engine.connect()
-
-    query = "SELECT *, runs.institution as runs_institution, modules.timestamp as modules_timestamp, modules.institution as modules_institution, data.timestamp as timestamp FROM data, modules, runs WHERE data.barcode = modules.barcode AND data.run = runs.run AND key = %s"
-
-    result = conn.execute(query, (key,))
-
-    keys = result.keys()
-    row = result.fetchone()
-
-    if row is None:
-        # Maybe no module uploaded?
-        query = "SELECT *, runs.institution as runs_institution, data.timestamp as timestamp FROM data, runs WHERE data.run = runs.run AND key = %s"
+@cached
+def get_channel_arrays(key):
+    """
+    Returns the histograms and the average pulse of the channel with key
+    `key`, or None if there is no such channel.
+    """
+    query = "SELECT %s FROM data WHERE key = %%s" % ", ".join(CHANNEL_ARRAYS)
 
+    with connection() as conn:
         result = conn.execute(query, (key,))
 
         keys = result.keys()
         row = result.fetchone()
 
+    if row is None:
+        return None
+
     return dict(zip(keys,row))
 
-def get_modules(kwargs, limit=100, offset=0, sort_by=None):
+def fetch_page(conn, query, params, limit, before):
     """
-    Returns a list of the latest data for individual channels. `kwargs` should
-    be a dictionary containing fields and their associated values to select on.
-    For example, to select only channels that have low occupancy:
+    Returns a tuple (rows, more) of the first `limit` rows of `query`, and
+    whether there are any more rows after them. `query` should select one
+    more row than `limit` so we can tell whether there are more. If `before`
+    is True, the query is sorted in the opposite order of the page, and the
+    rows are reversed.
+    """
+    result = conn.execute(query, params)
+
+    keys = result.keys()
+    rows = [dict(zip(keys,row)) for row in result.fetchall()]
 
-        >>> get_channels({'low_occupancy': True})
+    more = len(rows) > limit
+    rows = rows[:limit]
 
-    `limit` should be the maximum number of records returned.
+    if before:
+        rows.reverse()
+
+    return rows, more
+
+@cached
+def get_modules(kwargs, limit=100, after=None, before=None):
+    """
+    Returns a tuple (rows, more) of the latest modules tested, newest first,
+    and whether there are any more modules past the end of the page. `kwargs`
+    should be a dictionary containing fields and their associated values to
+    select on. For example, to select only the runs of a single module:
+
+        >>> get_modules({'barcode': 100})
+
+    `limit` should be the maximum number of records returned. The modules are
+    paged through with the (run, barcode) of a row instead of an offset, so
+    that we never have to count the rows before the page. If `after` is
+    given, the page starts after that row, and if `before` is given, the page
+    ends before it, in which case `more` says whether there are any modules
+    before the page.
     """
-    conn = engine.connect()
+    params = {'limit': limit + 1}
 
-    query = "SELECT * FROM (SELECT min(timestamp) as timestamp, run, barcode FROM data GROUP BY (run, barcode)) as channel, runs WHERE channel.run = runs.run"
+    conditions = []
+    if kwargs.get('barcode') is not None:
+        conditions.append("run_summary.barcode = %(barcode)s")
+        params['barcode'] = kwargs['barcode']
 
-    if sort_by == 'timestamp':
-        query += " ORDER BY runs.timestamp DESC LIMIT %i OFFSET %i" % (limit,offset)
-    else:
-        query += " ORDER BY runs.timestamp DESC LIMIT %i OFFSET %i" % (limit,offset)
+    cursor = after if before is None else before
+    if cursor is not None:
+        conditions.append("(run_summary.run_timestamp, run_summary.run, run_summary.barcode) %s ((SELECT timestamp FROM runs WHERE run = %%(cursor_run)s), %%(cursor_run)s, %%(cursor_barcode)s)" % ('>' if before is not None else '<'))
+        params['cursor_run'], params['cursor_barcode'] = cursor
 
-    result = conn.execute(query, kwargs)
+    query = "SELECT run_summary.run, run_summary.barcode, run_summary.run_timestamp as timestamp, runs.voltage, runs.institution FROM run_summary JOIN runs ON run_summary.run = runs.run"
+    if len(conditions):
+        query += " WHERE %s" % (" AND ".join(conditions))
 
-    if result is None:
-        return None
+    if before is not None:
+        query += " ORDER BY run_summary.run_timestamp, run_summary.run, run_summary.barcode"
+    else:
+        query += " ORDER BY run_summary.run_timestamp DESC, run_summary.run DESC, run_summary.barcode DESC"
 
-    keys = result.keys()
-    rows = result.fetchall()
+    query += " LIMIT %(limit)s"
 
-    return [dict(zip(keys,row)) for row in rows]
+    with connection() as conn:
+        return fetch_page(conn, query, params, limit, before is not None)
 
-def get_channels(kwargs, limit=100, offset=0, sort_by=None):
+@cached
+def get_channels(kwargs, limit=100, after=None, before=None):
     """
-    Returns a list of the latest data for individual channels. `kwargs` should
-    be a dictionary containing fields and their associated values to select on.
-    For example, to select only channels that have low occupancy:
+    Returns a tuple (rows, more) of the latest data for individual channels,
+    newest first, and whether there are any more channels past the end of the
+    page. `kwargs` should be a dictionary containing fields and their
+    associated values to select on. For example, to select only the channels
+    of a single module:
 
-        >>> get_channels({'low_occupancy': True})
+        >>> get_channels({'barcode': 100})
 
-    `limit` should be the maximum number of records returned.
+    `limit` should be the maximum number of records returned. `after` and
+    `before` are the key of the row the page starts after or ends before, see
+    get_modules().
     """
-    conn = engine.connect()
+    params = {'limit': limit + 1}
 
     conditions = []
-    for key in kwargs:
-        if key == 'barcode':
-            conditions.append("%s = %%(%s)s" % (key, key))
+    if kwargs.get('barcode') is not None:
+        conditions.append("data.barcode = %(barcode)s")
+        params['barcode'] = kwargs['barcode']
 
-    query = "SELECT * FROM data"
+    cursor = after if before is None else before
+    if cursor is not None:
+        conditions.append("(data.timestamp, data.key) %s ((SELECT timestamp FROM data WHERE key = %%(cursor)s), %%(cursor)s)" % ('>' if before is not None else '<'))
+        params['cursor'] = cursor
+
+    query = "SELECT %s FROM data" % ", ".join("data.%s" % column for column in CHANNEL_COLUMNS)
     if len(conditions):
-        query += " WHERE %s " % (" AND ".join(conditions))
+        query += " WHERE %s" % (" AND ".join(conditions))
 
-    if sort_by == 'timestamp':
-        query += " ORDER BY data.timestamp DESC LIMIT %i OFFSET %i" % (limit,offset)
+    if before is not None:
+        query += " ORDER BY data.timestamp, data.key"
     else:
-        query += " ORDER BY data.timestamp DESC LIMIT %i OFFSET %i" % (limit,offset)
-
-    result = conn.execute(query, kwargs)
+        query += " ORDER BY data.timestamp DESC, data.key DESC"
 
-    if result is None:
-        return None
-
-    keys = result.keys()
-    rows = result.fetchall()
+    query += " LIMIT %(limit)s"
 
-    return [dict(zip(keys,row)) for row in rows]
+    with connection() as conn:
+        return fetch_page(conn, query, params, limit, before is not None)
@@ -10,9 +10,13 @@ from math import isnan
 import os
 import sys
 import random
-from .moduledb import get_channels, get_channel_info, ModuleUploadForm, upload_new_module, get_modules, get_module_info
+from .moduledb import get_channels, get_channel_info, get_channel_arrays, ModuleUploadForm, upload_new_module, get_modules, get_module_info
+from .cache import stats as cache_stats
 from datetime import datetime
 import pytz
+import gzip
+import hashlib
+from io import BytesIO
 
 @app.template_filter('timefmt')
 def timefmt(timestamp):
@@ -22,21 +26,55 @@ def timefmt(timestamp):
 def internal_error(exception):
     return render_template('500.html'), 500
 
+def parse_cursor(value):
+    """
+    Returns the (run, barcode) of a row of the module database from the
+    string "run-barcode" in the URL, or None if it's missing or invalid.
+    """
+    try:
+        run, barcode = value.split('-')
+        return int(run), int(barcode)
+    except (AttributeError, ValueError):
+        return None
+
+def page_links(rows, more, after, before, cursor):
+    """
+    Returns the cursors of the previous and next pages of `rows`, or None if
+    there is no previous or next page. `cursor` should be a function
+    returning the cursor of a row.
+    """
+    if len(rows) == 0:
+        # Past the end in either direction, so just go back to the start.
+        return None, None
+
+    if before is not None:
+        prev = cursor(rows[0]) if more else None
+        next = cursor(rows[-1])
+    else:
+        prev = cursor(rows[0]) if after is not None else None
+        next = cursor(rows[-1]) if more else None
+
+    return prev, next
+
 @app.route('/module-database')
 def module_database():
     limit = request.args.get("limit", 100, type=int)
-    offset = request.args.get("offset", 0, type=int)
-    sort_by = request.args.get("sort-by", "timestamp")
-    results = get_modules(request.args, limit, offset, sort_by)
-    return render_template('module_database.html', results=results, limit=limit, offset=offset, sort_by=sort_by)
+    after = parse_cursor(request.args.get("after"))
+    before = parse_cursor(request.args.get("before"))
+    barcode = request.args.get("barcode", None, type=int)
+    results, more = get_modules({'barcode': barcode}, limit, after, before)
+    prev, next = page_links(results, more, after, before, lambda row: "%i-%i" % (row['run'], row['barcode']))
+    return render_template('module_database.html', results=results, limit=limit, barcode=barcode, prev=prev, next=next)
 
 @app.route('/channel-database')
 def channel_database():
     limit = request.args.get("limit", 100, type=int)
-    offset = request.args.get("offset", 0, type=int)
-    sort_by = request.args.get("sort-by", "timestamp")
-    results = get_channels(request.args, limit, offset, sort_by)
-    return render_template('channel_database.html', results=results, limit=limit, offset=offset, sort_by=sort_by)
+    after = request.args.get("after", None, type=int)
+    before = request.args.get("before", None, type=int)
+    barcode = request.args.get("barcode", None, type=int)
+    results, more = get_channels({'barcode': barcode}, limit, after, before)
+    prev, next = page_links(results, more, after, before, lambda row: row['key'])
+    return render_template('channel_database.html', results=results, limit=limit, barcode=barcode, prev=prev, next=next)
 
 @app.template_filter('time_from_now')
 def time_from_now(dt):
@@ -108,6 +146,66 @@ def channel_status():
         return redirect(url_for('channel_database'))
     return render_template('channel_status.html', info=info)
 
+def gzip_response(response):
+    """
+    Compresses the body of `response` with gzip if the client accepts it.
+    """
+    response.vary.add('Accept-Encoding')
+
+    if 'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return response
+
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(response.get_data())
+
+    response.set_data(buf.getvalue())
+    response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+@app.route('/channel-arrays')
+def channel_arrays():
+    """
+    Returns the histograms and the average pulse of a channel as JSON. These
+    are fetched by the channel status page after it's loaded, so they aren't
+    selected along with the rest of the channel.
+
+    The results of a channel are never changed once they're uploaded, so the
+    response can be cached by the browser and is revalidated with its ETag.
+    """
+    key = request.args.get("key", 0, type=int)
+    arrays = get_channel_arrays(key)
+
+    if arrays is None:
+        return jsonify(error="no channel with key %i" % key), 404
+
+    # NaNs aren't valid JSON, so send them as null, which the plots skip.
+    for name, values in arrays.items():
+        if values is not None:
+            arrays[name] = [None if value is None or isnan(value) else value for value in values]
+
+    data = json.dumps(arrays, separators=(',',':')).encode('utf-8')
+
+    response = make_response(data)
+    response.mimetype = 'application/json'
+    response.set_etag(hashlib.sha1(data).hexdigest(), weak=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    response.make_conditional(request)
+
+    if response.status_code == 304:
+        return response
+
+    return gzip_response(response)
+
+@app.route('/cache-stats')
+def cache_stats_view():
+    """
+    Returns the number of hits and misses of the query cache as JSON.
+    """
+    return jsonify(cache_stats())
+
 @app.route('/')
 def index():
     return redirect(url_for('module_database'))
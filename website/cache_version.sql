@@ -0,0 +1,47 @@
+-- Version counter used by the website to invalidate its cache of query
+-- results. This is included from btl_qa.sql, and can also be run on its own
+-- to upgrade an existing database:
+--
+--     $ psql btl_qa -f cache_version.sql
+--
+-- Everything here is idempotent, so it's safe to run more than once.
+
+-- A single row which is incremented by every statement which changes the
+-- runs, data, or modules tables. The website caches the results of its
+-- queries along with the version they were selected at, and throws them out
+-- when the version changes.
+CREATE TABLE IF NOT EXISTS cache_version (
+    id                  boolean PRIMARY KEY DEFAULT true CHECK (id),
+    version             bigint NOT NULL DEFAULT 0
+);
+
+INSERT INTO cache_version (id, version) VALUES (true, 0) ON CONFLICT (id) DO NOTHING;
+
+-- This is security definer since the users uploading data can't write to
+-- cache_version.
+CREATE OR REPLACE FUNCTION bump_cache_version() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+BEGIN
+    UPDATE cache_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS runs_cache_version ON runs;
+CREATE TRIGGER runs_cache_version AFTER INSERT OR UPDATE OR DELETE ON runs
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_cache_version();
+
+DROP TRIGGER IF EXISTS data_cache_version ON data;
+CREATE TRIGGER data_cache_version AFTER INSERT OR UPDATE OR DELETE ON data
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_cache_version();
+
+DROP TRIGGER IF EXISTS modules_cache_version ON modules;
+CREATE TRIGGER modules_cache_version AFTER INSERT OR UPDATE OR DELETE ON modules
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_cache_version();
+
+GRANT ALL ON cache_version TO btl_admin;
+GRANT SELECT ON cache_version TO btl_read;
+GRANT SELECT ON cache_version TO cms;
+
+ALTER TABLE cache_version OWNER TO btl_admin;
+ALTER FUNCTION bump_cache_version() OWNER TO btl_admin;
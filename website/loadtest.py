@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Load test of the website against a local PostgreSQL database.
+
+Sends requests to the module and channel pages from several threads at once
+through the Flask test client, and prints the number of requests, their
+latency, and the number of connections to the database every second. With
+the connection pool the number of connections should stay at or below
+DB_POOL_SIZE + DB_MAX_OVERFLOW no matter how many threads there are, and the
+latency should stay flat.
+
+Example:
+
+    $ WEBSITE_SETTINGS=settings.txt ./loadtest.py --threads 20 --duration 30 --no-cache
+"""
+from __future__ import print_function, division
+import argparse
+import random
+import threading
+import time
+import psycopg2
+
+def percentile(values, q):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(int(q*len(values)), len(values) - 1)]
+
+def count_connections(conn, dbname):
+    """
+    Returns the number of connections to `dbname` other than `conn`.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE datname = %s AND pid != pg_backend_pid()", (dbname,))
+    return cursor.fetchone()[0]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("load test of the website against a local database")
+    parser.add_argument("--threads", type=int, default=10, help="number of threads sending requests")
+    parser.add_argument("--duration", type=float, default=30, help="how long to send requests for (s)")
+    parser.add_argument("--no-cache", action='store_true', default=False, help="don't cache the query results, so every request goes to the database")
+    args = parser.parse_args()
+
+    from btl_testing import app
+    from btl_testing.db import engine
+    from btl_testing.moduledb import get_modules, get_channels
+
+    if args.no_cache:
+        app.config['CACHE_ENABLED'] = False
+
+    # Pick the pages to request from what's in the database.
+    with app.app_context():
+        modules, more = get_modules({}, limit=100)
+        channels, more = get_channels({}, limit=100)
+
+    urls = ['/module-database', '/module-database?limit=10', '/channel-database', '/channel-database?limit=10']
+    urls += ['/module-status?barcode=%i&run=%i' % (row['barcode'], row['run']) for row in modules]
+    urls += ['/channel-status?key=%i' % row['key'] for row in channels]
+    urls += ['/channel-arrays?key=%i' % row['key'] for row in channels]
+
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    done = threading.Event()
+
+    def worker():
+        client = app.test_client()
+        while not done.is_set():
+            url = random.choice(urls)
+            start = time.time()
+            response = client.get(url)
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                if response.status_code >= 400:
+                    errors[0] += 1
+
+    conn = psycopg2.connect(dbname=app.config['DB_NAME'],
+                            user=app.config['DB_USER'],
+                            host=app.config['DB_HOST'],
+                            port=app.config['DB_PORT'],
+                            password=app.config['DB_PASS'])
+    conn.autocommit = True
+
+    print("%i threads, %i urls, pool size %i, max overflow %i" % (args.threads, len(urls), engine.pool.size(), engine.pool._max_overflow))
+
+    threads = [threading.Thread(target=worker) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    total = []
+    max_connections = 0
+
+    print("%8s %8s %10s %10s %8s %12s" % ("time (s)", "requests", "p50 (ms)", "p99 (ms)", "errors", "connections"))
+    try:
+        while time.time() - start < args.duration:
+            time.sleep(1)
+            with lock:
+                values = latencies[:]
+                del latencies[:]
+                nerrors = errors[0]
+                errors[0] = 0
+            total += values
+            connections = count_connections(conn, app.config['DB_NAME'])
+            max_connections = max(max_connections, connections)
+            print("%8.1f %8i %10.1f %10.1f %8i %12i" % (time.time() - start, len(values), 1000*percentile(values, 0.5), 1000*percentile(values, 0.99), nerrors, connections))
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+
+    print("%i requests in %.1f s, %.0f requests/s, p50 %.1f ms, p99 %.1f ms, at most %i connections" % (len(total), time.time() - start, len(total)/(time.time() - start), 1000*percentile(total, 0.5), 1000*percentile(total, 0.99), max_connections))
+    print(engine.pool.status())
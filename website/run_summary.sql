@@ -0,0 +1,82 @@
+-- Indexes and the run_summary table used by the module and channel database
+-- pages. This is included from btl_qa.sql, and can also be run on its own to
+-- upgrade an existing database:
+--
+--     $ psql btl_qa -f run_summary.sql
+--
+-- Everything here is idempotent, so it's safe to run more than once.
+
+-- Selecting the channels of a module or a run, and listing the channels
+-- newest first (the channel database pages through them with the
+-- (timestamp, key) of the last row).
+CREATE INDEX IF NOT EXISTS data_barcode_idx ON data (barcode, timestamp DESC, key DESC);
+CREATE INDEX IF NOT EXISTS data_run_idx ON data (run);
+CREATE INDEX IF NOT EXISTS data_timestamp_idx ON data (timestamp DESC, key DESC);
+CREATE INDEX IF NOT EXISTS runs_timestamp_idx ON runs (timestamp DESC, run DESC);
+
+-- One row for every module in every run, with the per channel results as
+-- arrays ordered by channel. The module pages used to build this on every
+-- request by grouping the whole data table, so instead it's kept up to date
+-- by a trigger when the channels are inserted.
+CREATE TABLE IF NOT EXISTS run_summary (
+    run                 bigint NOT NULL references runs(run),
+    barcode             bigint NOT NULL,
+    run_timestamp       timestamp with time zone,
+    timestamp           timestamp with time zone,
+    keys                bigint[],
+    channels            smallint[],
+    sodium_peak         real[],
+    spe                 real[],
+    PRIMARY KEY (run, barcode)
+);
+
+CREATE INDEX IF NOT EXISTS run_summary_timestamp_idx ON run_summary (run_timestamp DESC, run DESC, barcode DESC);
+CREATE INDEX IF NOT EXISTS run_summary_barcode_idx ON run_summary (barcode, run_timestamp DESC, run DESC);
+
+-- Recomputes the row of run_summary for the run and module of a new channel.
+-- This is security definer since the users uploading data can't write to
+-- run_summary.
+CREATE OR REPLACE FUNCTION update_run_summary() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+BEGIN
+    INSERT INTO run_summary (run, barcode, run_timestamp, timestamp, keys, channels, sodium_peak, spe)
+        SELECT data.run, data.barcode, min(runs.timestamp), min(data.timestamp),
+               array_agg(data.key ORDER BY data.channel),
+               array_agg(data.channel ORDER BY data.channel),
+               array_agg(data.sodium_peak ORDER BY data.channel),
+               array_agg(data.spe ORDER BY data.channel)
+        FROM data JOIN runs ON data.run = runs.run
+        WHERE data.run = NEW.run AND data.barcode = NEW.barcode
+        GROUP BY data.run, data.barcode
+    ON CONFLICT (run, barcode) DO UPDATE SET
+        run_timestamp = EXCLUDED.run_timestamp,
+        timestamp = EXCLUDED.timestamp,
+        keys = EXCLUDED.keys,
+        channels = EXCLUDED.channels,
+        sodium_peak = EXCLUDED.sodium_peak,
+        spe = EXCLUDED.spe;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS data_run_summary ON data;
+CREATE TRIGGER data_run_summary AFTER INSERT ON data
+    FOR EACH ROW EXECUTE PROCEDURE update_run_summary();
+
+-- Fill in the runs which were uploaded before the table existed.
+INSERT INTO run_summary (run, barcode, run_timestamp, timestamp, keys, channels, sodium_peak, spe)
+    SELECT data.run, data.barcode, min(runs.timestamp), min(data.timestamp),
+           array_agg(data.key ORDER BY data.channel),
+           array_agg(data.channel ORDER BY data.channel),
+           array_agg(data.sodium_peak ORDER BY data.channel),
+           array_agg(data.spe ORDER BY data.channel)
+    FROM data JOIN runs ON data.run = runs.run
+    GROUP BY data.run, data.barcode
+ON CONFLICT (run, barcode) DO NOTHING;
+
+GRANT ALL ON run_summary TO btl_admin;
+GRANT SELECT ON run_summary TO btl_read;
+GRANT SELECT ON run_summary TO cms;
+
+ALTER TABLE run_summary OWNER TO btl_admin;
+ALTER FUNCTION update_run_summary() OWNER TO btl_admin;